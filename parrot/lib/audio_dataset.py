@@ -1,7 +1,10 @@
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, get_worker_info
 import os
 from lib.machinelearning import *
+from lib.augmentation import WaveAugmenter
+from lib.feature_cache import ShardedSamples
+from lib.load_data import concatenate_sample_sources, select_sample_sources, stack_label_samples
 import numpy as np
 import random
 import math
@@ -10,20 +13,68 @@ class AudioDataset(Dataset):
 
     def __init__(self, pytorch_data):
         self.paths = list( pytorch_data["data"].keys() )
-        self.samples = []
-        self.augmented_samples = []
-        self.length = 0
         self.training = False
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.generator = torch.Generator(device=self.device)
-        self.random_tensor = torch.tensor(1.0, requires_grad=False, device=self.device)
+        self.generator = torch.Generator()
+        self.augmenter = WaveAugmenter()
         
+        # The augmented samples can also be stored as audio, which is augmented again every time it is used
+        self.augmented_audio = pytorch_data.get("augmented_audio", False)
+        self.feature_engineering_type = pytorch_data.get("feature_engineering_type", FEATURE_ENGINEERING_TYPE)
+        self.streaming = pytorch_data.get("streaming", False)
+
+        # All the samples are kept in a single contiguous tensor, with the label indices in a matching int64 tensor
+        # When streaming, the samples are read from the shards in the feature cache instead
+        samples = []
+        labels = []
+        augmented_samples = []
+        augmented_labels = []
         for index, label in enumerate( pytorch_data["data"] ):
             print( "Indexing " + label + "..." )
-            for sample in pytorch_data["data"][label]:
-                self.samples.append([sample[0], index, sample[1]])
-            for augmented_sample in pytorch_data["augmented"][label]:
-                self.augmented_samples.append([augmented_sample[0], index, augmented_sample[1]])            
+            samples.append( pytorch_data["data"][label] )
+            labels.append( np.full( self.count_label_samples( pytorch_data["data"][label] ), index, dtype=np.int64 ) )
+            augmented_samples.append( pytorch_data["augmented"][label] )
+            augmented_labels.append( np.full( self.count_label_samples( pytorch_data["augmented"][label] ), index, dtype=np.int64 ) )
+
+        if self.streaming:
+            self.samples = ShardedSamples( [shard for label_shards in samples for shard in label_shards] )
+            self.augmented_samples = ShardedSamples( [shard for label_shards in augmented_samples for shard in label_shards] )
+        else:
+            self.samples = torch.from_numpy( stack_label_samples( samples ) )
+            self.augmented_samples = torch.from_numpy( stack_label_samples( augmented_samples ) )
+        self.labels = torch.from_numpy( np.concatenate( labels ) )
+        self.augmented_labels = torch.from_numpy( np.concatenate( augmented_labels ) )
+
+        # Where every sample came from, so the samples can be found in the recordings again after training
+        self.sample_sources = None
+        if "sources" in pytorch_data:
+            self.sample_sources = concatenate_sample_sources( [pytorch_data["sources"][label] for label in pytorch_data["data"]] )
+
+        # Labels that are loaded in only once for weighted sampling give every one of their samples a higher weight
+        label_weights = [pytorch_data.get("sample_weights", {}).get(label, 1) for label in self.paths]
+        self.sample_weights = None
+        if any( weight != 1 for weight in label_weights ):
+            self.sample_weights = torch.tensor( label_weights, dtype=torch.float64 )[self.labels]
+
+        # The offset variants of the samples of weighted labels are kept on disk, and only read when a sample is drawn more than once
+        # They are addressed by adding the length of the dataset to the index of the sample they belong to
+        self.offset_samples = None
+        self.offset_positions = None
+        offsets = pytorch_data.get( "offsets", {} )
+        if not self.streaming and any( len( label_offsets["samples"] ) > 0 for label_offsets in offsets.values() ):
+            offset_shards = []
+            offset_positions = []
+            for label in self.paths:
+                label_offsets = offsets.get( label, {"samples": [], "positions": np.full( self.count_label_samples( pytorch_data["data"][label] ), -1, dtype=np.int64 )} )
+                offset_count = sum( len( rows ) for _, rows in offset_shards )
+                offset_positions.append( np.where( label_offsets["positions"] >= 0, label_offsets["positions"] + offset_count, -1 ) )
+                offset_shards.extend( label_offsets["samples"] )
+            self.offset_samples = ShardedSamples( offset_shards )
+            self.offset_positions = torch.from_numpy( np.concatenate( offset_positions ) )
+
+    def count_label_samples(self, label_samples):
+        if self.streaming:
+            return sum( len( rows ) for _, rows in label_samples )
+        return len( label_samples )
 
     def set_training(self, training):
         self.training = training
@@ -31,13 +82,181 @@ class AudioDataset(Dataset):
     def __len__(self):
         return len( self.samples )
 
+    # Accepts both a single index and a tensor of indices, in which case a whole batch is returned at once
     def __getitem__(self, idx):
+        if not torch.is_tensor( idx ) or idx.dim() == 0:
+            samples, labels = self.get_batch( torch.tensor( [int(idx)] ) )
+            return samples[0], labels[0]
+        return self.get_batch( idx )
+
+    # Returns the indices that address the offset variants of the given samples, or the samples themselves if they have none
+    def get_offset_indices(self, indices):
+        indices = torch.as_tensor( indices, dtype=torch.int64 )
+        if self.offset_positions is None:
+            return indices
+        return torch.where( self.offset_positions[indices] >= 0, indices + len( self ), indices )
+
+    def get_batch(self, indices):
+        offset_mask = indices >= len( self )
+        if offset_mask.any():
+            indices = torch.where( offset_mask, indices - len( self ), indices )
+            samples = torch.as_tensor( self.samples[indices] )
+            samples[offset_mask] = torch.from_numpy( self.offset_samples[self.offset_positions[indices[offset_mask]].numpy()] )
+        else:
+            samples = torch.as_tensor( self.samples[indices] )
+        labels = self.labels[indices]
+
         # During training, get a 10% probability that you get an augmented sample
         if self.training:
-            self.random_tensor.uniform_(0, 1, generator=self.generator)
-            if self.random_tensor.item() >= 0.9:
-                return self.augmented_samples[idx][2], self.augmented_samples[idx][1]
-        return self.samples[idx][2], self.samples[idx][1]
+            augmented_mask = ( torch.rand( len( indices ), generator=self.generator ) >= 0.9 ) & ( indices < len( self.augmented_samples ) )
+            if augmented_mask.any():
+                augmented_indices = indices[augmented_mask]
+                samples[augmented_mask] = self.get_augmented_samples(augmented_indices)
+                labels[augmented_mask] = self.augmented_labels[augmented_indices]
+        return samples, labels
+
+    def get_augmented_samples(self, indices):
+        augmented_samples = self.augmented_samples[indices]
+        if self.augmented_audio:
+            augmented_samples = feature_engineering_batch( self.augmenter.augment_batch( np.asarray( augmented_samples ) ), RATE, self.feature_engineering_type )
+        return torch.as_tensor( augmented_samples )
 
     def get_labels(self):
         return self.paths
+
+    # Returns the sources of the given samples together with their label indices, or None if the sources are not known
+    def get_sample_sources(self, indices):
+        if self.sample_sources is None:
+            return None
+        indices = np.asarray( indices, dtype=np.int64 )
+        sample_sources = select_sample_sources( self.sample_sources, indices )
+        sample_sources["labels"] = self.labels.numpy()[indices].astype( np.int32 )
+        return sample_sources
+
+# Gives every data loader worker its own random streams, as they would otherwise all start from a copy of the same state
+def seed_dataset_worker(worker_id):
+    worker_info = get_worker_info()
+    dataset = worker_info.dataset.dataset if isinstance( worker_info.dataset, AudioBatchStream ) else worker_info.dataset
+    dataset.generator.manual_seed( worker_info.seed )
+    dataset.augmenter.reseed( worker_info.seed )
+
+# Streams shuffled batches of a subset of a streamed dataset
+# The samples are read from disk in blocks of neighbouring rows, after which a bounded buffer mixes the blocks together
+# Every data loader worker reads its own part of the blocks, so the batches are read ahead while training
+class AudioBatchStream(IterableDataset):
+
+    def __init__(self, dataset, indices, batch_size, shuffle = True, buffer_size = STREAMING_SHUFFLE_BUFFER):
+        self.dataset = dataset
+        self.indices = dataset.samples.sort_indices( indices )
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_size = max( buffer_size, batch_size )
+        self.block_size = max( batch_size, self.buffer_size // 8 )
+
+    def __iter__(self):
+        # The workers share the seed used to shuffle the blocks, so they each take a different part of the same block order
+        worker_info = get_worker_info()
+        block_generator = self.dataset.generator
+        if worker_info is not None:
+            block_generator = torch.Generator().manual_seed( worker_info.seed - worker_info.id )
+
+        blocks = [self.indices[start:start + self.block_size] for start in range( 0, len( self.indices ), self.block_size )]
+        if self.shuffle:
+            blocks = [blocks[block_index] for block_index in torch.randperm( len( blocks ), generator=block_generator ).tolist()]
+        if worker_info is not None:
+            blocks = blocks[worker_info.id::worker_info.num_workers]
+
+        if not self.shuffle:
+            for block in blocks:
+                for batch_indices in torch.split( torch.from_numpy( block ), self.batch_size ):
+                    yield self.dataset.get_batch( batch_indices )
+            return
+
+        buffer_samples = []
+        buffer_labels = []
+        buffered = 0
+        for block in blocks:
+            block_samples, block_labels = self.dataset.get_batch( torch.from_numpy( block ) )
+            buffer_samples.append( block_samples )
+            buffer_labels.append( block_labels )
+            buffered += len( block )
+            
+            # Once the buffer is full, it is shuffled and emptied until half of it is left
+            if buffered >= self.buffer_size:
+                samples, labels = self.shuffle_buffer( buffer_samples, buffer_labels )
+                batch_count = max( 1, ( buffered - self.buffer_size // 2 ) // self.batch_size )
+                for batch_index in range( batch_count ):
+                    yield samples[batch_index * self.batch_size:(batch_index + 1) * self.batch_size], labels[batch_index * self.batch_size:(batch_index + 1) * self.batch_size]
+                buffer_samples = [samples[batch_count * self.batch_size:]]
+                buffer_labels = [labels[batch_count * self.batch_size:]]
+                buffered = len( buffer_samples[0] )
+
+        if buffered > 0:
+            samples, labels = self.shuffle_buffer( buffer_samples, buffer_labels )
+            for batch_samples, batch_labels in zip( torch.split( samples, self.batch_size ), torch.split( labels, self.batch_size ) ):
+                yield batch_samples, batch_labels
+
+    def shuffle_buffer(self, buffer_samples, buffer_labels):
+        samples = torch.cat( buffer_samples )
+        labels = torch.cat( buffer_labels )
+        order = torch.randperm( len( samples ), generator=self.dataset.generator )
+        return samples[order], labels[order]
+
+# Yields shuffled batches of indices from a subset of the dataset
+# Used together with AudioDataset, every batch is fetched with a single indexing operation instead of per sample
+# When sample weights are given, every sample is drawn as many times as the whole part of its weight every epoch
+# The fractional parts of the weights decide which samples are drawn once more, without drawing any sample twice for them
+# So samples with a weight of one are drawn exactly once, and the labels stay as balanced as they would be with oversampling
+# Every draw of a sample after the first uses the offset indices, which address the offset variant of the sample when the dataset has one
+class AudioBatchSampler(Sampler):
+
+    def __init__(self, indices, batch_size, shuffle = True, sample_weights = None, offset_indices = None):
+        self.indices = torch.as_tensor( indices, dtype=torch.int64 )
+        self.offset_indices = self.indices if offset_indices is None else torch.as_tensor( offset_indices, dtype=torch.int64 )
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sample_weights = sample_weights
+        if sample_weights is not None:
+            sample_weights = torch.as_tensor( sample_weights, dtype=torch.float64 )
+            self.repeats = torch.floor( sample_weights ).to( torch.int64 )
+            self.fractions = sample_weights - self.repeats
+            self.extra_draws = int( round( self.fractions.sum().item() ) )
+
+    def count_indices(self):
+        if self.sample_weights is None:
+            return len( self.indices )
+        return int( self.repeats.sum().item() ) + self.extra_draws
+
+    def draw_indices(self):
+        if self.sample_weights is None:
+            return self.indices[torch.randperm( len( self.indices ) )] if self.shuffle else self.indices
+        
+        # The extra draws are picked without replacement in proportion to the fractional parts, using exponentially distributed keys
+        # Which, unlike torch.multinomial, has no limit on the amount of samples to pick from
+        extra_positions = torch.topk( torch.log( torch.rand( len( self.fractions ), dtype=torch.float64 ) ) / self.fractions, self.extra_draws ).indices
+        repeated_indices = torch.where( self.repeats > 0, self.offset_indices, self.indices )
+        drawn_indices = torch.cat( [self.indices[self.repeats > 0], 
+            torch.repeat_interleave( self.offset_indices, torch.clamp( self.repeats - 1, min=0 ) ), repeated_indices[extra_positions]] )
+        return drawn_indices[torch.randperm( len( drawn_indices ) )]
+
+    def __iter__(self):
+        for batch_indices in torch.split( self.draw_indices(), self.batch_size ):
+            yield batch_indices
+
+    def __len__(self):
+        return math.ceil( self.count_indices() / self.batch_size )
+
+# Only the training data is drawn using the sample weights, the validation data is used as it was loaded in
+def create_batch_loader(dataset, indices, batch_size, shuffle = True, weighted = False):
+    # Streamed datasets are read ahead by worker processes, which each yield complete batches
+    if dataset.streaming:
+        worker_options = {"prefetch_factor": 4} if STREAMING_WORKERS > 0 else {}
+        return DataLoader(AudioBatchStream(dataset, indices, batch_size, shuffle), batch_size=None, pin_memory=False, 
+            num_workers=STREAMING_WORKERS, worker_init_fn=seed_dataset_worker, **worker_options)
+
+    # Automatic batching is turned off, as the dataset already returns complete batches
+    sample_weights = dataset.sample_weights[indices] if weighted and shuffle and dataset.sample_weights is not None else None
+    offset_indices = dataset.get_offset_indices(indices) if sample_weights is not None else None
+    return DataLoader(dataset, sampler=AudioBatchSampler(indices, batch_size, shuffle, sample_weights, offset_indices), batch_size=None, pin_memory=False, 
+        num_workers=0, worker_init_fn=seed_dataset_worker)
+
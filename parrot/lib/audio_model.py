@@ -1,7 +1,16 @@
+from config.config import NUMPY_INFERENCE, CLASSIFIER_FOLDER
+import os
+import pickle
+import joblib
+from lib.numpy_classifier import create_numpy_classifier
+
 class AudioModel():
     classes_: []
     classifier: None
-    
+    numpy_classifier = None
+    pickled_classifier = None
+    classifier_file = None
+
     def __init__(self, settings, classifier):
         self.settings = {}
         self.settings['version'] = settings['version']
@@ -10,9 +19,10 @@ class AudioModel():
         self.settings['RECORD_SECONDS'] = settings['RECORD_SECONDS']
         self.settings['SLIDING_WINDOW_AMOUNT'] = settings['SLIDING_WINDOW_AMOUNT']
         self.settings['FEATURE_ENGINEERING_TYPE'] = settings['FEATURE_ENGINEERING_TYPE']
-        
+
         self.classifier = classifier
         self.classes_ = classifier.classes_
+        self.numpy_classifier = create_numpy_classifier(classifier)
         if ( self.settings['version'] == 0 ):
             print( "!----Upgrade note-----!" )
             print( "Parrot has added the AudioModel class to encapsulate models." )
@@ -20,14 +30,63 @@ class AudioModel():
             print( "If you are still using the old method, it is encouraged to update using the [C] menu in the settings" )
             print( "-----------------------" )
 
+    # Models with a numpy version keep the original classifier in a separate file next to the model, written by persist_audio_model
+    # So the model file only holds the numpy version, and the original classifier is only read from disk once it is used
+    # Without that file, the original classifier is pickled separately inside of the model, so its framework is still only loaded in once it is used
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if ( self.numpy_classifier is not None and self.classifier_file is not None ):
+            state['pickled_classifier'] = None
+            state['classifier'] = None
+        elif ( self.numpy_classifier is not None ):
+            state['pickled_classifier'] = pickle.dumps( self.get_classifier() )
+            state['classifier'] = None
+        return state
+
+    # Models saved before the numpy versions were added get one when they are loaded in
+    def __setstate__(self, state):
+        self.__dict__.update( state )
+        if ( 'numpy_classifier' not in state ):
+            self.numpy_classifier = create_numpy_classifier(self.classifier)
+
+    # The numpy version is also used when the file with the original classifier has been removed
+    def uses_numpy(self):
+        return self.numpy_classifier is not None and ( NUMPY_INFERENCE or self.get_classifier() is None )
+
     def predict_proba(self, data):
-        return self.classifier.predict_proba(data)
+        if ( self.uses_numpy() ):
+            return self.numpy_classifier.predict_proba(data)
+        return self.get_classifier().predict_proba(data)
 
     def get_setting(self, setting_key, default_value):
         if( setting_key in self.settings ):
             return self.settings[setting_key]
         else:
             return default_value
-    
+
     def get_classifier(self):
-        return self.classifier
\ No newline at end of file
+        if ( self.classifier is None and self.pickled_classifier is not None ):
+            self.classifier = pickle.loads( self.pickled_classifier )
+            self.pickled_classifier = None
+        elif ( self.classifier is None and self.classifier_file is not None and os.path.exists( os.path.join( CLASSIFIER_FOLDER, self.classifier_file ) ) ):
+            self.classifier = joblib.load( os.path.join( CLASSIFIER_FOLDER, self.classifier_file ) )
+        return self.classifier
+
+# Saves the model to the given file in the classifier folder
+# The original classifier of a model with a numpy version is saved to a .classifier file next to it, rather than inside of the model
+# Both are written to a temporary file first so a model that is being used is never replaced by a half written one
+def persist_audio_model(audio_model, filename):
+    if ( audio_model.numpy_classifier is not None ):
+        classifier_file = os.path.splitext( os.path.basename( filename ) )[0] + ".classifier"
+        
+        # A model that is saved again under the same name keeps the file of its original classifier, if it has not been read in
+        if ( audio_model.classifier is not None or audio_model.classifier_file != classifier_file ):
+            classifier = audio_model.get_classifier()
+            if ( classifier is not None ):
+                classifier_filename = os.path.join( os.path.dirname( filename ), classifier_file )
+                joblib.dump( classifier, classifier_filename + ".tmp" )
+                os.replace( classifier_filename + ".tmp", classifier_filename )
+            audio_model.classifier_file = classifier_file if classifier is not None else None
+
+    joblib.dump( audio_model, filename + ".tmp" )
+    os.replace( filename + ".tmp", filename )
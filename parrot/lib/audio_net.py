@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
 import os
 from lib.machinelearning import *
 import numpy as np
@@ -10,9 +9,11 @@ import csv
 from config.config import *
 import torch.optim as optim
 import time 
-from lib.combine_models import connect_model
+from lib.checkpoint_writer import CheckpointWriter, snapshot_state_dict
 from lib.key_poller import KeyPoller
+from lib.audio_dataset import create_batch_loader
 import random
+import math
 
 class TinyAudioNet(nn.Module):
 
@@ -63,6 +64,143 @@ class TinyAudioNetEnsemble(nn.Module):
         
         return out / self.model_length
             
+# A linear layer for every member of an ensemble, stored as a single stacked weight tensor
+# Takes an input of ( members, batch, inputsize ) and applies every member to its own slice with a batched matrix multiplication
+class StackedLinear(nn.Module):
+    def __init__(self, member_count, inputsize, outputsize):
+        super(StackedLinear, self).__init__()
+        bound = 1 / math.sqrt(inputsize)
+        self.weight = nn.Parameter(torch.empty(member_count, inputsize, outputsize).uniform_(-bound, bound))
+        self.bias = nn.Parameter(torch.empty(member_count, 1, outputsize).uniform_(-bound, bound))
+
+    def forward(self, x):
+        return torch.baddbmm(self.bias, x, self.weight)
+
+# Batch normalization that keeps separate statistics for every member of an ensemble
+class StackedBatchNorm(nn.Module):
+    def __init__(self, member_count, inputsize, eps = 1e-5, momentum = 0.1):
+        super(StackedBatchNorm, self).__init__()
+        self.eps = eps
+        self.momentum = momentum
+        self.weight = nn.Parameter(torch.ones(member_count, 1, inputsize))
+        self.bias = nn.Parameter(torch.zeros(member_count, 1, inputsize))
+        self.register_buffer('running_mean', torch.zeros(member_count, 1, inputsize))
+        self.register_buffer('running_var', torch.ones(member_count, 1, inputsize))
+        self.register_buffer('num_batches_tracked', torch.tensor(0, dtype=torch.long))
+
+    def forward(self, x):
+        if self.training:
+            mean = x.mean(dim=1, keepdim=True)
+            var = x.var(dim=1, unbiased=False, keepdim=True)
+            with torch.no_grad():
+                batch_size = x.shape[1]
+                self.running_mean.mul_(1 - self.momentum).add_(mean * self.momentum)
+                self.running_var.mul_(1 - self.momentum).add_(var * (batch_size / max(1, batch_size - 1)) * self.momentum)
+                self.num_batches_tracked.add_(1)
+        else:
+            mean = self.running_mean
+            var = self.running_var
+        return ( x - mean ) / torch.sqrt(var + self.eps) * self.weight + self.bias
+
+# All the members of an ensemble of TinyAudioNets in a single model, so they can be trained in one batched pass
+# The weights of the members can be moved in and out as ordinary TinyAudioNet state dicts
+class StackedTinyAudioNet(nn.Module):
+    layer_names = ['fc1', 'fc2', 'fc3', 'fc4', 'fc5', 'fc6']
+
+    def __init__(self, member_count, inputsize, outputsize):
+        super(StackedTinyAudioNet, self).__init__()
+        self.member_count = member_count
+        self.selu = nn.SELU()
+        self.dropOut = nn.Dropout(p=0.15)
+        
+        self.batchNorm = StackedBatchNorm(member_count, inputsize)
+        self.fc1 = StackedLinear(member_count, inputsize, 512)
+        self.fc2 = StackedLinear(member_count, 512, 512)
+        self.fc3 = StackedLinear(member_count, 512, 512)
+        self.fc4 = StackedLinear(member_count, 512, 512)
+        self.fc5 = StackedLinear(member_count, 512, 256)
+        self.fc6 = StackedLinear(member_count, 256, outputsize)
+
+    def forward(self, x):
+        x = self.dropOut(self.selu( self.fc1(self.batchNorm(x))))
+        x = self.dropOut(self.selu( self.fc2(x) ))
+        x = self.dropOut(self.selu( self.fc3(x) ))
+        x = self.dropOut(self.selu( self.fc4(x) ))
+        x = self.dropOut(self.selu( self.fc5(x) ))
+        return F.log_softmax(self.fc6(x), dim=-1)
+    
+    # Clips the gradient norm of every member separately, like clip_grad_norm_ would for the separate nets
+    def clip_grad_norm_(self, max_norm):
+        gradients = [parameter.grad for parameter in self.parameters() if parameter.grad is not None]
+        member_norms = torch.sqrt(sum(gradient.pow(2).reshape(self.member_count, -1).sum(dim=1) for gradient in gradients))
+        clip_coefficients = torch.clamp(max_norm / (member_norms + 1e-6), max=1.0)
+        for gradient in gradients:
+            gradient.mul_(clip_coefficients.reshape((self.member_count,) + (1,) * (gradient.dim() - 1)))
+
+    def load_member_state_dicts(self, state_dicts):
+        with torch.no_grad():
+            for member, state_dict in enumerate(state_dicts):
+                for layer_name in self.layer_names:
+                    getattr(self, layer_name).weight[member].copy_(state_dict[layer_name + '.weight'].t())
+                    getattr(self, layer_name).bias[member, 0].copy_(state_dict[layer_name + '.bias'])
+                for key in ['weight', 'bias', 'running_mean', 'running_var']:
+                    getattr(self.batchNorm, key)[member, 0].copy_(state_dict['batchNorm.' + key])
+            self.batchNorm.num_batches_tracked.copy_(state_dicts[0]['batchNorm.num_batches_tracked'])
+
+    def member_state_dicts(self):
+        state_dicts = []
+        with torch.no_grad():
+            for member in range(self.member_count):
+                state_dict = {}
+                for key in ['weight', 'bias', 'running_mean', 'running_var']:
+                    state_dict['batchNorm.' + key] = getattr(self.batchNorm, key)[member, 0].detach().clone()
+                state_dict['batchNorm.num_batches_tracked'] = self.batchNorm.num_batches_tracked.detach().clone()
+                for layer_name in self.layer_names:
+                    state_dict[layer_name + '.weight'] = getattr(self, layer_name).weight[member].t().detach().clone()
+                    state_dict[layer_name + '.bias'] = getattr(self, layer_name).bias[member, 0].detach().clone()
+                state_dicts.append(state_dict)
+        return state_dicts
+
+# Folds the batch normalization in front of the first linear layer of a TinyAudioNet into the weights of that layer
+# Returns the weight and bias of a linear layer that gives the same output as the batch normalization followed by the layer, during evaluation
+def fold_batch_norm(state_dict):
+    scale = state_dict['batchNorm.weight'].double() / torch.sqrt(state_dict['batchNorm.running_var'].double() + 1e-5)
+    shift = state_dict['batchNorm.bias'].double() - state_dict['batchNorm.running_mean'].double() * scale
+    weight = state_dict['fc1.weight'].double()
+    return weight * scale, state_dict['fc1.bias'].double() + weight.matmul(shift)
+
+# An evaluation only version of an ensemble of TinyAudioNets, which averages the probabilities of all the members
+# The weights of all the members are stacked into a single float32 graph, so every layer is one matrix multiplication for the whole ensemble
+# The batch normalization is folded into the first layer, whose weights are concatenated so the input is only multiplied once
+# The probabilities differ less than 1e-5 from the members evaluated one after the other in float64
+# It can be exported to TorchScript, which does not require this class to be loaded
+class FusedTinyAudioNetEnsemble(nn.Module):
+
+    def __init__(self, state_dicts):
+        super(FusedTinyAudioNetEnsemble, self).__init__()
+        self.member_count = len(state_dicts)
+        self.hidden_size = state_dicts[0]['fc1.weight'].shape[0]
+        folded_layers = [fold_batch_norm(state_dict) for state_dict in state_dicts]
+        self.register_buffer('input_weight', torch.cat([weight for weight, _ in folded_layers]).t().float().contiguous())
+        self.register_buffer('input_bias', torch.cat([bias for _, bias in folded_layers]).float())
+        for layer_name in ['fc2', 'fc3', 'fc4', 'fc5', 'fc6']:
+            self.register_buffer(layer_name + '_weight', torch.stack([state_dict[layer_name + '.weight'].t() for state_dict in state_dicts]).float().contiguous())
+            self.register_buffer(layer_name + '_bias', torch.stack([state_dict[layer_name + '.bias'].unsqueeze(0) for state_dict in state_dicts]).float())
+
+    def forward(self, x):
+        x = F.selu(torch.addmm(self.input_bias, x.float(), self.input_weight))
+        x = x.reshape(x.shape[0], self.member_count, self.hidden_size).transpose(0, 1)
+        x = F.selu(torch.baddbmm(self.fc2_bias, x, self.fc2_weight))
+        x = F.selu(torch.baddbmm(self.fc3_bias, x, self.fc3_weight))
+        x = F.selu(torch.baddbmm(self.fc4_bias, x, self.fc4_weight))
+        x = F.selu(torch.baddbmm(self.fc5_bias, x, self.fc5_weight))
+        x = torch.baddbmm(self.fc6_bias, x, self.fc6_weight)
+        return F.softmax(x, dim=-1).mean(dim=0)
+
+# Counts how often every label is predicted as every other label, with the true labels as rows
+def determine_confusion_matrix(labels, predictions, label_count):
+    return torch.bincount(labels * label_count + predictions, minlength = label_count * label_count).reshape(label_count, label_count)
+
 class AudioNetTrainer:
     nets = []
     dataset_labels = []
@@ -92,6 +230,9 @@ class AudioNetTrainer:
         self.audio_settings = audio_settings
         self.dataset_size = len(dataset)
         
+        self.stacked = STACKED_ENSEMBLE_TRAINING and net_count > 1
+        self.validation_samples = []
+        
         split = int(np.floor(self.validation_split * self.dataset_size))
 
         for i in range(self.net_count):
@@ -105,19 +246,48 @@ class AudioNetTrainer:
             np.random.shuffle(indices)
             train_indices, val_indices = indices[split:], indices[:split]
             self.train_indices.append( train_indices)
+            self.validation_samples.append( self.describe_validation_samples(dataset, val_indices) )
             
-            train_sampler = SubsetRandomSampler(self.train_indices[i])
-            valid_sampler = SubsetRandomSampler(val_indices)
-            self.train_loaders.append(torch.utils.data.DataLoader(dataset, batch_size=self.batch_size, sampler=train_sampler, pin_memory=False, num_workers=0))
-            self.validation_loaders.append(torch.utils.data.DataLoader(dataset, batch_size=self.batch_size, sampler=valid_sampler, pin_memory=False, num_workers=0))
+            self.train_loaders.append(create_batch_loader(dataset, self.train_indices[i], self.batch_size, weighted=True))
+            self.validation_loaders.append(create_batch_loader(dataset, val_indices, self.batch_size))
+
+        # Train all the nets at once using a single stacked model, starting from the same initial weights as the separate nets
+        if self.stacked:
+            self.stacked_net = StackedTinyAudioNet(self.net_count, self.input_size, len(self.dataset_labels))
+            self.stacked_net.load_member_state_dicts([net.state_dict() for net in self.nets])
+            self.stacked_optimizer = optim.SGD(self.stacked_net.parameters(), lr=0.003, momentum=0.9, nesterov=True)
         
+    # The validation samples are stored in the checkpoints as the recordings and windows they came from
+    # So the accuracy of the combined model can be measured on the same samples after training, for example when quantizing it
+    def describe_validation_samples(self, dataset, val_indices):
+        sample_sources = dataset.get_sample_sources(val_indices)
+        if sample_sources is None:
+            return None
+        return {
+            "files": sample_sources["files"],
+            "file_indices": torch.from_numpy(sample_sources["file_indices"]),
+            "windows": torch.from_numpy(sample_sources["windows"]),
+            "labels": torch.from_numpy(sample_sources["labels"]),
+        }
+
     def train(self, filename):
+        # The weights are written to disk in the background, the training loop only waits for them once it is done
+        checkpoint_writer = CheckpointWriter()
+        try:
+            self.train_epochs(filename, checkpoint_writer)
+            checkpoint_writer.finish()
+        finally:
+            checkpoint_writer.close()
+
+    def train_epochs(self, filename, checkpoint_writer):
         best_accuracy = []
-        combined_classifier_map = {}
+        best_checkpoints = []
         for i in range(self.net_count):
             self.nets[i] = self.nets[i].to(self.device)
-            combined_classifier_map['classifier_' + str(i)] = os.path.join(CLASSIFIER_FOLDER, filename + '_' + str(i + 1) + '-BEST-weights.pth.tar')
             best_accuracy.append(0)
+            best_checkpoints.append(None)
+        if self.stacked:
+            self.stacked_net = self.stacked_net.to(self.device)
         starttime = int(time.time())
         combined_model = TinyAudioNetEnsemble(self.nets).to(self.device)
         
@@ -131,42 +301,11 @@ class AudioNetTrainer:
             for epoch in range(self.max_epochs):
                 # Training
                 self.dataset.set_training(True)
-                epoch_loss = 0.0
-                running_loss = []
-                for j in range(self.net_count):
-                    running_loss.append(0.0)
-                    self.nets[j].train(True)
-                    
-                    i = 0
-                    with torch.set_grad_enabled(True):
-                        st_batch= time.time()
-                        for local_batch, local_labels in self.train_loaders[j]:
-                            # Transfer to GPU
-                            local_batch, local_labels = local_batch.to(self.device), local_labels.to(self.device)
-                            
-                            # Zero the gradients for this batch
-                            i += 1                        
-                            net = self.nets[j]
-                            optimizer = self.optimizers[j]
-                            optimizer.zero_grad()
-                        
-                            # Calculating loss
-                            output = net(local_batch)
-                            loss = self.criterion(output, local_labels)
-                            loss.backward()
-                                    
-                            # Prevent exploding weights
-                            torch.nn.utils.clip_grad_norm_(net.parameters(),4)
-                            optimizer.step()
-                        
-                            running_loss[j] += loss.item()
-                            epoch_loss += output.shape[0] * loss.item()
-                            
-                            if( i % 10 == 0 ):
-                                correct_in_minibatch = ( local_labels == output.max(dim = 1)[1] ).sum()
-                                print('[Net: %d, %d, %5d] loss: %.3f acc: %.3f' % (j + 1, epoch + 1, i + 1, (running_loss[j] / 10), correct_in_minibatch.item()/self.batch_size))
-                                running_loss[j] = 0.0
-                    
+                if self.stacked:
+                    epoch_loss = self.train_stacked_epoch(epoch)
+                else:
+                    epoch_loss = self.train_members_epoch(epoch)
+
                 epoch_loss = epoch_loss / ( self.dataset_size * (1 - self.validation_split) )
                 print('Training loss: {:.4f}'.format(epoch_loss))
                 print( "Validating..." )
@@ -175,88 +314,54 @@ class AudioNetTrainer:
                 
                 # Validation
                 self.dataset.set_training(False)
-                epoch_validation_loss = []
-                correct = []
-                epoch_loss = []
-                accuracy = []
-                combined_correct = 0
+                epoch_loss, accuracy, combined_accuracy, label_accuracy, confusion_matrices = self.validate_epoch(combined_model)
                 for j in range(self.net_count):
-                    epoch_validation_loss.append(0.0)
-                    correct.append(0)
-                
-                    with torch.set_grad_enabled(False):
-                        accuracy_batch = {'total': {}, 'correct': {}, 'percent': {}}
-                        for dataset_label in self.dataset_labels:
-                            accuracy_batch['total'][dataset_label] = 0
-                            accuracy_batch['correct'][dataset_label] = 0
-                            accuracy_batch['percent'][dataset_label] = 0
-                    
-                        for local_batch, local_labels in self.validation_loaders[j]:
-                            # Transfer to GPU
-                            local_batch, local_labels = local_batch.to(self.device), local_labels.to(self.device)
-                            
-                            # Zero the gradients for this batch
-                            optimizer = self.optimizers[j]
-                            net = self.nets[j]
-                            optimizer.zero_grad()
-                            
-                            # Calculating loss
-                            output = net(local_batch)
-                            correct[j] += ( local_labels == output.max(dim = 1)[1] ).sum().item()
-                            loss = self.criterion(output, local_labels)
-                            epoch_validation_loss[j] += output.shape[0] * loss.item()
-                            
-                            # Calculate combined accuracy on last validation pass
-                            if (j + 1 == self.net_count):
-                                combined_output = combined_model(local_batch)
-                                combined_correct += ( local_labels == combined_output.max(dim = 1)[1] ).sum().item()
-                            
-                            # Calculate the percentages
-                            for index, label in enumerate(local_labels):
-                                local_label_string = self.dataset_labels[label]
-                                accuracy_batch['total'][local_label_string] += 1
-                                if( output[index].argmax() == label ):
-                                    accuracy_batch['correct'][local_label_string] += 1
-                                accuracy_batch['percent'][local_label_string] = accuracy_batch['correct'][local_label_string] / accuracy_batch['total'][local_label_string]
-                
-                
-                for j in range(self.net_count):
-                    epoch_loss.append(epoch_validation_loss[j] / ( self.dataset_size * self.validation_split ) )
-                    accuracy.append( correct[j] / ( self.dataset_size * self.validation_split ) )
                     print('[Net: %d] Validation loss: %.4f accuracy %.3f' % (j + 1, epoch_loss[j], accuracy[j]))
 
-                print('[Combined] Sum validation loss: %.4f average accuracy %.3f' % (np.sum(epoch_loss), combined_correct / ( self.dataset_size * self.validation_split )))
+                print('[Combined] Sum validation loss: %.4f average accuracy %.3f' % (np.sum(epoch_loss), combined_accuracy))
                 
                 csv_row = { 'epoch': epoch, 'loss': np.sum(epoch_loss), 'avg_validation_accuracy': np.average(accuracy) }
-                for dataset_label in self.dataset_labels:
-                    csv_row[dataset_label] = accuracy_batch['percent'][dataset_label]
+                for label_index, dataset_label in enumerate(self.dataset_labels):
+                    csv_row[dataset_label] = label_accuracy[label_index]
                 writer.writerow( csv_row )
                 csvfile.flush()
                                 
                 new_best = False
+                persist_latest = CHECKPOINT_EVERY_EPOCHS > 0 and ( epoch + 1 ) % CHECKPOINT_EVERY_EPOCHS == 0
                 for j in range(self.net_count):
-                    current_filename = filename + '_' + str(j+1)
-                    if( accuracy[j] > best_accuracy[j] ):
-                        best_accuracy[j] = accuracy[j]
-                        current_filename = filename + '_' + str(j+1) + '-BEST'
-                        new_best = True
-                        
-                    torch.save({'state_dict': self.nets[j].state_dict(), 
+                    improved = accuracy[j] > best_accuracy[j]
+                    if not improved and not persist_latest:
+                        continue
+
+                    checkpoint = {'state_dict': snapshot_state_dict(self.nets[j]), 
                         'input_size': self.input_size,
                         'labels': self.dataset_labels,
                         'accuracy': accuracy[j],
+                        'confusion_matrix': confusion_matrices[j],
                         'last_row': csv_row,
                         'loss': epoch_loss[j],
                         'epoch': epoch,
                         'random_seed': self.random_seeds[j],
-                        }, os.path.join(CLASSIFIER_FOLDER, current_filename) + '-weights.pth.tar')
+                        'validation_samples': self.validation_samples[j],
+                        }
+                    current_filename = filename + '_' + str(j+1)
+                    if( improved ):
+                        best_accuracy[j] = accuracy[j]
+                        best_checkpoints[j] = checkpoint
+                        current_filename = filename + '_' + str(j+1) + '-BEST'
+                        new_best = True
+                    checkpoint_writer.save_checkpoint(checkpoint, os.path.join(CLASSIFIER_FOLDER, current_filename) + '-weights.pth.tar')
                 
                 # Persist a new combined model with the best weights if new best weights are given
                 if (new_best == True):
                     print( "------------------------------------------------------")
                     print( "Persisting new combined best in " + filename )
-                    print( "------------------------------------------------------")                    
-                    connect_model( filename, combined_classifier_map, "ensemble_torch", True, self.audio_settings )
+                    print( "------------------------------------------------------")
+                    combined_classifier_map = {}
+                    for j in range(self.net_count):
+                        if best_checkpoints[j] is not None:
+                            combined_classifier_map['classifier_' + str(j)] = best_checkpoints[j]
+                    checkpoint_writer.save_combined_model( filename, combined_classifier_map, self.audio_settings )
                 
                 with KeyPoller() as key_poller:
                     ESCAPEKEY = '\x1b'
@@ -264,4 +369,130 @@ class AudioNetTrainer:
                     if ( character == ESCAPEKEY ):
                         print("Pressed escape - Stopped training loop")
                         print( "------------------------------------------------------")
-                        return
\ No newline at end of file
+                        return
+
+    # Collects the predictions of every net into a single tensor per epoch
+    # So the accuracies and the confusion matrices are counted at once rather than per sample
+    def validate_epoch(self, combined_model):
+        validation_size = self.dataset_size * self.validation_split
+        label_count = len(self.dataset_labels)
+        epoch_loss = []
+        accuracy = []
+        confusion_matrices = []
+        with torch.set_grad_enabled(False):
+            for j in range(self.net_count):
+                validation_loss = torch.zeros((), device=self.device)
+                labels = []
+                predictions = []
+                combined_predictions = []
+                for local_batch, local_labels in self.validation_loaders[j]:
+                    # Transfer to GPU
+                    local_batch, local_labels = local_batch.to(self.device), local_labels.to(self.device)
+                    
+                    output = self.nets[j](local_batch)
+                    validation_loss += output.shape[0] * self.criterion(output, local_labels)
+                    labels.append(local_labels)
+                    predictions.append(output.argmax(dim = 1))
+                    
+                    # Calculate combined accuracy on last validation pass
+                    if (j + 1 == self.net_count):
+                        combined_predictions.append(combined_model(local_batch).argmax(dim = 1))
+                
+                labels = torch.cat(labels)
+                confusion_matrix = determine_confusion_matrix(labels, torch.cat(predictions), label_count)
+                epoch_loss.append(validation_loss.item() / validation_size)
+                accuracy.append(confusion_matrix.diagonal().sum().item() / validation_size)
+                confusion_matrices.append(confusion_matrix.tolist())
+            combined_accuracy = ( labels == torch.cat(combined_predictions) ).sum().item() / validation_size
+
+        # The accuracy per label is given for the validation set of the last net
+        label_totals = confusion_matrix.sum(dim = 1)
+        label_accuracy = ( confusion_matrix.diagonal().double() / label_totals.clamp(min = 1) ).tolist()
+        return epoch_loss, accuracy, combined_accuracy, label_accuracy, confusion_matrices
+
+    def train_members_epoch(self, epoch):
+        epoch_loss = 0.0
+        running_loss = []
+        for j in range(self.net_count):
+            running_loss.append(0.0)
+            self.nets[j].train(True)
+
+            i = 0
+            with torch.set_grad_enabled(True):
+                st_batch= time.time()
+                for local_batch, local_labels in self.train_loaders[j]:
+                    # Transfer to GPU
+                    local_batch, local_labels = local_batch.to(self.device), local_labels.to(self.device)
+
+                    # Zero the gradients for this batch
+                    i += 1                        
+                    net = self.nets[j]
+                    optimizer = self.optimizers[j]
+                    optimizer.zero_grad()
+
+                    # Calculating loss
+                    output = net(local_batch)
+                    loss = self.criterion(output, local_labels)
+                    loss.backward()
+
+                    # Prevent exploding weights
+                    torch.nn.utils.clip_grad_norm_(net.parameters(),4)
+                    optimizer.step()
+
+                    running_loss[j] += loss.item()
+                    epoch_loss += output.shape[0] * loss.item()
+
+                    if( i % 10 == 0 ):
+                        correct_in_minibatch = ( local_labels == output.max(dim = 1)[1] ).sum()
+                        print('[Net: %d, %d, %5d] loss: %.3f acc: %.3f' % (j + 1, epoch + 1, i + 1, (running_loss[j] / 10), correct_in_minibatch.item()/self.batch_size))
+                        running_loss[j] = 0.0
+        return epoch_loss
+
+    # Draws the training indices of a member for a single epoch, using the sample weights of the dataset if it has them
+    # Streamed datasets are never weighted, and their loaders do not sample indices, so they are simply shuffled
+    def draw_member_indices(self, j):
+        if self.dataset.streaming:
+            return torch.as_tensor(self.train_indices[j])[torch.randperm(len(self.train_indices[j]))]
+        return self.train_loaders[j].sampler.draw_indices()
+
+    # Trains every member of the ensemble in a single batched pass
+    # Every member still gets its own batches from its own training indices, gathered from the dataset at once
+    def train_stacked_epoch(self, epoch):
+        epoch_loss = 0.0
+        running_loss = [0.0 for j in range(self.net_count)]
+        self.stacked_net.train(True)
+        
+        # With sample weights, the members can draw a slightly different amount of indices, so they are cut off at the shortest draw
+        member_indices = [self.draw_member_indices(j) for j in range(self.net_count)]
+        member_indices = torch.stack([indices[:min(len(indices) for indices in member_indices)] for indices in member_indices])
+        with torch.set_grad_enabled(True):
+            for i, batch_indices in enumerate(torch.split(member_indices, self.batch_size, dim=1)):
+                local_batch, local_labels = self.dataset.get_batch(batch_indices.reshape(-1))
+                local_batch = local_batch.reshape(self.net_count, -1, self.input_size).to(self.device)
+                local_labels = local_labels.reshape(self.net_count, -1).to(self.device)
+                self.stacked_optimizer.zero_grad()
+
+                # Calculating the loss of every member, the sum of the losses gives every member its own gradients
+                output = self.stacked_net(local_batch)
+                losses = F.nll_loss(output.reshape(-1, output.shape[-1]), local_labels.reshape(-1), reduction='none').reshape(self.net_count, -1).mean(dim=1)
+                losses.sum().backward()
+
+                # Prevent exploding weights
+                self.stacked_net.clip_grad_norm_(4)
+                self.stacked_optimizer.step()
+                
+                member_losses = losses.tolist()
+                for j in range(self.net_count):
+                    running_loss[j] += member_losses[j]
+                    epoch_loss += local_batch.shape[1] * member_losses[j]
+
+                if( ( i + 1 ) % 10 == 0 ):
+                    correct_in_minibatch = ( local_labels == output.argmax(dim = -1) ).sum(dim = 1).tolist()
+                    for j in range(self.net_count):
+                        print('[Net: %d, %d, %5d] loss: %.3f acc: %.3f' % (j + 1, epoch + 1, i + 2, (running_loss[j] / 10), correct_in_minibatch[j]/self.batch_size))
+                        running_loss[j] = 0.0
+
+        # Copy the trained weights over to the separate nets used for validation and persisting
+        for j, state_dict in enumerate(self.stacked_net.member_state_dicts()):
+            self.nets[j].load_state_dict(state_dict)
+        return epoch_loss
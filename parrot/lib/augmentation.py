@@ -0,0 +1,88 @@
+import numpy as np
+from config.config import AUGMENT_GAIN
+
+# Augments whole ( windows, samples ) batches of audio at once, used to generate more samples to train on
+# Every perturbation is applied to a random half of the windows, with the random values drawn from a single seeded generator
+# So the same seed always gives the same augmentations, and separate processes can each be given their own stream
+# The gain is only changed when AUGMENT_GAIN is turned on, the noise, time stretch and shift follow the original audiomentations pipeline
+class WaveAugmenter:
+
+    def __init__(self, seed = None, probability = 0.5, use_gain = AUGMENT_GAIN, min_gain_db = -6.0, max_gain_db = 6.0, min_noise_amplitude = 0.001, max_noise_amplitude = 0.015,
+        min_rate = 0.8, max_rate = 1.25, min_shift = -0.5, max_shift = 0.5):
+        self.probability = probability
+        self.use_gain = use_gain
+        self.min_gain_db = min_gain_db
+        self.max_gain_db = max_gain_db
+        self.min_noise_amplitude = min_noise_amplitude
+        self.max_noise_amplitude = max_noise_amplitude
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.min_shift = min_shift
+        self.max_shift = max_shift
+        self.reseed(seed)
+
+    def reseed(self, seed = None):
+        self.rng = np.random.default_rng(seed)
+
+    # Returns an augmented float32 copy of the windows, with the same shape as the given windows
+    def augment_batch(self, windows) -> np.array:
+        windows = np.array(windows, dtype=np.float32)
+        if windows.ndim != 2 or windows.size == 0:
+            return windows
+
+        if self.use_gain:
+            windows = self.apply_gain(windows)
+        windows = self.add_gaussian_noise(windows)
+        windows = self.stretch_time(windows)
+        return self.shift(windows)
+
+    def select_windows(self, windows) -> np.array:
+        return self.rng.random(len(windows)) < self.probability
+
+    def apply_gain(self, windows) -> np.array:
+        selected = self.select_windows(windows)
+        gain_db = self.rng.uniform(self.min_gain_db, self.max_gain_db, len(windows))
+        windows[selected] *= np.power(10, gain_db[selected] / 20).astype(np.float32)[:, np.newaxis]
+        return windows
+
+    def add_gaussian_noise(self, windows) -> np.array:
+        selected = self.select_windows(windows)
+        amplitudes = self.rng.uniform(self.min_noise_amplitude, self.max_noise_amplitude, len(windows))
+        noise = self.rng.standard_normal((np.count_nonzero(selected), windows.shape[1]), dtype=np.float32)
+        windows[selected] += noise * amplitudes[selected].astype(np.float32)[:, np.newaxis]
+        return windows
+
+    # Resamples the windows by a random rate, which changes both their speed and their pitch
+    # Unlike the phase vocoder of the audiomentations TimeStretch it replaced, which only changes the speed
+    # Faster windows are padded with silence at the end and slower windows are cut off, so their length stays the same
+    def stretch_time(self, windows) -> np.array:
+        selected = self.select_windows(windows)
+        rates = self.rng.uniform(self.min_rate, self.max_rate, len(windows))
+        if not selected.any():
+            return windows
+
+        window_size = windows.shape[1]
+        positions = np.arange(window_size)[np.newaxis, :] * rates[selected][:, np.newaxis]
+        lower_indices = np.minimum(np.floor(positions).astype(np.int64), window_size - 1)
+        upper_indices = np.minimum(lower_indices + 1, window_size - 1)
+        fractions = (positions - lower_indices).astype(np.float32)
+
+        stretched_windows = windows[selected]
+        lower_values = np.take_along_axis(stretched_windows, lower_indices, axis=1)
+        upper_values = np.take_along_axis(stretched_windows, upper_indices, axis=1)
+        stretched_windows = lower_values + (upper_values - lower_values) * fractions
+        stretched_windows[positions > window_size - 1] = 0
+        windows[selected] = stretched_windows
+        return windows
+
+    # Rolls the windows over by a random fraction of their length
+    def shift(self, windows) -> np.array:
+        selected = self.select_windows(windows)
+        shifts = np.round(self.rng.uniform(self.min_shift, self.max_shift, len(windows)) * windows.shape[1]).astype(np.int64)
+        if not selected.any():
+            return windows
+
+        window_size = windows.shape[1]
+        source_indices = (np.arange(window_size)[np.newaxis, :] - shifts[selected][:, np.newaxis]) % window_size
+        windows[selected] = np.take_along_axis(windows[selected], source_indices, axis=1)
+        return windows
@@ -0,0 +1,232 @@
+from config.config import *
+import contextlib
+import getopt
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import wave
+import numpy as np
+from lib.typing import DetectionEvent
+from lib.srt import persist_srt_file
+from lib.load_data import load_pytorch_data, load_sklearn_data
+from lib.machinelearning import feature_engineering_batch, frame_wav_data
+from lib.augmentation import WaveAugmenter
+from lib.combine_models import get_current_default_settings
+
+try:
+    import resource
+except ImportError:
+    # The peak memory use cannot be determined on Windows
+    resource = None
+
+# Measures the throughput of the training pipeline on synthetic recordings, so changes to the pipeline can be compared against each other
+# Every stage is run in a temporary data folder on the CPU, without using the microphone, and the results are printed as JSON
+# Run it from the parrot folder with python -m lib.benchmark, optionally with --epochs, --nets, --recordings, --seconds, --seed and --output
+BENCHMARK_LABELS = ["hiss", "hum", "whistle"]
+
+def run_benchmark(epochs = 3, net_count = 3, recordings_per_label = 4, recording_seconds = 30, seed = 0) -> dict:
+    settings = get_current_default_settings()
+    input_type = settings["FEATURE_ENGINEERING_TYPE"]
+    results = {
+        "settings": {
+            "epochs": epochs,
+            "nets": net_count,
+            "labels": len(BENCHMARK_LABELS),
+            "recordings_per_label": recordings_per_label,
+            "recording_seconds": recording_seconds,
+            "seed": seed,
+            "feature_engineering_type": input_type,
+            "feature_cache_enabled": FEATURE_CACHE_ENABLED,
+            "streaming_dataset": STREAMING_DATASET,
+            "augment_during_training": AUGMENT_DURING_TRAINING,
+            "stacked_ensemble_training": STACKED_ENSEMBLE_TRAINING,
+            "pytorch_available": PYTORCH_AVAILABLE,
+        },
+        "stages": {}
+    }
+    stages = results["stages"]
+
+    # The data folders are all relative paths, so moving into a temporary folder keeps the real recordings and models untouched
+    current_directory = os.getcwd()
+    benchmark_directory = tempfile.mkdtemp(prefix="parrot_benchmark_")
+    try:
+        os.chdir(benchmark_directory)
+        for folder in [DATASET_FOLDER, CLASSIFIER_FOLDER, REPLAYS_FOLDER, FEATURE_CACHE_FOLDER, "data/code"]:
+            os.makedirs(folder, exist_ok=True)
+        user_config = os.path.join(current_directory, "data", "code", "config.py")
+        if os.path.exists(user_config):
+            shutil.copy(user_config, "data/code/config.py")
+
+        start_time = time.perf_counter()
+        window_count = generate_synthetic_recordings(DATASET_FOLDER, BENCHMARK_LABELS, recordings_per_label, recording_seconds, seed)
+        stages["generate_recordings"] = determine_stage_result(start_time, window_count)
+        raw_windows = np.concatenate([load_raw_windows(os.path.join(DATASET_FOLDER, label, "source", "benchmark_" + str(recording_index) + ".wav"))
+            for label in BENCHMARK_LABELS for recording_index in range(recordings_per_label)])
+
+        start_time = time.perf_counter()
+        feature_engineering_batch(raw_windows, RATE, input_type)
+        stages["feature_extraction"] = determine_stage_result(start_time, len(raw_windows))
+
+        start_time = time.perf_counter()
+        WaveAugmenter(seed).augment_batch(raw_windows)
+        stages["augmentation"] = determine_stage_result(start_time, len(raw_windows))
+
+        # The first load fills the feature cache, the load after it shows how fast a training run with unchanged recordings starts
+        if PYTORCH_AVAILABLE:
+            start_time = time.perf_counter()
+            pytorch_data = load_pytorch_data(BENCHMARK_LABELS, input_type)
+            stages["load_pytorch_data"] = determine_stage_result(start_time, count_pytorch_windows(pytorch_data))
+            del pytorch_data
+
+            start_time = time.perf_counter()
+            pytorch_data = load_pytorch_data(BENCHMARK_LABELS, input_type)
+            stages["load_pytorch_data_cached"] = determine_stage_result(start_time, count_pytorch_windows(pytorch_data))
+            stages["training"] = benchmark_training(pytorch_data, net_count, epochs, settings)
+            del pytorch_data
+
+        # The feature cache is emptied first, so the scikit-learn data is also loaded once without and once with a filled cache
+        shutil.rmtree(FEATURE_CACHE_FOLDER, ignore_errors=True)
+        os.makedirs(FEATURE_CACHE_FOLDER, exist_ok=True)
+        start_time = time.perf_counter()
+        sklearn_x, _, _ = load_sklearn_data(BENCHMARK_LABELS, input_type)
+        stages["load_sklearn_data"] = determine_stage_result(start_time, len(sklearn_x))
+        del sklearn_x
+
+        start_time = time.perf_counter()
+        sklearn_x, _, _ = load_sklearn_data(BENCHMARK_LABELS, input_type)
+        stages["load_sklearn_data_cached"] = determine_stage_result(start_time, len(sklearn_x))
+        del sklearn_x
+    finally:
+        os.chdir(current_directory)
+        shutil.rmtree(benchmark_directory, ignore_errors=True)
+
+    results["peak_rss_mb"] = determine_peak_rss_mb()
+    return results
+
+def benchmark_training(pytorch_data, net_count, epochs, settings) -> dict:
+    # Import pytorch related things here to make sure pytorch isn't a hard requirement
+    import torch
+    from lib.audio_dataset import AudioDataset
+    from lib.audio_net import AudioNetTrainer
+
+    AudioNetTrainer.use_cuda = False
+    AudioNetTrainer.device = torch.device("cpu")
+    torch.manual_seed(0)
+
+    start_time = time.perf_counter()
+    dataset = AudioDataset(pytorch_data)
+    trainer = AudioNetTrainer(dataset, net_count, settings)
+    trainer.max_epochs = epochs
+    setup_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    trainer.train("benchmark")
+    result = determine_stage_result(start_time, len(trainer.train_indices[0]) * net_count * epochs)
+    result["setup_seconds"] = round(setup_seconds, 3)
+    result["seconds_per_epoch"] = round(result["seconds"] / epochs, 3)
+    return result
+
+def determine_stage_result(start_time, window_count) -> dict:
+    seconds = time.perf_counter() - start_time
+    return {
+        "seconds": round(seconds, 3),
+        "windows": int(window_count),
+        "windows_per_second": round(window_count / seconds, 1) if seconds > 0 else None,
+        "peak_rss_mb": determine_peak_rss_mb(),
+    }
+
+# Returns the highest memory use of the benchmark so far, including the worker processes that load in the recordings
+def determine_peak_rss_mb():
+    if resource is None:
+        return None
+
+    # The maximum resident set size is given in bytes on macOS and in kilobytes elsewhere
+    unit = 1 if sys.platform == "darwin" else 1024
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak_rss * unit / ( 1024 * 1024 ), 1)
+
+def count_pytorch_windows(pytorch_data) -> int:
+    window_count = 0
+    for samples in list(pytorch_data["data"].values()) + list(pytorch_data["augmented"].values()):
+        # Streamed datasets contain the rows to read from every feature cache shard instead of the samples themselves
+        window_count += sum(len(rows) for _, rows in samples) if pytorch_data["streaming"] else len(samples)
+    return window_count
+
+def load_raw_windows(filename) -> np.array:
+    with wave.open(filename, 'rb') as wav_file:
+        samples = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype=np.int16)
+    window_size = round(RATE * RECORD_SECONDS)
+    return np.array(frame_wav_data(samples, window_size, round(window_size / SLIDING_WINDOW_AMOUNT)))
+
+# Writes recordings of every label with their segmentation, and returns the amount of windows inside of them
+def generate_synthetic_recordings(dataset_folder, labels, recordings_per_label, recording_seconds, seed) -> int:
+    rng = np.random.default_rng(seed)
+    window_count = 0
+    for label_index, label in enumerate(labels):
+        source_folder = os.path.join(dataset_folder, label, "source")
+        segments_folder = os.path.join(dataset_folder, label, "segments")
+        os.makedirs(source_folder, exist_ok=True)
+        os.makedirs(segments_folder, exist_ok=True)
+
+        for recording_index in range(recordings_per_label):
+            samples, events = generate_synthetic_recording(rng, label, label_index, recording_seconds)
+            filename = "benchmark_" + str(recording_index)
+            with wave.open(os.path.join(source_folder, filename + ".wav"), 'wb') as wav_file:
+                wav_file.setnchannels(1)
+                wav_file.setsampwidth(2)
+                wav_file.setframerate(RATE)
+                wav_file.writeframes(samples.tobytes())
+            persist_srt_file(os.path.join(segments_folder, filename), events)
+            window_count += len(samples) // round(RATE * RECORD_SECONDS / SLIDING_WINDOW_AMOUNT)
+    return window_count
+
+# Generates a recording with quiet noise, in which the label is repeatedly made with pauses in between
+# Every label gets its own pitch and amount of noise, so the labels can be told apart
+def generate_synthetic_recording(rng, label, label_index, recording_seconds) -> tuple:
+    ms_per_frame = math.floor(RECORD_SECONDS / SLIDING_WINDOW_AMOUNT * 1000)
+    samples = rng.normal(0, 60, round(recording_seconds * RATE))
+    events = []
+    start_ms = int(rng.integers(200, 800))
+    while True:
+        end_ms = start_ms + int(rng.integers(300, 1200))
+        if end_ms >= recording_seconds * 1000:
+            break
+
+        start = start_ms * RATE // 1000
+        end = end_ms * RATE // 1000
+        times = np.arange(end - start) / RATE
+        frequency = 220 * ( label_index + 1 ) * rng.uniform(0.95, 1.05)
+        envelope = np.minimum(1, np.minimum(times, times[-1] - times) * 50)
+        sound = np.sin(2 * np.pi * frequency * times) + 0.5 * np.sin(4 * np.pi * frequency * times) + rng.normal(0, 0.2 * label_index, len(times))
+        samples[start:end] += envelope * sound * rng.uniform(2000, 8000)
+
+        events.append(DetectionEvent(label, start_ms // ms_per_frame, end_ms // ms_per_frame, start_ms, end_ms, 0, [], []))
+        start_ms = end_ms + int(rng.integers(200, 800))
+    return np.clip(samples, -32768, 32767).astype(np.int16), events
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "", ["epochs=", "nets=", "recordings=", "seconds=", "seed=", "output="])
+    options = {"epochs": 3, "nets": 3, "recordings": 4, "seconds": 30, "seed": 0}
+    output_filename = None
+    for opt, arg in opts:
+        if opt == "--output":
+            output_filename = arg
+        else:
+            options[opt[2:]] = int(arg)
+
+    # Everything printed during the stages is sent to stderr, so only the results are printed to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmark(options["epochs"], options["nets"], options["recordings"], options["seconds"], options["seed"])
+
+    if output_filename is not None:
+        with open(output_filename, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+    print(json.dumps(results, indent=4))
+
+# The guard is required for the worker processes that load in the training data
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,88 @@
+import os
+import threading
+import torch
+from config.config import CLASSIFIER_FOLDER
+from lib.combine_models import connect_model
+
+# Writes the checkpoints and combined models of a training run on a background thread
+# So the training loop only has to copy the weights, rather than wait for the disk
+# Only the newest pending write for every file is kept, older ones that have not been written yet are dropped
+class CheckpointWriter:
+
+    def __init__(self):
+        self.pending_writes = {}
+        self.last_combined_model = None
+        self.condition = threading.Condition()
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def save_checkpoint(self, checkpoint, checkpoint_filename):
+        self.schedule(checkpoint_filename, self.write_checkpoint, checkpoint)
+
+    # The classifier map contains the checkpoints in memory rather than the filenames of the persisted weights
+    def save_combined_model(self, clf_filename, classifier_map, settings):
+        self.last_combined_model = (clf_filename, classifier_map, settings)
+        self.schedule(os.path.join(CLASSIFIER_FOLDER, clf_filename), self.write_combined_model, (clf_filename, classifier_map, settings))
+
+    def schedule(self, key, write_function, arguments):
+        with self.condition:
+            self.raise_error()
+            # Re-insert the key so the writes are done in the order they were last requested
+            self.pending_writes.pop(key, None)
+            self.pending_writes[key] = (write_function, arguments)
+            self.condition.notify()
+
+    def write_checkpoint(self, checkpoint_filename, checkpoint):
+        temporary_filename = checkpoint_filename + ".tmp"
+        torch.save(checkpoint, temporary_filename)
+        os.replace(temporary_filename, checkpoint_filename)
+
+    def write_combined_model(self, key, arguments):
+        clf_filename, classifier_map, settings = arguments
+        connect_model( clf_filename, classifier_map, "ensemble_torch", True, settings )
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending_writes and not self.closed:
+                    self.condition.wait()
+                if not self.pending_writes:
+                    return
+                key = next(iter(self.pending_writes))
+                write_function, arguments = self.pending_writes.pop(key)
+
+            try:
+                write_function(key, arguments)
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.pending_writes = {}
+                    return
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    # Waits until all the pending writes are on disk, after which the last combined model is written once more
+    # Together with its TorchScript export, which is skipped for the models written during training
+    # Only called once training has succeeded, so a failing export never hides an error raised during training
+    def finish(self):
+        self.close()
+        self.raise_error()
+
+        if self.last_combined_model is not None:
+            clf_filename, classifier_map, settings = self.last_combined_model
+            connect_model( clf_filename, classifier_map, "ensemble_torch", True, settings, export_torchscript=True )
+
+    # Stops the background thread once the pending writes are done, without raising any of the errors of the writes
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+# Copies the weights of a net to the CPU, so they are no longer changed by the training loop
+def snapshot_state_dict(net):
+    return {key: value.detach().to('cpu', copy=True) for key, value in net.state_dict().items()}
@@ -55,8 +55,13 @@ def combine_models():
             classifier_map = configure_single_layer_model( available_state_dicts, True )
         else:
             classifier_map = configure_single_layer_model( available_models, False )
+        
+        quantize = False
+        if( model_type == "ensemble_torch" ):
+            print( "Quantize the Audio Nets to int8? This can make predictions faster at a small cost in accuracy. Y/N ( Empty is no )" )
+            quantize = input("").strip().lower() == "y"
                 
-        connect_model( clf_filename, classifier_map, model_type )
+        connect_model( clf_filename, classifier_map, model_type, quantize=quantize )
     
 def configure_base_model( available_models, text=None, with_filename=False ):
     if( text == None ):
@@ -138,11 +143,11 @@ def update_model( available_models ):
         print( "Current version: v0" )
         settings = define_settings( get_current_default_settings() )
         main_classifier = AudioModel(settings, main_classifier)
-        joblib.dump( main_classifier, classifier_filename )
+        persist_audio_model( main_classifier, classifier_filename )
     else:
         print( "Current version: v" + str(main_classifier.settings['version']) )    
         main_classifier.settings = define_settings( main_classifier.settings )
-        joblib.dump( main_classifier, classifier_filename )
+        persist_audio_model( main_classifier, classifier_filename )
 
 def define_settings(settings):
     print( "Use the current audio settings for this model? Y/N ( Empty is yes )" )
@@ -197,7 +202,7 @@ def print_available_models( available_models ):
     for modelindex, available_model in enumerate(available_models):
         print( " - [" + str( modelindex + 1 ) + "] " + available_model )
 
-def connect_model( clf_filename, classifier_map, model_type, during_training = False, settings = None ):
+def connect_model( clf_filename, classifier_map, model_type, during_training = False, settings = None, quantize = False, export_torchscript = None ):
     if( model_type == "hierarchial" ):
         classifier = HierarchialClassifier( classifier_map )
     elif( model_type == "ensemble" ):
@@ -208,9 +213,23 @@ def connect_model( clf_filename, classifier_map, model_type, during_training = F
 
     if (settings == None):
         settings = define_settings( get_current_default_settings() )
+        
+    # The accuracy and speed of the quantized Audio Nets are shown before deciding to save them
+    if( quantize and model_type == "ensemble_torch" ):
+        from lib.quantization import quantize_torch_ensemble
+        classifier = quantize_torch_ensemble( classifier, classifier_map, settings )
     classifier = AudioModel( settings, classifier )
     classifier_filename = CLASSIFIER_FOLDER + "/" + clf_filename
-    joblib.dump( classifier, classifier_filename )
+    
+    # The Pytorch ensemble is also exported to TorchScript, which is used when the model is loaded in during play
+    # During training this is only done for the final model, rather than for every new best model
+    if( export_torchscript is None ):
+        export_torchscript = not during_training
+    if( model_type == "ensemble_torch" and export_torchscript ):
+        classifier.get_classifier().export_torchscript( os.path.splitext( classifier_filename )[0] + ".pt" )
+
+    # Written to a temporary file first so a model that is being used is never replaced by a half written one
+    persist_audio_model( classifier, classifier_filename )
     
     if (during_training == False):
         print( "-------------------------" )
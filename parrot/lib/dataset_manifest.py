@@ -0,0 +1,78 @@
+from config.config import DATASET_MANIFEST_FILE
+import json
+import os
+
+# Keeps the statistics of the recordings and their segmentations on disk, such as the frames counted for every label
+# Every entry stores the size and modification time of the files its statistics were calculated from
+# So after a change, only the statistics of the changed files are calculated again
+MANIFEST_VERSION = 1
+_manifest = None
+_manifest_changed = False
+
+def load_manifest() -> dict:
+    global _manifest
+    if _manifest is None:
+        _manifest = {"version": MANIFEST_VERSION, "files": {}}
+        if os.path.exists(DATASET_MANIFEST_FILE):
+            try:
+                with open(DATASET_MANIFEST_FILE, 'r') as f:
+                    manifest = json.load(f)
+                if manifest.get("version") == MANIFEST_VERSION:
+                    _manifest = manifest
+            except (ValueError, OSError):
+                # A broken manifest is simply rebuilt
+                pass
+    return _manifest
+
+def determine_file_signature(filenames) -> list:
+    signature = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        signature.append([stat.st_size, stat.st_mtime_ns])
+    return signature
+
+# Returns a statistic calculated from one or more files, only calling calculate_statistic if the files have changed
+# The statistic needs to be storable as JSON
+def get_file_statistic(filenames, statistic_key: str, calculate_statistic):
+    global _manifest_changed
+    if isinstance(filenames, str):
+        filenames = [filenames]
+
+    entry_key = "|".join([os.path.abspath(filename) for filename in filenames])
+    signature = determine_file_signature(filenames)
+    files = load_manifest()["files"]
+    if entry_key not in files or files[entry_key]["signature"] != signature:
+        files[entry_key] = {"signature": signature, "statistics": {}}
+        _manifest_changed = True
+
+    statistics = files[entry_key]["statistics"]
+    if statistic_key not in statistics:
+        statistics[statistic_key] = calculate_statistic()
+        _manifest_changed = True
+    return statistics[statistic_key]
+
+def save_manifest():
+    global _manifest_changed
+    if not _manifest_changed:
+        return
+
+    manifest_directory = os.path.dirname(DATASET_MANIFEST_FILE)
+    if manifest_directory and not os.path.exists(manifest_directory):
+        os.makedirs(manifest_directory)
+
+    # Write to a temporary file first so an interrupted write never leaves a broken manifest behind
+    temporary_filename = DATASET_MANIFEST_FILE + ".tmp"
+    with open(temporary_filename, 'w') as f:
+        json.dump(load_manifest(), f)
+    os.replace(temporary_filename, DATASET_MANIFEST_FILE)
+    _manifest_changed = False
+
+# Removes the entries of files that no longer exist, for instance the segmentations of an older version
+def prune_manifest():
+    global _manifest_changed
+    files = load_manifest()["files"]
+    for entry_key in list(files.keys()):
+        if not all(os.path.exists(filename) for filename in entry_key.split("|")):
+            del files[entry_key]
+            _manifest_changed = True
+    save_manifest()
@@ -12,7 +12,11 @@ import pyautogui
 
 pyautogui.FAILSAFE = False
 
-default_audio = pyaudio.PyAudio().get_default_input_device_info()
+# Machines without a microphone, like the ones running the training benchmark, have no default input device
+try:
+    default_audio = pyaudio.PyAudio().get_default_input_device_info()
+except OSError:
+    default_audio = None
 REPEAT_DELAY = 0.5
 REPEAT_RATE = 33
 SPEECHREC_ENABLED = False
@@ -48,6 +52,8 @@ CLASSIFIER_FOLDER = "data/models"
 OVERLAY_FOLDER = "data/overlays"
 COORDINATE_FILEPATH = "config/current-coordinate.txt"
 CONVERSION_OUTPUT_FOLDER = "data/output"
+FEATURE_CACHE_FOLDER = "data/cache"
+DATASET_MANIFEST_FILE = "data/dataset_manifest.json"
 PATH_TO_FFMPEG = "ffmpeg/bin/ffmpeg"
 
 DEFAULT_CLF_FILE = ""
@@ -56,6 +62,7 @@ MICROPHONE_SEPARATOR = None
 
 SAVE_REPLAY_DURING_PLAY = True
 SAVE_FILES_DURING_PLAY = False
+NUMPY_INFERENCE = True # Predict with a numpy version of Audio Nets, Multi Layer Perceptrons and Random Forests during play, so Pytorch does not need to be loaded in
 EYETRACKING_TOGGLE = "f4"
 OVERLAY_ENABLED = False
 
@@ -70,8 +77,22 @@ if( SPEECHREC_ENABLED == True ):
 BACKGROUND_LABEL = "silence"
 AUTOMATIC_DATASET_BALANCING = True
 SHOULD_FIT_INSIDE_RAM = True # Ensure the dataset fits inside RAM for faster training
+WEIGHTED_SAMPLING = False # Draw the samples of rarer sounds more often while training the Audio Nets, instead of loading in extra samples of them
 # Turning this to FALSE might crash the dataloading
 MAX_RAM = 7000000000 # 7GB of usable RAM is assumed to be the maximum size to be loaded in for data
+FEATURE_CACHE_ENABLED = True # Keep the features of every recording on disk so they do not need to be recalculated for every training run
+FEATURE_CACHE_DTYPE = "float32" # Use float16 to halve the size of the cache on disk
+FEATURE_CACHE_AUGMENTED = False # Also keep the augmented features in the feature cache, which makes every training run reuse the same augmentations
+STACKED_ENSEMBLE_TRAINING = False # Train all the nets of an Audio Net ensemble in a single batched pass, which is faster on most hardware
+DATA_LOADING_WORKERS = 0 # Amount of processes used to load in the recordings during training, 0 uses all the available CPU cores
+CROSS_VALIDATION_JOBS = 2 # Amount of cross validation folds fitted at the same time while training a Random Forest, every fold holds a copy of two thirds of the dataset, 0 uses all the available CPU cores
+CHECKPOINT_EVERY_EPOCHS = 10 # Besides every improvement, also persist the latest weights of the Audio Nets every this many epochs, 0 only persists improvements
+STREAMING_DATASET = False # Read the samples from the feature cache on disk while training the Audio Nets, so the whole dataset can be used without fitting inside RAM
+STREAMING_SHUFFLE_BUFFER = 32768 # Amount of samples kept in memory to shuffle the streamed samples with
+STREAMING_WORKERS = 2 # Amount of processes reading the streamed samples ahead of training
+SKLEARN_INCREMENTAL_EPOCHS = 30 # Amount of passes over the streamed samples when training a Multi Layer Perceptron
+AUGMENT_DURING_TRAINING = False # Augment the audio of the samples while training the Audio Nets, so every epoch sees different augmentations instead of a single augmented copy
+AUGMENT_GAIN = False # Also change the volume of the augmented samples by up to 6dB, which the original noise, speed and shift augmentations did not do
 
 # Detection strategies
 CURRENT_VERSION = 3
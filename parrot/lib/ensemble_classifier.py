@@ -26,33 +26,45 @@ class EnsembleClassifier:
 				for label in self.classifiers[ classifier_label ].classes_:
 					if( label not in self.classifiers ):
 						self.classes_.append( label )
+		self.determine_label_indices()
+
+	# Classifiers saved before the label indices were added determine them when they are loaded in
+	def __setstate__( self, state ):
+		self.__dict__.update( state )
+		if( 'label_indices' not in state ):
+			self.determine_label_indices()
+
+	# Determines which probabilities of every classifier are added to which of the combined probabilities
+	# Classifiers with the same labels in the same order are added as a whole, labels that are not in the combined classes are left out
+	def determine_label_indices( self ):
+		self.label_indices = {}
+		for index in self.classifiers.keys():
+			classifier_labels = list( self.classifiers[ index ].classes_ )
+			if( classifier_labels == self.classes_ ):
+				self.label_indices[ index ] = None
+			else:
+				shared_labels = [ label for label in classifier_labels if label in self.classes_ ]
+				self.label_indices[ index ] = ( np.array( [ classifier_labels.index( label ) for label in shared_labels ], dtype=np.intp ),
+					np.array( [ self.classes_.index( label ) for label in shared_labels ], dtype=np.intp ) )
 							
 	# Predict the probabilities of the given data array
+	# Every classifier predicts all the rows at once, after which their probabilities are averaged
 	def predict_proba( self, data ):
-		predictions = []
-		for data_row in data:
-			predictions.append( self.predict_single_proba(data_row) )
-				
-		return np.asarray( predictions )
-			
-	# Predict a single data row
-	# This will ask all the classifiers for a prediction
-	# The one with the highest prediction wins
-	def predict_single_proba( self, data_row ):
-		totalProbabilities = []
-		
-		type = None
+		data = np.asarray( data )
+		totalProbabilities = np.zeros( ( len( data ), len( self.classes_ ) ), dtype=np.float64 )
 		for index in self.classifiers.keys():
-			probabilities = self.classifiers[ index ].predict_proba( [data_row] )[0]
-			
-			if( len( totalProbabilities ) == 0 ):
-				totalProbabilities = probabilities
+			probabilities = self.classifiers[ index ].predict_proba( data )
+			label_indices = self.label_indices[ index ]
+			if( label_indices is None ):
+				totalProbabilities += probabilities
 			else:
-				for probindex, probability in enumerate( probabilities ):
-					totalProbabilities[ probindex ] = totalProbabilities[ probindex ] + probability
+				totalProbabilities[ :, label_indices[1] ] += probabilities[ :, label_indices[0] ]
 
 		# Normalize the model
-		for probindex, probability in enumerate( totalProbabilities ):
-			totalProbabilities[ probindex ] = totalProbabilities[ probindex ] * ( 1 / len( self.classifiers.keys() ) )
-												
-		return np.asarray( totalProbabilities, dtype=np.float64 )
\ No newline at end of file
+		totalProbabilities *= ( 1 / len( self.classifiers.keys() ) )
+		return totalProbabilities
+			
+	# Predict a single data row
+	# The row is given to the classifiers as a view with a single row, rather than a list
+	def predict_single_proba( self, data_row ):
+		return self.predict_proba( np.asarray( data_row )[ np.newaxis ] )[0]
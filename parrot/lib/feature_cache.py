@@ -0,0 +1,155 @@
+from config.config import FEATURE_CACHE_FOLDER, FEATURE_CACHE_DTYPE, RATE, RECORD_SECONDS, SLIDING_WINDOW_AMOUNT, CURRENT_VERSION
+from lib.dataset_manifest import get_file_statistic
+import numpy as np
+import hashlib
+import json
+import os
+
+# Content addressed store for the features extracted from the recordings
+# Every source file gets its own folder, keyed by the hash of the WAV data
+# Inside of it, every combination of audio settings, feature type and sampling variant is stored as a memory mapped .npy shard
+# The SRT file contents are part of the shard name, so a resegmented recording automatically invalidates its old shards
+_cache_statistics = {"hits": 0, "misses": 0}
+
+# The hashes are kept in the dataset manifest, so a file is only hashed again once its size or modification time has changed
+def hash_file(filename: str) -> str:
+    def calculate_hash():
+        file_hash = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+    return get_file_statistic(filename, "sha1", calculate_hash)
+
+def determine_shard_keys(source_file: str, srt_file: str, feature_engineering_type: int, variant: str, with_offset: bool):
+    settings = {
+        "RATE": RATE,
+        "RECORD_SECONDS": RECORD_SECONDS,
+        "SLIDING_WINDOW_AMOUNT": SLIDING_WINDOW_AMOUNT,
+        "FEATURE_ENGINEERING_TYPE": feature_engineering_type,
+        "variant": variant,
+        "with_offset": with_offset,
+        "dtype": FEATURE_CACHE_DTYPE,
+    }
+    settings_key = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    # The SRT files of a recording share the same recording key, whichever version of the segmentation they hold
+    # Manual segmentations and versioned segmentations are cached separately
+    recording_key = hashlib.sha1(os.path.abspath(srt_file).rsplit(".", 2)[0].encode('utf-8')).hexdigest()[:8]
+    srt_type = "MANUAL" if srt_file.endswith(".MANUAL.srt") else "v" + str(CURRENT_VERSION)
+    srt_key = recording_key + "_" + srt_type + "_" + hash_file(srt_file)[:16]
+    return hash_file(source_file), settings_key, srt_key
+
+def get_shard_filename(source_file: str, srt_file: str, feature_engineering_type: int, variant: str, with_offset: bool) -> str:
+    source_key, settings_key, srt_key = determine_shard_keys(source_file, srt_file, feature_engineering_type, variant, with_offset)
+    return os.path.join(FEATURE_CACHE_FOLDER, source_key, settings_key + "_" + srt_key + ".npy")
+
+def load_cached_features(source_file: str, srt_file: str, feature_engineering_type: int, variant: str, with_offset: bool) -> np.array:
+    global _cache_statistics
+    shard_filename = get_shard_filename(source_file, srt_file, feature_engineering_type, variant, with_offset)
+    if os.path.exists(shard_filename):
+        try:
+            features = np.load(shard_filename, mmap_mode='r')
+            _cache_statistics["hits"] += 1
+            return features
+        except (ValueError, OSError):
+            # Corrupt shards are treated as a miss and will be overwritten
+            pass
+
+    _cache_statistics["misses"] += 1
+    return None
+
+def persist_cached_features(source_file: str, srt_file: str, feature_engineering_type: int, variant: str, with_offset: bool, features) -> np.array:
+    shard_filename = get_shard_filename(source_file, srt_file, feature_engineering_type, variant, with_offset)
+    shard_directory = os.path.dirname(shard_filename)
+    if not os.path.exists(shard_directory):
+        os.makedirs(shard_directory)
+
+    features = np.asarray(features, dtype=FEATURE_CACHE_DTYPE)
+    if features.ndim != 2:
+        features = features.reshape(len(features), -1 if len(features) > 0 else 0)
+
+    # Write to a temporary file first so an interrupted training run never leaves a broken shard behind
+    temporary_filename = shard_filename + ".tmp"
+    with open(temporary_filename, 'wb') as f:
+        np.save(f, features)
+    os.replace(temporary_filename, shard_filename)
+
+    # Remove the shards created for older segmentations of the same recording
+    # The same audio can be segmented by multiple SRT files in different folders, so only the shards of this SRT file are removed
+    # Shards that are still memory mapped cannot be removed on Windows, they are removed the next time instead
+    recording_prefix = "_".join(os.path.basename(shard_filename).split("_")[:2]) + "_"
+    for existing_file in os.listdir(shard_directory):
+        if existing_file.startswith(recording_prefix) and existing_file != os.path.basename(shard_filename):
+            try:
+                os.remove(os.path.join(shard_directory, existing_file))
+            except OSError:
+                pass
+
+    return np.load(shard_filename, mmap_mode='r')
+
+def get_resampled_filename(source_file: str, sample_rate: int) -> str:
+    return os.path.join(FEATURE_CACHE_FOLDER, hash_file(source_file), "resampled_" + str(sample_rate) + ".npy")
+
+def persist_resampled_audio(resampled_filename: str, samples) -> np.array:
+    resampled_directory = os.path.dirname(resampled_filename)
+    if not os.path.exists(resampled_directory):
+        os.makedirs(resampled_directory)
+
+    temporary_filename = resampled_filename + ".tmp"
+    with open(temporary_filename, 'wb') as f:
+        np.save(f, samples)
+    os.replace(temporary_filename, resampled_filename)
+    return np.load(resampled_filename, mmap_mode='r')
+
+def get_cache_statistics():
+    return dict(_cache_statistics)
+
+def print_cache_statistics(statistics = None):
+    if statistics is None:
+        statistics = _cache_statistics
+    total = statistics["hits"] + statistics["misses"]
+    if total > 0:
+        print( "Feature cache: " + str(statistics["hits"]) + " hits, " + str(statistics["misses"]) + " misses ( " + str(round(statistics["hits"] / total * 100)) + "% reused )" )
+
+# Reads samples from the memory mapped feature cache shards, using a list of shards with the rows to use from every shard
+# Indexing with an array of sample indices returns a float32 matrix, the same as indexing a matrix that holds all the samples
+class ShardedSamples:
+
+    def __init__(self, shards):
+        shards = [(shard_filename, np.asarray(rows, dtype=np.int64)) for shard_filename, rows in shards if len(rows) > 0]
+        self.shard_filenames = [shard_filename for shard_filename, _ in shards]
+        self.sample_shards = np.concatenate([np.full(len(rows), shard_index, dtype=np.int32) for shard_index, (_, rows) in enumerate(shards)] + [np.zeros(0, dtype=np.int32)])
+        self.sample_rows = np.concatenate([rows for _, rows in shards] + [np.zeros(0, dtype=np.int64)])
+        self.shards = {}
+        self.sample_size = self.open_shard(0).shape[1] if len(shards) > 0 else 0
+
+    # The shards are opened again in every process, rather than copying their memory maps over to data loader workers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def open_shard(self, shard_index):
+        if shard_index not in self.shards:
+            self.shards[shard_index] = np.load(self.shard_filenames[shard_index], mmap_mode='r')
+        return self.shards[shard_index]
+
+    def __len__(self):
+        return len(self.sample_rows)
+
+    # Sorts the sample indices on their shards and rows, which tells the order in which they are read from disk the fastest
+    def sort_indices(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        return indices[np.lexsort((self.sample_rows[indices], self.sample_shards[indices]))]
+
+    def __getitem__(self, indices):
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        samples = np.empty((len(indices), self.sample_size), dtype=np.float32)
+        sample_shards = self.sample_shards[indices]
+        for shard_index in np.unique(sample_shards):
+            positions = np.flatnonzero(sample_shards == shard_index)
+            rows = self.sample_rows[indices[positions]]
+            order = np.argsort(rows, kind='stable')
+            samples[positions[order]] = self.open_shard(shard_index)[rows[order]]
+        return samples
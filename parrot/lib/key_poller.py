@@ -11,7 +11,9 @@ else:
 # Courtesy from pokeyrule (https://github.com/pokey)
 class KeyPoller():
     def __enter__(self):
-        if (IS_WINDOWS == False):
+        # Without a terminal, for instance when the training benchmark runs as a background job, no keys can be polled
+        self.interactive = IS_WINDOWS or sys.stdin.isatty()
+        if (IS_WINDOWS == False and self.interactive):
             # Save the terminal settings
             self.fd = sys.stdin.fileno()
             self.new_term = termios.tcgetattr(self.fd)
@@ -24,7 +26,7 @@ class KeyPoller():
         return self
 
     def __exit__(self, type, value, traceback):
-        if(IS_WINDOWS == False ):
+        if(IS_WINDOWS == False and self.interactive):
             termios.tcsetattr(self.fd, termios.TCSAFLUSH, self.old_term)
 
     def poll(self):
@@ -34,7 +36,7 @@ class KeyPoller():
                 if ch == b'\xe0' or ch == b'\000':
                     ch = msvcrt.getch()
                 return ch.decode()
-        else:
+        elif self.interactive:
             dr,dw,de = select.select([sys.stdin], [], [], 0)
             if not dr == []:
                 return sys.stdin.read(1)
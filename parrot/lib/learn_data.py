@@ -8,8 +8,10 @@ import joblib
 from lib.machinelearning import *
 from sklearn.neural_network import *
 from lib.combine_models import define_settings, get_current_default_settings
-from lib.audio_model import AudioModel
-from lib.load_data import load_sklearn_data, load_pytorch_data
+from lib.audio_model import AudioModel, persist_audio_model
+from lib.load_data import load_sklearn_data, load_sklearn_shards, load_pytorch_data
+from lib.wav import augmented_feature_engineering_batch
+import numpy as np
 
 def learn_data():
     dir_path = os.path.join( os.path.dirname( os.path.dirname( os.path.realpath(__file__)) ), DATASET_FOLDER)    
@@ -89,28 +91,103 @@ def learn_data():
 def fit_sklearn_classifier( classifier,  dir_path, clf_filename, settings ):    
     print( "--------------------------" )
     filtered_data_directory_names = determine_labels( dir_path )
+    
+    # Classifiers that can learn incrementally are trained on the feature cache shards when streaming, instead of a single matrix in memory
+    if ( STREAMING_DATASET and hasattr( classifier, "partial_fit" ) ):
+        fit_streaming_sklearn_classifier( classifier, filtered_data_directory_names, clf_filename, settings )
+        return
+    
     dataX, dataY, directory_names = load_sklearn_data( filtered_data_directory_names, settings['FEATURE_ENGINEERING_TYPE'] )
     print( "--------------------------" )
 
     print( "Learning the data..." )
-    classifier.fit( dataX, dataY )
-    print( "Data analyzed!               " )
-
-    persisted_classifier = AudioModel( settings, classifier )
-    
-    print( "Saving the model to " + CLASSIFIER_FOLDER + "/" + clf_filename )
-    joblib.dump( persisted_classifier, CLASSIFIER_FOLDER + "/" + clf_filename )
-    print( "--------------------------" )
     
+    # The model is saved as soon as it is fitted, so it is kept even if the cross validation does not finish
     if ( not isinstance(classifier, MLPClassifier ) ):
-        print( "Predicting recognition accuracy using cross validation...", end="\r" )
-        scores = cross_validation( classifier, dataX, dataY )
+        print( "Predicting recognition accuracy using cross validation at the same time..." )
+        classifier, scores = fit_and_cross_validate( classifier, dataX, dataY, 
+            persist_classifier=lambda fitted_classifier: persist_sklearn_classifier( fitted_classifier, clf_filename, settings ) )
+        print( "Data analyzed!               " )
         print( "Accuracy: %0.4f (+/- %0.4f)                               " % (scores.mean(), scores.std() * 2))
+    else:
+        classifier.fit( dataX, dataY )
+        print( "Data analyzed!               " )
+        persist_sklearn_classifier( classifier, clf_filename, settings )
     
     detailed_analysis = input("Should we do a detailed analysis of the model? Y/n" ).lower() == 'y'
     if( detailed_analysis ):
         create_confusion_matrix( classifier, dataX, dataY, directory_names )
         print( "--------------------------" )
+
+def fit_streaming_sklearn_classifier( classifier, filtered_data_directory_names, clf_filename, settings ):
+    sharded_dataset, directory_names = load_sklearn_shards( filtered_data_directory_names, settings['FEATURE_ENGINEERING_TYPE'] )
+    print( "--------------------------" )
+    
+    print( "Learning the data..." )
+    fit_incremental_classifier( classifier, sharded_dataset, settings['FEATURE_ENGINEERING_TYPE'] )
+    print( "Data analyzed!               " )
+    
+    persist_sklearn_classifier( classifier, clf_filename, settings )
+    
+    detailed_analysis = input("Should we do a detailed analysis of the model? Y/n" ).lower() == 'y'
+    if( detailed_analysis ):
+        # Only a random part of the samples is loaded in for the analysis, so it still fits inside RAM
+        samples = sharded_dataset["samples"]
+        indices = samples.sort_indices( np.random.choice( len( samples ), min( len( samples ), STREAMING_SHUFFLE_BUFFER * 4 ), replace=False ) )
+        create_confusion_matrix( classifier, samples[indices], sharded_dataset["labels"][indices], directory_names )
+        print( "--------------------------" )
+
+# Trains the classifier with partial_fit on buffers of samples, read from the feature cache shards in blocks of neighbouring rows
+# The blocks of the samples and the augmented samples are shuffled every epoch, and mixed together in buffers of STREAMING_SHUFFLE_BUFFER samples
+def fit_incremental_classifier( classifier, sharded_dataset, input_type, epochs = SKLEARN_INCREMENTAL_EPOCHS ):
+    sources = [(sharded_dataset["samples"], sharded_dataset["labels"], False), 
+        (sharded_dataset["augmented"], sharded_dataset["augmented_labels"], sharded_dataset["augmented_audio"])]
+    classes = np.unique( np.concatenate( [labels for _, labels, _ in sources] ) )
+    
+    # Early stopping needs a validation set of the whole dataset, which partial_fit does not support
+    if ( classifier.get_params().get( "early_stopping", False ) ):
+        classifier.set_params( early_stopping=False )
+    
+    block_size = max( 1, STREAMING_SHUFFLE_BUFFER // 8 )
+    blocks = []
+    for source_index, (samples, labels, is_audio) in enumerate( sources ):
+        indices = samples.sort_indices( np.arange( len( samples ) ) )
+        blocks.extend( [(source_index, indices[start:start + block_size]) for start in range( 0, len( indices ), block_size )] )
+    
+    for epoch in range( epochs ):
+        print( "Epoch " + str( epoch + 1 ) + " of " + str( epochs ) )
+        buffer_x = []
+        buffer_y = []
+        buffered = 0
+        for block_index in np.random.permutation( len( blocks ) ):
+            source_index, block = blocks[block_index]
+            samples, labels, is_audio = sources[source_index]
+            block_x = samples[block]
+            if ( is_audio ):
+                block_x = augmented_feature_engineering_batch( block_x, input_type )
+            buffer_x.append( block_x )
+            buffer_y.append( labels[block] )
+            buffered += len( block )
+            
+            if ( buffered >= STREAMING_SHUFFLE_BUFFER ):
+                partial_fit_buffer( classifier, buffer_x, buffer_y, classes )
+                buffer_x = []
+                buffer_y = []
+                buffered = 0
+        
+        if ( buffered > 0 ):
+            partial_fit_buffer( classifier, buffer_x, buffer_y, classes )
+
+# The classifier shuffles the samples inside of every buffer itself
+def partial_fit_buffer( classifier, buffer_x, buffer_y, classes ):
+    classifier.partial_fit( np.concatenate( buffer_x ), np.concatenate( buffer_y ), classes=classes )
+
+def persist_sklearn_classifier( classifier, clf_filename, settings ):
+    persisted_classifier = AudioModel( settings, classifier )
+    
+    print( "Saving the model to " + CLASSIFIER_FOLDER + "/" + clf_filename )
+    persist_audio_model( persisted_classifier, CLASSIFIER_FOLDER + "/" + clf_filename )
+    print( "--------------------------" )
     
 def determine_labels( dir_path ):
     data_directory_names =  [directory for directory in os.listdir( dir_path ) if not directory.startswith(".")]
@@ -1,7 +1,8 @@
 import numpy as np
 import sounddevice as sd
 from config.config import *
-from lib.machinelearning import feature_engineering, feature_engineering_raw, get_label_for_directory, get_highest_intensity_of_wav_file, get_recording_power
+from lib.machinelearning import feature_engineering, feature_engineering_raw, feature_engineering_frame, get_label_for_directory, get_highest_intensity_of_wav_file, get_recording_power
+from lib.signal_processing import FrameAnalysis
 import wave
 import time
 import scipy
@@ -37,17 +38,17 @@ def classify_audioframes( audioQueue, audio_frames, classifier, high_speed ):
         
         if( len( audio_frames ) >= 2 ):
             audio_frames = audio_frames[-2:]
-                        
-            highestintensity = np.amax( audioop.maxpp( audio_frames[1], 4 ) / 32767 )
-            wavData = b''.join(audio_frames)
+            
+            # All the metrics of this frame are derived from a single analysis
+            frame_analysis = FrameAnalysis( audio_frames, classifier.get_setting('RATE', RATE), classifier.get_setting('RECORD_SECONDS', RECORD_SECONDS), classifier.get_setting('CHANNELS', CHANNELS) )
+            highestintensity = frame_analysis.intensity
+            wavData = frame_analysis.byte_data
                 
             # SKIP FEATURE ENGINEERING COMPLETELY WHEN DEALING WITH SILENCE
             if( high_speed == True and highestintensity < SILENCE_INTENSITY_THRESHOLD ):
                 probabilityDict, predicted, frequency = create_empty_probability_dict( classifier, {}, 0, highestintensity, 0 )
             else:
-                fftData = np.frombuffer( wavData, dtype=np.int16 )
-                power = get_recording_power( fftData, classifier.get_setting('RECORD_SECONDS', RECORD_SECONDS) )            
-                probabilityDict, predicted, frequency = predict_raw_data( wavData, classifier, highestintensity, power )
+                probabilityDict, predicted, frequency = predict_frame_analysis( frame_analysis, classifier )
             
             return probabilityDict, predicted, audio_frames, highestintensity, frequency, wavData
             
@@ -292,12 +293,20 @@ def predict_raw_data( wavData, classifier, intensity, power ):
     if( classifier.get_setting('CHANNELS', CHANNELS) == 2 ):
         first_channel_data = first_channel_data[::2]
         
+    # The listen loop slides over the audio stream, so only the newest part of the window has not been seen before
+    hop_size = len( first_channel_data ) // classifier.get_setting('SLIDING_WINDOW_AMOUNT', SLIDING_WINDOW_AMOUNT)
     data_row, frequency = feature_engineering_raw( first_channel_data, classifier.get_setting('RATE', RATE), intensity, classifier.get_setting('RECORD_SECONDS', RECORD_SECONDS), 
-        classifier.get_setting('FEATURE_ENGINEERING_TYPE', FEATURE_ENGINEERING_TYPE) )    
+        classifier.get_setting('FEATURE_ENGINEERING_TYPE', FEATURE_ENGINEERING_TYPE), hop_size )    
     data = [ data_row ]
 
     return create_probability_dict( classifier, data, frequency, intensity, power )
         
+def predict_frame_analysis( frame_analysis, classifier ):
+    data_row, frequency = feature_engineering_frame( frame_analysis, classifier.get_setting('FEATURE_ENGINEERING_TYPE', FEATURE_ENGINEERING_TYPE) )
+    data = [ data_row ]
+
+    return create_probability_dict( classifier, data, frequency, frame_analysis.intensity, frame_analysis.recording_power )
+        
 def predict_wav_file( wav_file, classifier, intensity ):
     # FEATURE ENGINEERING
     data_row, frequency = feature_engineering( wav_file, classifier.get_setting('RECORD_SECONDS', RECORD_SECONDS), classifier.get_setting('FEATURE_ENGINEERING_TYPE', FEATURE_ENGINEERING_TYPE) )
@@ -369,6 +378,13 @@ def load_running_classifier( classifier_name ):
             }
             
             classifier = AudioModel( settings, classifier )
+            
+        # Models that can be run with numpy do not need Pytorch to be loaded in
+        # Other Pytorch ensembles use their TorchScript export if it was saved together with the model
+        if( classifier.uses_numpy() ):
+            print( "Predicting with numpy" )
+        elif( hasattr( classifier.get_classifier(), 'load_torchscript' ) ):
+            classifier.get_classifier().load_torchscript( CLASSIFIER_FOLDER + "/" + classifier_name + ".pt" )
         ipc_manager.setClassifier(classifier_name)            
     else:
         print( "Loading dummy classifier for testing purposes" )
@@ -7,7 +7,10 @@ import os
 import warnings
 from lib.machinelearning import *
 from lib.srt import count_total_frames, count_total_silence_frames
-from lib.wav import load_wav_files_with_srts, load_wav_data_from_srt
+from lib.wav import load_wav_files_with_srts, load_wav_streams_from_srt, load_cached_wav_streams_from_srt, count_srt_streams, determine_sample_streams, augmented_feature_engineering_batch, extract_wav_windows_from_srt, determine_offset_windows
+from lib.dataset_manifest import save_manifest, determine_file_signature
+from lib.feature_cache import get_cache_statistics, print_cache_statistics, get_shard_filename, hash_file, ShardedSamples
+from concurrent.futures import ProcessPoolExecutor
 
 def get_grouped_data_directories( labels ):
     # If the microphone separator setting is set use that to split directory names into categories/labels.
@@ -24,7 +27,9 @@ def get_grouped_data_directories( labels ):
         grouped_data_directories[ category_name ].append( data_directory )
     return grouped_data_directories
 
-def generate_data_balance_strategy_map(grouped_data_directories):
+# With weighted sampling, labels that would be oversampled are loaded in only once and given a higher sample weight instead
+# So they are drawn more often during training, without the extra samples taking up memory
+def generate_data_balance_strategy_map(grouped_data_directories, weighted_sampling = False):
     ms_per_frame = math.floor(RECORD_SECONDS / SLIDING_WINDOW_AMOUNT * 1000)
     directory_counts = {}
     max_size = 0
@@ -41,6 +46,7 @@ def generate_data_balance_strategy_map(grouped_data_directories):
             max_size = max(max_size, label_count)
             if label_count > 0:
                 min_size = min(min_size, label_count)
+    save_manifest()
 
     strategies = ['oversample', 'undersample', 'sample', 'background']
     max_oversample_ratio = 2
@@ -77,17 +83,29 @@ def generate_data_balance_strategy_map(grouped_data_directories):
         "sample_from_each": round(min(total_truncation, background_label_size) / len(grouped_data_directories.keys()))
     }
 
-    return rebalance_sampling_strategies_for_memory(sampling_strategies)
+    return assign_sample_weights(rebalance_sampling_strategies_for_memory(sampling_strategies, weighted_sampling), weighted_sampling)
 
-def rebalance_sampling_strategies_for_memory(sampling_strategies):
-    if not SHOULD_FIT_INSIDE_RAM or not AUTOMATIC_DATASET_BALANCING:
+def assign_sample_weights(sampling_strategies, weighted_sampling = False):
+    for label in sampling_strategies:
+        strategy = sampling_strategies[label]
+        strategy["weighted"] = weighted_sampling and strategy["strategy"] == "oversample" and strategy["total_size"] > 0
+        strategy["sample_weight"] = strategy["total_loaded"] / strategy["total_size"] if strategy["weighted"] else 1
+    return sampling_strategies
+
+def rebalance_sampling_strategies_for_memory(sampling_strategies, weighted_sampling = False):
+    # Streamed datasets are read from disk during training, so they do not need to fit inside RAM
+    if not SHOULD_FIT_INSIDE_RAM or not AUTOMATIC_DATASET_BALANCING or STREAMING_DATASET:
         return sampling_strategies
 
     # Make sure the additional data loaded does not increase past a certain point
     total_data_size = 0
     total_truncation = 0
     for label in sampling_strategies:
-        total_data_size += sampling_strategies[label]["total_loaded"]
+        # Oversampled labels only keep a single copy of their samples in memory when they are drawn more often instead
+        if weighted_sampling and sampling_strategies[label]["strategy"] == "oversample":
+            total_data_size += min(sampling_strategies[label]["total_size"], sampling_strategies[label]["total_loaded"])
+        else:
+            total_data_size += sampling_strategies[label]["total_loaded"]
         total_truncation = sampling_strategies[label]["truncate_after"]
     
     strategies = ['oversample', 'undersample', 'sample', 'background']
@@ -126,8 +144,7 @@ def rebalance_sampling_strategies_for_memory(sampling_strategies):
     
     return sampling_strategies
 
-def sample_data_from_label(label, grouped_data_directories, sample_strategies, input_type):
-    warnings.filterwarnings("ignore", "n_fft=2048 is too small for input signal")
+def list_source_files(label, grouped_data_directories):
     directories = grouped_data_directories[ label ]
 
     listed_files = {}
@@ -161,71 +178,334 @@ def sample_data_from_label(label, grouped_data_directories, sample_strategies, i
                         srt_file = possible_srt_file
             
             listed_files[os.path.join(source_directory, source_file)] = os.path.join(segments_directory, srt_file)
-    listed_files_size = len( listed_files )
+    return listed_files
+
+def should_load_label(label, sample_strategies):
+    return label in sample_strategies and sample_strategies[label]["strategy"] != "background"
+
+def to_feature_array(samples) -> np.array:
+    features = np.asarray(samples, dtype=np.float32)
+    return features.reshape(len(features), -1 if len(features) > 0 else 0)
+
+# Determines which windows of the source files of a label end up in the dataset, before any features are calculated
+# The windows are counted using only the SRT files, after which the truncation is done on their indices
+# Sampling the indices with the same seed selects the same samples as sampling the loaded samples themselves
+def plan_label_samples(label, grouped_data_directories, sample_strategies):
+    listed_files = list_source_files(label, grouped_data_directories)
+    strategy = sample_strategies[label]["strategy"]
+    truncate_after = sample_strategies[label]["truncate_after"]
+    should_oversample = strategy == "oversample" and not sample_strategies[label]["weighted"]
+
+    file_counts = [count_srt_streams(listed_files[full_filename], full_filename, should_oversample) for full_filename in listed_files]
+
+    # The files are hashed for the feature cache here rather than in the worker processes, so their hashes are saved in the manifest
+    if FEATURE_CACHE_ENABLED:
+        for full_filename in listed_files:
+            hash_file(full_filename)
+            hash_file(listed_files[full_filename])
+    save_manifest()
+    total_counts = {key: sum(counts[key] for counts in file_counts) for key in determine_sample_streams()}
+    selected_indices = {}
+    seed = round(time.time() * 1000)
+
+    # Truncate the background label samples
+    if BACKGROUND_LABEL in sample_strategies and total_counts["background"] > sample_strategies[BACKGROUND_LABEL]["sample_from_each"]:
+        random.seed(seed)
+        selected_indices["background"] = random.sample(range(total_counts["background"]), sample_strategies[BACKGROUND_LABEL]["sample_from_each"])
+        random.seed(seed)
+        selected_indices["background_augmented"] = random.sample(range(total_counts["background_augmented"]), sample_strategies[BACKGROUND_LABEL]["sample_from_each"])
+    
+    # Truncate the sample data randomly, but ensure the seed is the same so that the augmented data matches the non-augmented data index
+    if strategy in ["oversample", "undersample"] and total_counts["label"] > truncate_after:
+        random.seed(seed)
+        selected_indices["label"] = random.sample(range(total_counts["label"]), truncate_after)
+        random.seed(seed)
+        selected_indices["augmented"] = random.sample(range(total_counts["augmented"]), truncate_after)
+
+    # Split the selected indices up into the windows to extract for every source file
+    # The files return their windows in order, so the order of the random sample is restored afterwards
+    file_selections = [{} for full_filename in listed_files]
+    sample_orders = {}
+    for key, indices in selected_indices.items():
+        indices = np.array(indices, dtype=np.int64)
+        sorted_indices = np.sort(indices)
+        file_offsets = np.cumsum([0] + [counts[key] for counts in file_counts])
+        for file_index in range(len(file_counts)):
+            in_file = (sorted_indices >= file_offsets[file_index]) & (sorted_indices < file_offsets[file_index + 1])
+            file_selections[file_index][key] = sorted_indices[in_file] - file_offsets[file_index]
+        sample_orders[key] = np.searchsorted(sorted_indices, indices)
+    
+    return {
+        "listed_files": listed_files,
+        "should_oversample": should_oversample,
+        "file_selections": file_selections,
+        "sample_orders": sample_orders,
+    }
+
+# Loads the selected windows of all the sample streams of a single source file
+# This runs inside of a worker process when loading in parallel, so the results are returned as float32 arrays
+# Which are a lot cheaper to send back to the main process than lists of lists
+def load_source_file_samples(srt_file, source_file, input_type, should_oversample, selections = None):
+    warnings.filterwarnings("ignore", "n_fft=2048 is too small for input signal")
+    statistics_before = get_cache_statistics()
+    streams = load_wav_streams_from_srt(srt_file, source_file, input_type, should_oversample, selections)
+    samples = {key: to_feature_array(features) for key, features in streams.items()}
+    statistics_after = get_cache_statistics()
+    return samples, {key: statistics_after[key] - statistics_before[key] for key in statistics_after}
+
+# Makes sure all the sample streams of a single source file are stored in the feature cache, without sending any features back
+# Used for streamed datasets, which read the features from the cache during training instead
+# The augmented features are written again for every training run, unless they are kept in the cache
+def cache_source_file_samples(srt_file, source_file, input_type, should_oversample):
+    warnings.filterwarnings("ignore", "n_fft=2048 is too small for input signal")
+    statistics_before = get_cache_statistics()
+    load_cached_wav_streams_from_srt(srt_file, source_file, input_type, should_oversample, persist_augmented=True)
+    statistics_after = get_cache_statistics()
+    return {key: statistics_after[key] - statistics_before[key] for key in statistics_after}
+
+def submit_source_file_jobs(executor, sample_plan, input_type, streaming = False):
+    listed_files = sample_plan["listed_files"]
+    if streaming:
+        return [executor.submit(cache_source_file_samples, listed_files[full_filename], full_filename, input_type, sample_plan["should_oversample"])
+            for full_filename in listed_files]
+    return [executor.submit(load_source_file_samples, listed_files[full_filename], full_filename, input_type, sample_plan["should_oversample"], sample_plan["file_selections"][file_index])
+        for file_index, full_filename in enumerate(listed_files)]
+
+def print_sample_strategy(label, sample_strategies):
+    strategy = sample_strategies[label]["strategy"]
+    if strategy == "oversample" and sample_strategies[label]["weighted"]:
+        print( f"Loading in {label} using weighted sampling: +" + str(abs(round(sample_strategies[label]["sample_weight"] * 100) - 100)) + "%" )
+    elif strategy == "oversample":
+        print( f"Loading in {label} using oversampling: +" + str(abs(round(sample_strategies[label]["total_loaded"] / sample_strategies[label]["total_size"] * 100) - 100)) + "%" )
+    elif strategy == "undersample":
+        print( f"Loading in {label} using undersampling: -" + str(abs(round(sample_strategies[label]["total_loaded"] / sample_strategies[label]["total_size"] * 100) - 100)) + "%" )
+    elif strategy == "background":
+        print( f"Loading in {label} by sampling from other labels" )
+    else:
+        print( f"Loading in {label}" )
+
+def sample_data_from_label(label, grouped_data_directories, sample_strategies, input_type, jobs=None, sample_plan=None):
+    warnings.filterwarnings("ignore", "n_fft=2048 is too small for input signal")
     
-    data = {"background": [], "background_augmented": [], "label": [], "augmented": []}
-    total_label_samples = []
-    total_augmented_samples = []
-    total_background_samples = []
-    total_augmented_background_samples = []
+    data = {key: create_sample_stream(np.zeros((0, 0), dtype=np.float32)) for key in ["background", "background_augmented", "label", "augmented"]}
     
     if label in sample_strategies:
-        strategy = sample_strategies[label]["strategy"]
-        truncate_after = sample_strategies[label]["truncate_after"]
-        if strategy == "oversample":
-            print( f"Loading in {label} using oversampling: +" + str(abs(round(sample_strategies[label]["total_loaded"] / sample_strategies[label]["total_size"] * 100) - 100)) + "%" )
-        elif strategy == "undersample":
-            print( f"Loading in {label} using undersampling: -" + str(abs(round(sample_strategies[label]["total_loaded"] / sample_strategies[label]["total_size"] * 100) - 100)) + "%" )
-        elif strategy == "background":
-            print( f"Loading in {label} by sampling from other labels" )
+        print_sample_strategy(label, sample_strategies)
+        
+        # Early return for background loading as we do that during other loading sequences
+        if sample_strategies[label]["strategy"] == "background":
+            return data
+        
+        if sample_plan is None:
+            sample_plan = plan_label_samples(label, grouped_data_directories, sample_strategies)
+        listed_files = sample_plan["listed_files"]
+        cache_statistics = {"hits": 0, "misses": 0}
+        
+        # Jobs submitted to a worker pool come back in the same order as the source files were listed
+        # So the samples end up in the same order as when they are loaded one by one
+        streams = {key: [] for key in data}
+        windows = {key: [] for key in data}
+        for file_index, full_filename in enumerate( listed_files ):
+            if jobs is None:
+                file_samples, file_cache_statistics = load_source_file_samples(listed_files[full_filename], full_filename, input_type, 
+                    sample_plan["should_oversample"], sample_plan["file_selections"][file_index])
+            else:
+                file_samples, file_cache_statistics = jobs[file_index].result()
             
-            # Early return for background loading as we do that during other loading sequences
+            for key in streams:
+                streams[key].append(file_samples[key])
+                windows[key].append(determine_selected_windows(sample_plan["file_selections"][file_index], key, len(file_samples[key])))
+            for key in cache_statistics:
+                cache_statistics[key] += file_cache_statistics[key]
+        
+        if FEATURE_CACHE_ENABLED:
+            print_cache_statistics(cache_statistics)
+
+        # Every stream is kept as a single float32 matrix, with the source file and window of every row kept next to it as arrays
+        for key in streams:
+            order = sample_plan["sample_orders"].get(key)
+            data[key] = create_sample_stream(gather_stream_rows(streams[key], order), create_stream_sources(sample_plan, key, windows[key], order))
+
+    return data
+
+# Concatenates the feature matrices that were loaded for every source file of a stream, in the planned order
+# Every row is copied straight from the matrix of its source file, rather than concatenating all of them first and reordering that copy
+def gather_stream_rows(file_samples, order = None) -> np.array:
+    file_samples = [samples for samples in file_samples if len(samples) > 0]
+    if len(file_samples) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    if order is None:
+        return np.concatenate(file_samples)
+    
+    file_offsets = np.cumsum([0] + [len(samples) for samples in file_samples])
+    file_indices = np.searchsorted(file_offsets, order, side="right") - 1
+    positions = np.argsort(file_indices, kind="stable")
+    file_positions = np.split(positions, np.cumsum(np.bincount(file_indices, minlength=len(file_samples)))[:-1])
+    rows = np.empty((len(order), file_samples[0].shape[1]), dtype=np.float32)
+    for file_index, samples in enumerate(file_samples):
+        rows[file_positions[file_index]] = samples[order[file_positions[file_index]] - file_offsets[file_index]]
+    return rows
+
+# A stream of samples, either as a float32 matrix or as a list of feature cache shards with the rows to read from them
+# Together with the sources of its samples
+def create_sample_stream(samples, sources = None):
+    return {
+        "samples": samples,
+        "sources": create_sample_sources([], [], []) if sources is None else sources,
+    }
+
+# Combines the streams of several labels into one, in the given order
+def concatenate_sample_streams(streams):
+    if any(isinstance(stream["samples"], list) for stream in streams):
+        samples = [shard for stream in streams for shard in stream["samples"]]
+    else:
+        samples = stack_label_samples([stream["samples"] for stream in streams])
+    return create_sample_stream(samples, concatenate_sample_sources([stream["sources"] for stream in streams]))
+
+def stack_label_samples(label_samples) -> np.array:
+    label_samples = [samples for samples in label_samples if len( samples ) > 0]
+    if len( label_samples ) == 0:
+        return np.zeros( (0, 0), dtype=np.float32 )
+    return np.ascontiguousarray( np.concatenate( label_samples ), dtype=np.float32 )
+
+# The windows of a stream that were loaded from a single source file, in the order they were returned
+def determine_selected_windows(selections, key, window_count):
+    return np.asarray(selections[key], dtype=np.int64) if key in selections else np.arange(window_count, dtype=np.int64)
+
+# Describes where every sample of a dataset came from, so the same samples can be extracted from the recordings again later
+# The files are ( source file, SRT file, cache variant, offset, file signature ) tuples, with the file and the window index given for every sample
+def create_sample_sources(files, file_indices, windows):
+    return {
+        "files": list(files),
+        "file_indices": np.asarray(file_indices, dtype=np.int32).reshape(-1),
+        "windows": np.asarray(windows, dtype=np.int32).reshape(-1),
+    }
+
+# The sample sources of a stream of a label, with the windows of every source file in the given order
+def create_stream_sources(sample_plan, key, file_windows, order = None):
+    listed_files = sample_plan["listed_files"]
+    variant, stream_offset = determine_sample_streams(sample_plan["should_oversample"])[key]
+    files = [(full_filename, listed_files[full_filename], variant, stream_offset, determine_file_signature([full_filename, listed_files[full_filename]])) for full_filename in listed_files]
+    file_indices = np.concatenate([np.full(len(windows), file_index, dtype=np.int32) for file_index, windows in enumerate(file_windows)] + [np.zeros(0, dtype=np.int32)])
+    windows = np.concatenate(list(file_windows) + [np.zeros(0, dtype=np.int64)])
+    if order is not None:
+        file_indices = file_indices[order]
+        windows = windows[order]
+    return create_sample_sources(files, file_indices, windows)
+
+def concatenate_sample_sources(sample_sources_list):
+    files = []
+    file_indices = []
+    for sample_sources in sample_sources_list:
+        file_indices.append(sample_sources["file_indices"] + len(files))
+        files.extend(sample_sources["files"])
+    return create_sample_sources(files, np.concatenate(file_indices + [np.zeros(0, dtype=np.int32)]),
+        np.concatenate([sample_sources["windows"] for sample_sources in sample_sources_list] + [np.zeros(0, dtype=np.int32)]))
+
+# Only keeps the sample sources of the given samples, together with the files they came from
+def select_sample_sources(sample_sources, indices):
+    used_files, file_indices = np.unique(sample_sources["file_indices"][indices], return_inverse=True)
+    return create_sample_sources([sample_sources["files"][file_index] for file_index in used_files], file_indices, sample_sources["windows"][indices])
+
+# Extracts the features of the samples described by the sample sources from the recordings, in the same order as they were described
+# Returns None if any of the recordings or their SRT files have been removed or changed since the samples were described
+def load_sample_sources(sample_sources, input_type):
+    features = None
+    for file_index, (source_file, srt_file, variant, stream_offset, signature) in enumerate(sample_sources["files"]):
+        if not os.path.exists(source_file) or not os.path.exists(srt_file) or determine_file_signature([source_file, srt_file]) != signature:
+            return None
+
+        positions = np.flatnonzero(sample_sources["file_indices"] == file_index)
+        file_features = extract_wav_windows_from_srt(srt_file, source_file, input_type, variant, stream_offset, sample_sources["windows"][positions])
+        if features is None:
+            features = np.empty((len(sample_sources["windows"]), file_features.shape[1]), dtype=np.float32)
+        features[positions] = file_features
+    return features
+
+# The half frame offset variants of the samples of a weighted label, which are read from the feature cache when a sample is drawn more than once
+# Oversampled labels load these variants in as extra samples, weighted labels only read them from disk when they are used
+# Returns the shard rows of the offset variants, and the position of the offset variant of every sample among them, or -1 if it has none
+def create_offset_samples(sample_sources, input_type):
+    shards = []
+    offset_positions = np.full(len(sample_sources["windows"]), -1, dtype=np.int64)
+    offset_count = 0
+    for file_index, (source_file, srt_file, variant, stream_offset, _) in enumerate(sample_sources["files"]):
+        shard_filename = get_shard_filename(source_file, srt_file, input_type, variant, True)
+        if stream_offset or not os.path.exists(shard_filename):
+            continue
+
+        positions = np.flatnonzero(sample_sources["file_indices"] == file_index)
+        offset_windows = determine_offset_windows(srt_file, source_file, variant.startswith("background"))[sample_sources["windows"][positions]]
+        has_offset = offset_windows >= 0
+        shards.append((shard_filename, offset_windows[has_offset]))
+        offset_positions[positions[has_offset]] = offset_count + np.arange(np.count_nonzero(has_offset))
+        offset_count += np.count_nonzero(has_offset)
+    return {"samples": shards, "positions": offset_positions}
+
+# Determines which rows of the feature cache shards of a label end up in the dataset, without loading them into memory
+# The shards are filled first for source files that are not in the feature cache yet
+def shard_data_from_label(label, grouped_data_directories, sample_strategies, input_type, jobs=None, sample_plan=None):
+    data = {key: create_sample_stream([]) for key in ["background", "background_augmented", "label", "augmented"]}
+    
+    if label in sample_strategies:
+        print_sample_strategy(label, sample_strategies)
+        if sample_strategies[label]["strategy"] == "background":
             return data
-        else:
-            print( f"Loading in {label}" )
         
-        should_oversample = strategy == "oversample"
+        if sample_plan is None:
+            sample_plan = plan_label_samples(label, grouped_data_directories, sample_strategies)
+        listed_files = sample_plan["listed_files"]
+        cache_statistics = {"hits": 0, "misses": 0}
         
-        listed_source_files = listed_files.keys()
-        for file_index, full_filename in enumerate( listed_source_files ):
-            label_samples = load_wav_data_from_srt(listed_files[full_filename], full_filename, input_type, should_oversample)
-            for sample in label_samples:
-                total_label_samples.append([full_filename, sample])
-
-            augmented_samples = load_wav_data_from_srt(listed_files[full_filename], full_filename, input_type, should_oversample, True)
-            for augmented_sample in augmented_samples:
-                total_augmented_samples.append([full_filename, augmented_sample])
-
-            background_samples = load_wav_data_from_srt(listed_files[full_filename], full_filename, input_type, False, False, True)
-            for background_sample in background_samples:
-                total_background_samples.append([full_filename, background_sample])
+        for file_index, full_filename in enumerate( listed_files ):
+            srt_file = listed_files[full_filename]
+            if jobs is None:
+                file_cache_statistics = cache_source_file_samples(srt_file, full_filename, input_type, sample_plan["should_oversample"])
+            else:
+                file_cache_statistics = jobs[file_index].result()
+            for key in cache_statistics:
+                cache_statistics[key] += file_cache_statistics[key]
             
-            augmented_background_samples = load_wav_data_from_srt(listed_files[full_filename], full_filename, input_type, True, False, True)
-            for augmented_background_sample in augmented_background_samples:
-                total_augmented_background_samples.append([full_filename, augmented_background_sample])
-
-        seed = round(time.time() * 1000)
-
-        # Truncate the background label samples
-        if BACKGROUND_LABEL in sample_strategies and len(total_background_samples) > sample_strategies[BACKGROUND_LABEL]["sample_from_each"]:
-            random.seed(seed)
-            total_background_samples = random.sample(total_background_samples, sample_strategies[BACKGROUND_LABEL]["sample_from_each"])
-            random.seed(seed)
-            total_augmented_background_samples = random.sample(total_augmented_background_samples, sample_strategies[BACKGROUND_LABEL]["sample_from_each"])
+            # Streams without a selection use all the rows of their shard
+            selections = sample_plan["file_selections"][file_index]
+            for key, (variant, stream_offset) in determine_sample_streams(sample_plan["should_oversample"]).items():
+                shard_filename = get_shard_filename(full_filename, srt_file, input_type, variant, stream_offset)
+                rows = selections[key] if key in selections else np.arange(len(np.load(shard_filename, mmap_mode='r')))
+                data[key]["samples"].append((shard_filename, rows))
         
-        # Truncate the sample data randomly, but ensure the seed is the same so that the augmented data matches the non-augmented data index
-        if strategy in ["oversample", "undersample"] and len(total_label_samples) > truncate_after:
-            random.seed(seed)
-            total_label_samples = random.sample(total_label_samples, truncate_after)
-            random.seed(seed)
-            total_augmented_samples = random.sample(total_augmented_samples, truncate_after)
-
-    data["label"] = total_label_samples
-    data["augmented"] = total_augmented_samples
-    data["background"] = total_background_samples
-    data["background_augmented"] = total_augmented_background_samples
+        print_cache_statistics(cache_statistics)
+        for key in data:
+            data[key]["sources"] = create_stream_sources(sample_plan, key, [rows for _, rows in data[key]["samples"]])
+    
     return data
 
+# Loads the samples of all the labels at once
+# The source files of every label are spread across a pool of worker processes, as loading is mostly bound by feature engineering
+# When streaming, only the feature cache is filled and the shards with the rows to use are returned instead of the samples
+def sample_data_from_labels(labels, grouped_data_directories, sample_strategies, input_type, streaming = False):
+    workers = DATA_LOADING_WORKERS if DATA_LOADING_WORKERS > 0 else os.cpu_count()
+    sample_label = shard_data_from_label if streaming else sample_data_from_label
+    
+    label_samples = {}
+    if workers <= 1:
+        for label in labels:
+            label_samples[label] = sample_label( label, grouped_data_directories, sample_strategies, input_type)
+        return label_samples
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Submit the files of every label up front so the workers never run idle between labels
+        sample_plans = {}
+        label_jobs = {}
+        for label in labels:
+            if should_load_label(label, sample_strategies):
+                sample_plans[label] = plan_label_samples(label, grouped_data_directories, sample_strategies)
+                label_jobs[label] = submit_source_file_jobs(executor, sample_plans[label], input_type, streaming)
+
+        for label in labels:
+            label_samples[label] = sample_label( label, grouped_data_directories, sample_strategies, input_type, 
+                label_jobs[label] if label in label_jobs else None, sample_plans[label] if label in sample_plans else None)
+    return label_samples
+
 def shannon_entropy(label_counts):
     totals = list(label_counts.values())
     n = sum(totals)
@@ -236,46 +516,107 @@ def load_sklearn_data( filtered_data_directory_names, input_type ):
     grouped_data_directories = get_grouped_data_directories( filtered_data_directory_names )
     sample_strategies = generate_data_balance_strategy_map(grouped_data_directories )
     
+    labels = [label for label in grouped_data_directories if label != BACKGROUND_LABEL]
+    label_samples = sample_data_from_labels( labels, grouped_data_directories, sample_strategies, input_type)
+
+    # The background label comes first, followed by the samples of every label
     dataset = {}
     dataset[BACKGROUND_LABEL] = []
-    for label in grouped_data_directories:
-        if label != BACKGROUND_LABEL:
-            data_sample = sample_data_from_label( label, grouped_data_directories, sample_strategies, input_type)
-            dataset[label] = [x[1] for x in data_sample["label"]]
-            dataset[label].extend([x[1] for x in data_sample["augmented"]])
-            dataset[BACKGROUND_LABEL].extend([x[1] for x in data_sample["background"]])
-            dataset[BACKGROUND_LABEL].extend([x[1] for x in data_sample["background_augmented"]])
+    for label in labels:
+        data_sample = label_samples[label]
+        dataset[label] = [data_sample["label"]["samples"]]
+        dataset[BACKGROUND_LABEL].append(data_sample["background"]["samples"])
+        
+        # Without a data loader to augment the audio during training, the augmentations are done once up front
+        if PYTORCH_AVAILABLE and AUGMENT_DURING_TRAINING:
+            dataset[label].append(augmented_feature_engineering_batch(data_sample["augmented"]["samples"], input_type))
+            dataset[BACKGROUND_LABEL].append(augmented_feature_engineering_batch(data_sample["background_augmented"]["samples"], input_type))
+        else:
+            dataset[label].append(data_sample["augmented"]["samples"])
+            dataset[BACKGROUND_LABEL].append(data_sample["background_augmented"]["samples"])
 
     # Generate the training set and labels with them
-    dataset_x = []
-    dataset_labels = []
-
-    for label, data in dataset.items():
-        # Add a label used for classifying the sounds
-        dataset_x.extend( data )
-        dataset_labels.extend([label for x in data])
+    # The samples are copied into a single preallocated float32 matrix, which scikit-learn can use without converting it
+    sample_parts = [(label, samples) for label, label_parts in dataset.items() for samples in label_parts if len(samples) > 0]
+    feature_size = next((samples.shape[1] for _, samples in sample_parts), 0)
+    dataset_x = np.empty((sum(len(samples) for _, samples in sample_parts), feature_size), dtype=np.float32)
+    offset = 0
+    for _, samples in sample_parts:
+        dataset_x[offset:offset + len(samples)] = samples
+        offset += len(samples)
+    dataset_labels = np.repeat(np.array([label for label, _ in sample_parts]), [len(samples) for _, samples in sample_parts])
 
     return dataset_x, dataset_labels, grouped_data_directories.keys()
-    
-def load_pytorch_data( filtered_data_directory_names, input_type):
-    import torch
 
+# Gathers the feature cache shards of the dataset for scikit-learn classifiers that are trained incrementally
+# Returns the samples and the augmented samples, each with the label of every sample, without loading any of them into memory
+def load_sklearn_shards( filtered_data_directory_names, input_type ):
     grouped_data_directories = get_grouped_data_directories( filtered_data_directory_names )
     sample_strategies = generate_data_balance_strategy_map(grouped_data_directories )
+    
+    labels = [label for label in grouped_data_directories if label != BACKGROUND_LABEL]
+    label_samples = sample_data_from_labels( labels, grouped_data_directories, sample_strategies, input_type, True)
+    
+    sample_shards = []
+    augmented_shards = []
+    for label in labels:
+        data_sample = label_samples[label]
+        sample_shards.extend([(label, data_sample["label"]["samples"]), (BACKGROUND_LABEL, data_sample["background"]["samples"])])
+        augmented_shards.extend([(label, data_sample["augmented"]["samples"]), (BACKGROUND_LABEL, data_sample["background_augmented"]["samples"])])
+    
+    samples, sample_labels = to_sharded_samples(sample_shards)
+    augmented_samples, augmented_labels = to_sharded_samples(augmented_shards)
+    return {
+        "samples": samples,
+        "labels": sample_labels,
+        "augmented": augmented_samples,
+        "augmented_labels": augmented_labels,
+        "augmented_audio": PYTORCH_AVAILABLE and AUGMENT_DURING_TRAINING
+    }, grouped_data_directories.keys()
 
-    dataset = {}
-    augmented = {}
-    dataset[BACKGROUND_LABEL] = []
-    augmented[BACKGROUND_LABEL] = []    
-    for label in grouped_data_directories:
-        if label != BACKGROUND_LABEL:
-            data_sample = sample_data_from_label( label, grouped_data_directories, sample_strategies, input_type)
-            dataset[label] = [[x[0], torch.tensor(x[1]).float()] for x in data_sample["label"]]
-            augmented[label] =[[x[0], torch.tensor(x[1]).float()] for x in data_sample["augmented"]]
-            dataset[BACKGROUND_LABEL].extend([[x[0], torch.tensor(x[1]).float()] for x in data_sample["background"]])
-            augmented[BACKGROUND_LABEL].extend([[x[0], torch.tensor(x[1]).float()] for x in data_sample["background_augmented"]])
+def to_sharded_samples(label_shards):
+    shards = [shard for _, shards in label_shards for shard in shards]
+    counts = [sum(len(rows) for _, rows in shards) for _, shards in label_shards]
+    labels = np.repeat(np.array([label for label, _ in label_shards] + [BACKGROUND_LABEL]), counts + [0])
+    return ShardedSamples(shards), labels
+    
+def load_pytorch_data( filtered_data_directory_names, input_type):
+    grouped_data_directories = get_grouped_data_directories( filtered_data_directory_names )
+
+    # Streamed datasets are read in blocks rather than drawn sample by sample, so they keep using oversampling
+    sample_strategies = generate_data_balance_strategy_map(grouped_data_directories, WEIGHTED_SAMPLING and not STREAMING_DATASET )
+
+    labels = [label for label in grouped_data_directories if label != BACKGROUND_LABEL]
+    label_samples = sample_data_from_labels( labels, grouped_data_directories, sample_strategies, input_type, STREAMING_DATASET)
+    
+    # Every label is stored as a single float32 matrix, rather than a tensor per sample
+    # Or as a list of feature cache shards with the rows to read from them when streaming
+    # The background label is kept as the first label, so the label indices stay the same as before
+    dataset = {BACKGROUND_LABEL: None}
+    augmented = {BACKGROUND_LABEL: None}
+    sources = {BACKGROUND_LABEL: None}
+    for label in labels:
+        data_sample = label_samples[label]
+        dataset[label] = data_sample["label"]["samples"]
+        augmented[label] = data_sample["augmented"]["samples"]
+        sources[label] = data_sample["label"]["sources"]
+    background = concatenate_sample_streams([label_samples[label]["background"] for label in labels])
+    dataset[BACKGROUND_LABEL] = background["samples"]
+    augmented[BACKGROUND_LABEL] = concatenate_sample_streams([label_samples[label]["background_augmented"] for label in labels])["samples"]
+    sources[BACKGROUND_LABEL] = background["sources"]
+    
+    # Weighted labels use the offset variants of their samples, read from the feature cache, for every draw of a sample after the first
+    offsets = {label: create_offset_samples(sources[label], input_type) for label in labels if sample_strategies[label]["weighted"]}
     
+    # When augmenting during training, the augmented samples contain audio which still needs its features calculated
     return {
         "data": dataset,
-        "augmented": augmented
-    }
\ No newline at end of file
+        "augmented": augmented,
+        "sources": sources,
+        "offsets": offsets,
+        "augmented_audio": AUGMENT_DURING_TRAINING,
+        "streaming": STREAMING_DATASET,
+        "sample_weights": {label: sample_strategies[label]["sample_weight"] for label in dataset},
+        "feature_engineering_type": input_type
+    }
+
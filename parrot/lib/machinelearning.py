@@ -4,7 +4,11 @@ import scipy.io.wavfile
 from scipy.fftpack import fft, rfft, fft2, dct
 from python_speech_features import mfcc
 import time
-from sklearn.model_selection import cross_val_score, train_test_split
+from sklearn.model_selection import cross_val_score, train_test_split, check_cv
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+from joblib import Parallel, delayed
+import os
 from sklearn.metrics import confusion_matrix
 import numpy as np
 import itertools
@@ -14,8 +18,8 @@ from config.config import *
 import wave
 import audioop
 from lib.mfsc import Mfsc
-if (PYTORCH_AVAILABLE == True):
-    from audiomentations import Compose, AddGaussianNoise, Shift, TimeStretch
+from lib.signal_processing import get_streaming_mfsc, get_mfsc, determine_mfcc_batch, determine_loudest_frequency, determine_loudest_frequency_batch
+from lib.augmentation import WaveAugmenter
 
 _mfscs = {}
 
@@ -30,7 +34,9 @@ def feature_engineering( wavFile, record_seconds, input_type ):
         else:
             return feature_engineering_raw( rawWav[:,0], fs, intensity, record_seconds, input_type )        
     
-def feature_engineering_raw( wavData, sampleRate, intensity, record_seconds, input_type ):
+# When a hop size is given, the data is assumed to be a sliding window over a continuous stream
+# Which allows the MFSC features to reuse the calculations done for the previous window
+def feature_engineering_raw( wavData, sampleRate, intensity, record_seconds, input_type, hop_size = None ):
     freq = get_loudest_freq( wavData, record_seconds )
     if (input_type == TYPE_FEATURE_ENGINEERING_RAW_WAVE):
         data_row = wavData
@@ -45,17 +51,61 @@ def feature_engineering_raw( wavData, sampleRate, intensity, record_seconds, inp
         data_row = []
         data_row.extend( mfcc_result1.ravel() )
     elif(input_type == TYPE_FEATURE_ENGINEERING_NORM_MFSC):
-        global _mfscs
-        if ( sampleRate not in _mfscs ):
-            _mfscs[sampleRate] = Mfsc(sr=sampleRate, n_mel=40, preem_coeff=0.5, frame_stride_ms=5, frame_size_ms=15)
+        if ( hop_size is not None ):
+            mfsc_result = get_streaming_mfsc( sampleRate ).apply( wavData, hop_size )
+        else:
+            global _mfscs
+            if ( sampleRate not in _mfscs ):
+                _mfscs[sampleRate] = Mfsc(sr=sampleRate, n_mel=40, preem_coeff=0.5, frame_stride_ms=5, frame_size_ms=15)
 
-        _mfsc = _mfscs[sampleRate]
-        mfsc_result = _mfsc.apply( wavData )
+            _mfsc = _mfscs[sampleRate]
+            mfsc_result = _mfsc.apply( wavData )
         data_row = []
         data_row.extend( mfsc_result.ravel() )
         
     return data_row, freq
     
+# Feature engineering for a FrameAnalysis of the latest sliding window
+# Which reuses the frequency and MFSC features calculated for the other per-frame metrics
+def feature_engineering_frame( frame_analysis, input_type ):
+    if (input_type == TYPE_FEATURE_ENGINEERING_NORM_MFSC):
+        data_row = []
+        data_row.extend( frame_analysis.mfsc.ravel() )
+        return data_row, frame_analysis.loudest_frequency
+    else:
+        return feature_engineering_raw( frame_analysis.channel_data, frame_analysis.sample_rate, frame_analysis.intensity, frame_analysis.record_seconds, input_type )
+
+# Batched version of feature_engineering_raw, which takes an (N, samples) array of windows
+# And returns an (N, features) float32 matrix with one feature row per window
+def feature_engineering_batch( windows, sampleRate, input_type, record_seconds = RECORD_SECONDS, intensities = 0 ):
+    windows = np.asarray( windows )
+    if ( windows.ndim != 2 or len( windows ) == 0 ):
+        return np.zeros( (0, 0), dtype=np.float32 )
+
+    if (input_type == TYPE_FEATURE_ENGINEERING_RAW_WAVE):
+        data = windows
+    elif(input_type == TYPE_FEATURE_ENGINEERING_OLD_MFCC):
+        mfcc_result = determine_mfcc_batch( windows, sampleRate, nfft=1103, numcep=13, appendEnergy=True )
+        data = np.empty( (len( windows ), mfcc_result[0].size + 2) )
+        data[:,:-2] = mfcc_result.reshape( len( windows ), -1 )
+        data[:,-2] = get_loudest_freq_batch( windows, record_seconds )
+        data[:,-1] = intensities
+    elif(input_type == TYPE_FEATURE_ENGINEERING_NORM_MFCC):
+        mfcc_result = determine_mfcc_batch( windows, sampleRate, nfft=1103, numcep=30, nfilt=40, preemph=0.5, winstep=0.005, winlen=0.015, appendEnergy=False )
+        data = mfcc_result.reshape( len( windows ), -1 )
+    elif(input_type == TYPE_FEATURE_ENGINEERING_NORM_MFSC):
+        mfsc_result = get_mfsc( sampleRate ).apply_batch( windows )
+        data = mfsc_result.reshape( len( windows ), -1 )
+        
+    return np.asarray( data, dtype=np.float32 )
+
+# Turns a whole signal into an (N, window_size) view of sliding windows without copying any data
+def frame_wav_data( wavData, window_size, hop_size ):
+    wavData = np.asarray( wavData )
+    if ( len( wavData ) < window_size ):
+        return wavData[:0].reshape( 0, window_size )
+    return np.lib.stride_tricks.sliding_window_view( wavData, window_size )[::hop_size]
+
 def training_feature_engineering( wavFile, settings):
     fs, rawWav = scipy.io.wavfile.read( wavFile )
     wavData = rawWav
@@ -88,12 +138,7 @@ def augmented_feature_engineering( wavFile, settings ):
     if ( settings['CHANNELS'] == 2 ):
         wavData = rawWav[:,0]
     
-    augmenter = Compose([
-        AddGaussianNoise(min_amplitude=0.001, max_amplitude=0.015, p=0.5),
-        TimeStretch(min_rate=0.8, max_rate=1.25, p=0.5),
-        Shift(min_fraction=-0.5, max_fraction=0.5, p=0.5),
-    ])
-    wavData = augmenter(samples=np.array(wavData, dtype="float32"), sample_rate=fs)
+    wavData = WaveAugmenter().augment_batch( np.array( [wavData], dtype=np.float32 ) )[0]
     
     data_row = []
     input_type = settings['FEATURE_ENGINEERING_TYPE']
@@ -120,6 +165,38 @@ def get_label_for_directory( setdir ):
 def cross_validation( classifier, dataset, labels):
     return cross_val_score(classifier, dataset, labels, cv=3)
 
+# Fits the classifier on the whole dataset while the cross validation folds are fitted next to it
+# Returns the fitted classifier together with the accuracy of every fold, which are the same as the scores of cross_validation
+# The classifier fitted on the whole dataset is handed to persist_classifier as soon as it is done, before the folds have finished
+# Forests run their folds in threads, as the trees are built without holding the GIL, so the dataset itself is never copied
+# Other classifiers, like the multi layer perceptron, mostly hold on to the GIL while fitting, so their folds run in separate processes instead
+# Every running fold still holds a copy of its training samples, which is why the amount of jobs is capped by CROSS_VALIDATION_JOBS
+def fit_and_cross_validate( classifier, dataset, labels, cv=3, persist_classifier=None ):
+    jobs = CROSS_VALIDATION_JOBS if CROSS_VALIDATION_JOBS > 0 else os.cpu_count()
+    folds = list( check_cv( cv, labels, classifier=True ).split( dataset, labels ) )
+    backend = "threads" if isinstance( classifier, ( RandomForestClassifier, ExtraTreesClassifier ) ) else "processes"
+    results = Parallel( n_jobs=min( jobs, len( folds ) + 1 ), prefer=backend, return_as="generator" )(
+        [delayed( fit_classifier_fold )( clone( classifier ), dataset, labels )] + 
+        [delayed( fit_classifier_fold )( clone( classifier ), dataset, labels, train_indices, test_indices ) for train_indices, test_indices in folds] )
+    
+    # The results are returned in the order the jobs were submitted, so the classifier fitted on the whole dataset comes first
+    fitted_classifier = next( results )
+    if persist_classifier is not None:
+        persist_classifier( fitted_classifier )
+    return fitted_classifier, np.array( list( results ) )
+
+# The test samples are predicted in blocks, so only the training samples of a fold are copied at once
+def fit_classifier_fold( classifier, dataset, labels, train_indices = None, test_indices = None, block_size = 4096 ):
+    if train_indices is None:
+        return classifier.fit( dataset, labels )
+    classifier.fit( dataset[train_indices], labels[train_indices] )
+    
+    correct = 0
+    for start in range( 0, len( test_indices ), block_size ):
+        block_indices = test_indices[start:start + block_size]
+        correct += np.count_nonzero( classifier.predict( dataset[block_indices] ) == labels[block_indices] )
+    return correct / len( test_indices )
+
 def average_prediction_speed( classifier, dataset_x ):
     start_time = time.time() * 1000
     classifier.predict( dataset_x[-1000:] )
@@ -180,26 +257,13 @@ def get_highest_intensity_of_wav_file( wav_file, record_seconds ):
 def get_loudest_freq( fftData, recordLength ):
     fft_result = fft( fftData )
     positiveFreqs = np.abs( fft_result[ 0:round( len(fft_result)/2 ) ] )
-    highestFreq = 0
-    loudestPeak = 500
-    frequencies = [0]
-    for freq in range( 0, len( positiveFreqs ) ):
-        if( positiveFreqs[ freq ] > loudestPeak ):
-            loudestPeak = positiveFreqs[ freq ]
-            highestFreq = freq
-    
-    if( loudestPeak > 500 ):
-        frequencies.append( highestFreq )
-    
-    if( recordLength < 1 ):
-        # Considering our sound sample is, for example, 100 ms, our lowest frequency we can find is 10Hz ( I think )
-        # So add that as a base to our found frequency to get Hz - This is probably wrong
-        freqInHz = ( 1 / recordLength ) + np.amax( frequencies )
-    else:
-        # I have no clue how to even pretend to know how to calculate Hz for fft frames longer than a second
-        freqInHz = np.amax( frequencies )
-        
-    return freqInHz
+    return determine_loudest_frequency( positiveFreqs, recordLength )
+
+# Batched version of get_loudest_freq that determines the loudest frequency for every window in an (N, samples) array
+def get_loudest_freq_batch( windows, recordLength ):
+    windows = np.asarray( windows )
+    positiveFreqs = np.abs( fft( windows, axis=1 )[:, 0:round( windows.shape[1] / 2 ) ] )
+    return determine_loudest_frequency_batch( positiveFreqs, recordLength )
 
 def get_recording_power( fftData, recordLength ):
     return audioop.rms( fftData, 4 ) / 1000
\ No newline at end of file
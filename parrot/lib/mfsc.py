@@ -58,6 +58,27 @@ class Mfsc:
         P = self.power_spectrum(frames)
         return np.log(np.maximum(P @ self.trifilter, self.mel_floor))
 
+    # Batched variants that take an (N, samples) array of windows and return (N, frames, n_mel) log-mels
+    # All the windows are framed with a single strided view and transformed with a single rFFT and matmul
+    def apply_batch(self, windows: AnyArray) -> np.array:
+        return self.standardize_batch(self.get_log_mels_batch(windows))
+
+    def get_log_mels_batch(self, windows: AnyArray) -> np.array:
+        windows = np.ascontiguousarray(windows, dtype=np.float32)
+        frames = self.frame_signal_batch(windows)
+        frames = frames * 32768.0 # HTK scaling to int range
+        P = self.power_spectrum(frames)
+        return np.log(np.maximum(P @ self.trifilter, self.mel_floor))
+
+    def frame_signal_batch(self, windows: np.array) -> np.array:
+        windows = np.ascontiguousarray(windows, dtype=np.float32)
+        if windows.ndim != 2 or windows.shape[1] < self.frame_size:
+            return np.zeros((len(windows), 0, self.frame_size), dtype=np.float32)
+        shape = (windows.shape[0], int(1 + np.floor((windows.shape[1] - self.frame_size) / self.frame_stride)), self.frame_size)
+        element = windows.strides[1]
+        strides = (windows.strides[0], element * self.frame_stride, element)
+        return np.lib.stride_tricks.as_strided(windows, shape, strides)
+
     def frame_signal(self, samples: np.array) -> np.array:
         samples = np.asarray(samples, dtype=np.float32)
         if len(samples) < self.frame_size:
@@ -70,8 +91,8 @@ class Mfsc:
     def power_spectrum(self, frames: np.array) -> np.array:
         # pre-emphasis
         if self.preem_coeff > 0:
-            frames[:,0] *= (1 - self.preem_coeff)
-            frames[:,1:] -= frames[:,:-1] * self.preem_coeff
+            frames[...,0] *= (1 - self.preem_coeff)
+            frames[...,1:] -= frames[...,:-1] * self.preem_coeff
         out = np.fft.rfft(frames * self.window, self.n_fft)
         return np.abs(out)
 
@@ -81,4 +102,50 @@ class Mfsc:
         if std > 0:
             return (frames - mean) / std
         else:
-            return frames - mean
\ No newline at end of file
+            return frames - mean
+
+    # Standardizes every window in the batch separately, the same way standardize does for a single window
+    def standardize_batch(self, frames: np.array) -> np.array:
+        if frames.size == 0:
+            return frames
+        mean = np.mean(frames, axis=(1, 2), keepdims=True)
+        std = np.std(frames, axis=(1, 2), keepdims=True)
+        return (frames - mean) / np.where(std > 0, std, 1)
+
+# Keeps the log-mel rows of the previous sliding window around
+# So that only the STFT frames for the newly added hop have to be calculated
+# The overlap is verified against the previous samples, so non-contiguous input simply falls back to a full calculation
+class StreamingMfsc:
+    def __init__(self, mfsc: Mfsc):
+        self.mfsc = mfsc
+        self.reset()
+
+    def reset(self):
+        self.samples = None
+        self.log_mels = None
+
+    def apply(self, samples: AnyArray, hop_size: int) -> np.array:
+        return self.mfsc.standardize(self.get_log_mels(samples, hop_size))
+
+    def get_log_mels(self, samples: AnyArray, hop_size: int) -> np.array:
+        samples = np.array(samples, dtype=np.float32)
+        reused_rows = self.determine_reusable_rows(samples, hop_size)
+        if reused_rows > 0:
+            new_rows = self.mfsc.get_log_mels(samples[reused_rows * self.mfsc.frame_stride:])
+            log_mels = np.concatenate((self.log_mels[-reused_rows:], new_rows))
+        else:
+            log_mels = self.mfsc.get_log_mels(samples)
+
+        self.samples = samples
+        self.log_mels = log_mels
+        return log_mels
+
+    # Rows can only be reused if the window moved a whole amount of strides over the exact same samples
+    def determine_reusable_rows(self, samples: np.array, hop_size: int) -> int:
+        if self.samples is None or hop_size <= 0 or hop_size % self.mfsc.frame_stride != 0:
+            return 0
+        if len(samples) != len(self.samples) or hop_size >= len(samples):
+            return 0
+        if not np.array_equal(samples[:-hop_size], self.samples[hop_size:]):
+            return 0
+        return max(0, len(self.log_mels) - hop_size // self.mfsc.frame_stride)
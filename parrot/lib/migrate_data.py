@@ -3,6 +3,7 @@ import os
 from lib.stream_processing import process_wav_file
 from lib.print_status import create_progress_bar, clear_previous_lines, get_current_status, reset_previous_lines
 from .typing import DetectionState
+from .dataset_manifest import prune_manifest
 import time
 
 def check_migration():
@@ -15,27 +16,27 @@ def check_migration():
                 version_detected = 0
                 break
             else:
+                # The segments folder is listed only once, together with the modification times of its files
                 source_files = [x for x in os.listdir(os.path.join(RECORDINGS_FOLDER, file, "source")) if x.endswith(".wav")]
+                segment_modification_times = list_modification_times(segments_folder)
                 for source_file in source_files:
                     srt_file = source_file.replace(".wav", ".v" + str(CURRENT_VERSION) + ".srt")
-                    thresholds_file_location = os.path.join(segments_folder, source_file.replace(".wav", "_thresholds.txt"))
+                    thresholds_file = source_file.replace(".wav", "_thresholds.txt")
                     
                     manual_srt_file = source_file.replace(".wav", ".MANUAL.srt")
-                    if not os.path.exists(os.path.join(segments_folder, srt_file)) and not os.path.exists(os.path.join(segments_folder, manual_srt_file)):
+                    if srt_file not in segment_modification_times and manual_srt_file not in segment_modification_times:
                         version_detected = 0
                         break
 
                     # If an override file exists and the time of modification is later than the manual SRT file generated, we need to resegment
-                    elif os.path.exists(thresholds_file_location):
-                        srt_file_location = os.path.join(segments_folder, srt_file)
-                        manual_srt_file_location = os.path.join(segments_folder, manual_srt_file)
-                        if os.path.exists(manual_srt_file_location):
-                            if os.path.getmtime(thresholds_file_location) > os.path.getmtime(manual_srt_file_location):
+                    elif thresholds_file in segment_modification_times:
+                        if manual_srt_file in segment_modification_times:
+                            if segment_modification_times[thresholds_file] > segment_modification_times[manual_srt_file]:
                                 version_detected = 0
 
-                        elif os.path.exists(srt_file_location):
+                        elif srt_file in segment_modification_times:
                             # Thresholds file has been changed manually - We need to resegment
-                            if os.path.getmtime(srt_file_location) + 5 < os.path.getmtime(thresholds_file_location):
+                            if segment_modification_times[srt_file] + 5 < segment_modification_times[thresholds_file]:
                                 version_detected = 0
 
                 
@@ -49,6 +50,10 @@ def check_migration():
         print("Resegmenting your data may take a while")
         migrate_data()
 
+def list_modification_times(folder):
+    with os.scandir(folder) as entries:
+        return {entry.name: entry.stat().st_mtime for entry in entries if entry.is_file()}
+
 def migrate_data():
     print("----------------------------")
     recording_dirs = os.listdir(RECORDINGS_FOLDER)
@@ -124,6 +129,8 @@ def migrate_data():
             clear_previous_lines(1)
             print( label + " resegmented!" if skipped_amount < len(wav_files) else label + " already properly segmented!" )
 
+    # The statistics of the older segmentations are no longer needed
+    prune_manifest()
     time.sleep(1)
     print("Finished migrating data!")
     print("----------------------------")
@@ -0,0 +1,141 @@
+import numpy as np
+from scipy.special import expit
+
+# Classifiers that only use numpy to predict, so neither Pytorch nor sklearn need to be loaded in during play
+# They are made from the weights of trained models, and cannot be trained themselves
+
+SELU_ALPHA = 1.6732632423543772848170429916717
+SELU_SCALE = 1.0507009873554804934193349852946
+
+def selu(x):
+    return SELU_SCALE * np.where(x > 0, x, SELU_ALPHA * np.expm1(np.minimum(x, 0)))
+
+def softmax(x):
+    x = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return x / np.sum(x, axis=-1, keepdims=True)
+
+# Returns a numpy version of the given classifier, or None if the classifier cannot be run with numpy
+def create_numpy_classifier(classifier):
+    if hasattr(classifier, 'create_numpy_classifier'):
+        return classifier.create_numpy_classifier()
+    elif type(classifier).__name__ == 'MLPClassifier' and hasattr(classifier, 'coefs_'):
+        return NumpyMLPClassifier(classifier)
+    elif type(classifier).__name__ in ['RandomForestClassifier', 'ExtraTreesClassifier'] and getattr(classifier, 'n_outputs_', 0) == 1:
+        return NumpyForestClassifier(classifier)
+    return None
+
+# An ensemble of TinyAudioNets made from the state dicts of its members, as numpy arrays
+# The members are stacked the same way as in the FusedTinyAudioNetEnsemble, with the batch normalization folded into the first layer
+class NumpyTinyAudioNetEnsemble:
+
+    def __init__(self, classes, state_dicts):
+        self.classes_ = classes
+        self.member_count = len(state_dicts)
+        self.hidden_size = state_dicts[0]['fc1.weight'].shape[0]
+
+        input_weights = []
+        input_biases = []
+        for state_dict in state_dicts:
+            scale = state_dict['batchNorm.weight'] / np.sqrt(state_dict['batchNorm.running_var'] + 1e-5)
+            shift = state_dict['batchNorm.bias'] - state_dict['batchNorm.running_mean'] * scale
+            input_weights.append(state_dict['fc1.weight'] * scale)
+            input_biases.append(state_dict['fc1.bias'] + state_dict['fc1.weight'].dot(shift))
+        self.input_weight = np.ascontiguousarray(np.concatenate(input_weights).T, dtype=np.float32)
+        self.input_bias = np.concatenate(input_biases).astype(np.float32)
+        self.weights = [np.ascontiguousarray(np.stack([state_dict[layer_name + '.weight'].T for state_dict in state_dicts]), dtype=np.float32)
+            for layer_name in ['fc2', 'fc3', 'fc4', 'fc5', 'fc6']]
+        self.biases = [np.stack([state_dict[layer_name + '.bias'][np.newaxis] for state_dict in state_dicts]).astype(np.float32)
+            for layer_name in ['fc2', 'fc3', 'fc4', 'fc5', 'fc6']]
+
+    def predict_proba(self, data):
+        x = selu(np.asarray(data, dtype=np.float32).dot(self.input_weight) + self.input_bias)
+        x = x.reshape(len(x), self.member_count, self.hidden_size).transpose(1, 0, 2)
+        for weight, bias in zip(self.weights[:-1], self.biases[:-1]):
+            x = selu(np.matmul(x, weight) + bias)
+        x = np.matmul(x, self.weights[-1]) + self.biases[-1]
+        return softmax(x).mean(axis=0, dtype=np.float64)
+
+# A fitted sklearn MLPClassifier, which calculates the same probabilities without the input validation of sklearn
+class NumpyMLPClassifier:
+    activations = {
+        'identity': lambda x: x,
+        'logistic': expit,
+        'tanh': np.tanh,
+        'relu': lambda x: np.maximum(x, 0),
+    }
+
+    def __init__(self, classifier):
+        self.classes_ = classifier.classes_
+        self.coefs_ = [np.ascontiguousarray(coef) for coef in classifier.coefs_]
+        self.intercepts_ = [np.asarray(intercept) for intercept in classifier.intercepts_]
+        self.activation = classifier.activation
+        self.out_activation = classifier.out_activation_
+
+    def predict_proba(self, data):
+        x = np.asarray(data, dtype=self.coefs_[0].dtype)
+        for layer_index, (coef, intercept) in enumerate(zip(self.coefs_, self.intercepts_)):
+            x = x.dot(coef) + intercept
+            if layer_index + 1 < len(self.coefs_):
+                x = self.activations[self.activation](x)
+
+        # A single logistic output gives the probability of the second of two classes
+        if self.out_activation == 'softmax':
+            return softmax(x)
+        x = expit(x)
+        if x.shape[1] == 1:
+            return np.hstack([1 - x, x])
+        return x
+
+# A fitted sklearn RandomForestClassifier or ExtraTreesClassifier, with the nodes of all its trees stored in flat arrays
+# Every row walks through all the trees at once, one level of the trees at a time
+class NumpyForestClassifier:
+
+    def __init__(self, classifier):
+        self.classes_ = classifier.classes_
+        self.tree_count = len(classifier.estimators_)
+
+        features = []
+        thresholds = []
+        left_children = []
+        right_children = []
+        leaf_probabilities = []
+        roots = []
+        node_offset = 0
+        self.depth = 0
+        for estimator in classifier.estimators_:
+            tree = estimator.tree_
+            nodes = np.arange(tree.node_count)
+            is_leaf = tree.children_left == -1
+            roots.append(node_offset)
+
+            # Leaves point to themselves, so rows that reach a leaf early stay there while the deeper rows continue
+            features.append(np.where(is_leaf, 0, tree.feature))
+            thresholds.append(np.where(is_leaf, np.inf, tree.threshold))
+            left_children.append(np.where(is_leaf, nodes, tree.children_left) + node_offset)
+            right_children.append(np.where(is_leaf, nodes, tree.children_right) + node_offset)
+
+            # Older versions of sklearn store the sample counts of every class rather than their fractions
+            values = tree.value[:, 0, :].astype(np.float64)
+            leaf_probabilities.append(values / np.maximum(values.sum(axis=1, keepdims=True), np.finfo(np.float64).tiny))
+            node_offset += tree.node_count
+            self.depth = max(self.depth, tree.max_depth)
+
+        self.roots = np.array(roots, dtype=np.intp)
+        self.features = np.concatenate(features).astype(np.intp)
+        self.thresholds = np.concatenate(thresholds)
+        self.leaf_probabilities = np.concatenate(leaf_probabilities)
+
+        # The right child of every node is stored first, so the next node is found by adding whether to go left
+        self.children = np.stack([np.concatenate(right_children), np.concatenate(left_children)], axis=1).ravel().astype(np.intp)
+
+    # The inputs are compared as float32, just like sklearn does
+    def predict_proba(self, data):
+        data = np.asarray(data, dtype=np.float32)
+        feature_count = data.shape[1]
+        data = data.ravel()
+        row_offsets = np.arange(0, len(data), feature_count)[:, np.newaxis]
+        nodes = np.broadcast_to(self.roots, (len(row_offsets), self.tree_count))
+        for level in range(self.depth):
+            go_left = data[row_offsets + self.features[nodes]] <= self.thresholds[nodes]
+            nodes = self.children[2 * nodes + go_left]
+        return self.leaf_probabilities[nodes].sum(axis=1) / self.tree_count
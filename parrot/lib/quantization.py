@@ -0,0 +1,76 @@
+from config.config import *
+import time
+import numpy as np
+import torch
+from lib.load_data import create_sample_sources, load_sample_sources
+from lib.audio_net import AudioNetTrainer
+
+# The amount of single sound frames used to measure how long a prediction takes
+LATENCY_FRAMES = 200
+
+# Quantizes the Audio Nets of a Pytorch ensemble to int8, and compares it to the original ensemble before it is saved
+# The comparison is done on the validation samples of the last Audio Net, just like the combined accuracy during training
+# Returns the classifier that should be saved, which is the original one if the quantized one is not accepted
+def quantize_torch_ensemble( classifier, classifier_map, settings ):
+    print( "-------------------------" )
+    print( "Quantizing the Audio Nets to int8..." )
+    quantized_classifier = classifier.quantize()
+
+    validation_batches = load_validation_batches( classifier, classifier_map, settings )
+    if ( validation_batches is not None ):
+        accuracy = determine_accuracy( classifier, validation_batches )
+        quantized_accuracy = determine_accuracy( quantized_classifier, validation_batches )
+        print( "Validation accuracy: %.4f -> %.4f ( %+.4f )" % (accuracy, quantized_accuracy, quantized_accuracy - accuracy) )
+        latency_frames = torch.cat( [samples for samples, _ in validation_batches] )[:LATENCY_FRAMES].numpy()
+    else:
+        input_size = next(iter(classifier.classifiers.values())).fc1.in_features
+        latency_frames = np.random.default_rng(0).normal( size=(LATENCY_FRAMES, input_size) ).astype( np.float32 )
+
+    latency = determine_frame_latency( classifier, latency_frames )
+    quantized_latency = determine_frame_latency( quantized_classifier, latency_frames )
+    print( "Prediction time per sound frame: %.3f ms -> %.3f ms ( %.2fx speedup )" % (latency * 1000, quantized_latency * 1000, latency / quantized_latency) )
+    print( "-------------------------" )
+
+    print( "Save the quantized model? Y/N ( Empty is yes )" )
+    if ( input("").strip().lower() == "n" ):
+        return classifier
+    return quantized_classifier
+
+# Extracts the validation samples of the last Audio Net in the ensemble from the recordings again
+# The checkpoint stores the recordings and windows of its validation samples, so only those windows have their features calculated
+def load_validation_batches( classifier, classifier_map, settings ):
+    checkpoint = list(classifier_map.values())[-1]
+    if not isinstance( checkpoint, dict ):
+        checkpoint = torch.load( checkpoint, map_location=torch.device('cpu') )
+    if checkpoint.get( 'validation_samples' ) is None:
+        print( "The checkpoints do not contain the validation samples they were trained with, skipping the accuracy comparison" )
+        return None
+
+    print( "Extracting the validation samples from the recordings to compare the validation accuracy..." )
+    validation_samples = checkpoint['validation_samples']
+    sample_sources = create_sample_sources( validation_samples['files'], validation_samples['file_indices'], validation_samples['windows'] )
+    features = load_sample_sources( sample_sources, settings['FEATURE_ENGINEERING_TYPE'] )
+    if ( features is None or len( features ) == 0 ):
+        print( "The recordings of the validation samples have been changed or removed since training, skipping the accuracy comparison" )
+        return None
+
+    samples = torch.from_numpy( features )
+    labels = torch.as_tensor( validation_samples['labels'], dtype=torch.int64 )
+    return list( zip( torch.split( samples, AudioNetTrainer.batch_size ), torch.split( labels, AudioNetTrainer.batch_size ) ) )
+
+def determine_accuracy( classifier, validation_batches ):
+    correct = 0
+    total = 0
+    for samples, labels in validation_batches:
+        predictions = np.argmax( classifier.predict_proba( samples.numpy() ), axis=1 )
+        correct += int( np.sum( predictions == labels.numpy() ) )
+        total += len( labels )
+    return correct / max( 1, total )
+
+# Predicts the frames one by one, like they are predicted during play, and returns the average time per frame in seconds
+def determine_frame_latency( classifier, frames ):
+    classifier.predict_proba( frames[:1] )
+    start_time = time.perf_counter()
+    for frame in frames:
+        classifier.predict_proba( frame[np.newaxis] )
+    return ( time.perf_counter() - start_time ) / len( frames )
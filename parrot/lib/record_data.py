@@ -16,6 +16,7 @@ from lib.stream_processing import CURRENT_VERSION, CURRENT_DETECTION_STRATEGY
 from lib.typing import DetectionState, DetectionFrame
 from lib.stream_recorder import StreamRecorder
 from lib.srt import count_total_label_ms, ms_to_srt_timestring
+from lib.dataset_manifest import save_manifest
 from typing import List
 
 # Countdown from seconds to 0
@@ -188,6 +189,7 @@ def record_sound():
                 time_recorded = " ( " + ms_to_srt_timestring(current_count, False).split(",")[0] + " )"
                 
                 print(" - ", directory_name.ljust(30) + time_recorded )
+            save_manifest()
             print("")
             print("NOTE: It is recommended to record roughly the same amount for each sound")
             print("As it will improve the ability for the machine learning models to learn from the data")
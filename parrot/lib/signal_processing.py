@@ -3,18 +3,28 @@ import numpy as np
 from scipy.fftpack import fft, rfft, fft2, dct
 import audioop
 from python_speech_features import mfcc
-from .mfsc import Mfsc
+from python_speech_features.base import get_filterbanks
+from python_speech_features.sigproc import round_half_up
+from .mfsc import Mfsc, StreamingMfsc
 from typing import List, Tuple
 import os
-from config.config import RATE
+import threading
+from functools import cached_property
+from config.config import RATE, RECORD_SECONDS
 from scipy import signal
 
 long_byte_size = 4
 _mfscs = {}
+_filterbanks = {}
+
+# Streaming log-mel state is kept per thread, as every recording microphone and the listen loop run their own thread
+_streaming_state = threading.local()
 
 # Determine the decibel based on full scale of 16 bit ints ( same as Audacity )
 def determine_dBFS(waveData: np.array) -> float:
-    power = determine_power(waveData)
+    return power_to_dBFS(determine_power(waveData))
+
+def power_to_dBFS(power: float) -> float:
     if power <= 0:
         power = 0.0001
 
@@ -29,29 +39,99 @@ def determine_legacy_power(waveData: np.array) -> float:
 
 # Old fundamental frequency finder - this one doesn't show frequency in Hz
 def determine_legacy_frequency(waveData: np.array) -> float:
-    fft_result = fft( waveData )
-    positiveFreqs = np.abs( fft_result[ 0:round( len(fft_result) / 2 ) ] )
-    highestFreq = 0
-    loudestPeak = 500
-    frequencies = [0]
-    for freq in range( 0, len( positiveFreqs ) ):
-        if( positiveFreqs[ freq ] > loudestPeak ):
-            loudestPeak = positiveFreqs[ freq ]
-            highestFreq = freq
-    
-    if( loudestPeak > 500 ):
-        frequencies.append( highestFreq )
+    return determine_legacy_frequency_batch(np.asarray(waveData)[np.newaxis])[0]
+
+def determine_legacy_frequency_batch(waveData: np.array) -> np.array:
+    waveData = np.asarray(waveData)
+    positiveFreqs = np.abs( fft( waveData, axis=-1 )[:, 0:round( waveData.shape[-1] / 2 ) ] )
+    return determine_loudest_frequency_batch(positiveFreqs, 0.03)
+
+# Determine the loudest frequency from the positive half of a magnitude spectrum
+# Frequencies are only counted if their peak is louder than 500
+def determine_loudest_frequency(positiveFreqs: np.array, recordLength: float) -> float:
+    return determine_loudest_frequency_batch(np.asarray(positiveFreqs)[np.newaxis], recordLength)[0]
+
+def determine_loudest_frequency_batch(positiveFreqs: np.array, recordLength: float) -> np.array:
+    if positiveFreqs.shape[-1] == 0:
+        frequencies = np.zeros(len(positiveFreqs), dtype=np.int64)
+    else:
+        highestFreqs = np.argmax(positiveFreqs, axis=-1)
+        loudestPeaks = np.take_along_axis(positiveFreqs, highestFreqs[:, np.newaxis], axis=-1)[:, 0]
+        frequencies = np.where(loudestPeaks > 500, highestFreqs, 0)
 
-    recordLength = 0.03
     if( recordLength < 1 ):
         # Considering our sound sample is, for example, 100 ms, our lowest frequency we can find is 10Hz ( I think )
         # So add that as a base to our found frequency to get Hz - This is probably wrong
-        freqInHz = ( 1 / recordLength ) + np.amax( frequencies )
+        return ( 1 / recordLength ) + frequencies
     else:
         # I have no clue how to even pretend to know how to calculate Hz for fft frames longer than a second
-        freqInHz = np.amax( frequencies )
-        
-    return freqInHz
+        return frequencies
+
+# Analysis of a single sliding window of audio frames
+# Every metric is only calculated when it is first requested, and then kept for the other consumers of the same frame
+# The magnitude spectrum and the log-mels are therefore calculated at most once per frame
+class FrameAnalysis:
+    def __init__(self, audio_frames: List[bytes], sample_rate: int = RATE, record_seconds: float = RECORD_SECONDS, channels: int = 1):
+        self.audio_frames = audio_frames
+        self.sample_rate = sample_rate
+        self.record_seconds = record_seconds
+        self.channels = channels
+
+    @cached_property
+    def byte_data(self) -> bytes:
+        return b''.join(self.audio_frames)
+
+    @cached_property
+    def wave_data(self) -> np.array:
+        return np.frombuffer(self.byte_data, dtype=np.int16)
+
+    # The samples of the first channel, used for all the spectral metrics
+    @cached_property
+    def channel_data(self) -> np.array:
+        return self.wave_data[::2] if self.channels == 2 else self.wave_data
+
+    # The amount of samples added by the latest audio frame
+    @cached_property
+    def hop_size(self) -> int:
+        return len(self.audio_frames[-1]) // 2 // self.channels
+
+    # Peak intensity of the latest audio frame
+    @cached_property
+    def intensity(self) -> float:
+        return audioop.maxpp(self.audio_frames[-1], 4) / 32767
+
+    @cached_property
+    def power(self) -> float:
+        return determine_power(self.wave_data)
+
+    # The power representation used in play mode and the replay files
+    @cached_property
+    def recording_power(self) -> float:
+        return self.power / 1000
+
+    @cached_property
+    def dBFS(self) -> float:
+        return power_to_dBFS(self.power)
+
+    @cached_property
+    def spectrum(self) -> np.array:
+        return np.abs(np.fft.rfft(self.channel_data))
+
+    @cached_property
+    def loudest_frequency(self) -> float:
+        return determine_loudest_frequency(self.spectrum[:round(len(self.channel_data) / 2)], self.record_seconds)
+
+    @cached_property
+    def log_mels(self) -> np.array:
+        return determine_streaming_log_mels(self.channel_data, self.hop_size, self.sample_rate)
+
+    @cached_property
+    def mfsc(self) -> np.array:
+        return get_mfsc(self.sample_rate).standardize(self.log_mels)
+
+    @cached_property
+    def spectral_flux(self) -> float:
+        return determine_euclidean_dist(self.log_mels, True)
 
 # Approximate vocal formants F1 and F2 using weighted average
 # Goal is to have a light weight, smooth pair of values that can be properly controlled by the user
@@ -97,43 +177,99 @@ def determine_mfcc_type1(waveData: np.array, sampleRate: int = 16000) -> List[fl
 def determine_mfcc_type2(waveData: np.array, sampleRate: int = 16000) -> List[float]:
     return mfcc( waveData, samplerate=sampleRate, nfft=1103, numcep=30, nfilt=40, preemph=0.5, winstep=0.005, winlen=0.015, appendEnergy=False )
 
-def determine_mfsc(waveData: np.array, sampleRate:int = 16000) -> List[float]:
+def get_mfsc(sampleRate:int = 16000) -> Mfsc:
     global _mfscs
     if ( sampleRate not in _mfscs ):
         _mfscs[sampleRate] = Mfsc(sr=sampleRate, n_mel=40, preem_coeff=0.5, frame_stride_ms=5, frame_size_ms=15)
-    _mfsc = _mfscs[sampleRate]
-    return _mfsc.apply( waveData )
+    return _mfscs[sampleRate]
+
+# Batched equivalent of python_speech_features' mfcc, which takes an (N, samples) array of windows
+# And returns an (N, frames, numcep) array with the same values as calling mfcc on every window separately
+def determine_mfcc_batch(windows: np.array, sampleRate: int = 16000, winlen: float = 0.025, winstep: float = 0.01, numcep: int = 13, 
+    nfilt: int = 26, nfft: int = 512, preemph: float = 0.97, ceplifter: int = 22, appendEnergy: bool = True) -> np.array:
+    global _filterbanks
+    windows = np.asarray(windows, dtype=np.float64)
+    emphasized = np.concatenate((windows[:,:1], windows[:,1:] - preemph * windows[:,:-1]), axis=1)
+
+    # Frame the signal the same way as python_speech_features, padding the last frame with zeros
+    frame_len = int(round_half_up(winlen * sampleRate))
+    frame_step = int(round_half_up(winstep * sampleRate))
+    window_len = windows.shape[1]
+    numframes = 1 if window_len <= frame_len else 1 + int(math.ceil((1.0 * window_len - frame_len) / frame_step))
+    padlen = int((numframes - 1) * frame_step + frame_len)
+    if padlen > window_len:
+        emphasized = np.pad(emphasized, ((0, 0), (0, padlen - window_len)))
+    frames = np.lib.stride_tricks.sliding_window_view(emphasized, frame_len, axis=1)[:,::frame_step][:,:numframes]
+
+    pspec = 1.0 / nfft * np.square(np.absolute(np.fft.rfft(frames, nfft)))
+    energy = np.sum(pspec, 2)
+    energy = np.where(energy == 0, np.finfo(float).eps, energy)
+
+    filterbank_key = (nfilt, nfft, sampleRate)
+    if ( filterbank_key not in _filterbanks ):
+        _filterbanks[filterbank_key] = get_filterbanks(nfilt, nfft, sampleRate, 0, sampleRate / 2).T
+    feat = pspec @ _filterbanks[filterbank_key]
+    feat = np.log(np.where(feat == 0, np.finfo(float).eps, feat))
+    feat = dct(feat, type=2, axis=2, norm='ortho')[:,:,:numcep]
+    if ceplifter > 0:
+        feat = feat * (1 + (ceplifter / 2.) * np.sin(np.pi * np.arange(feat.shape[2]) / ceplifter))
+    if appendEnergy:
+        feat[:,:,0] = np.log(energy)
+    return feat
+
+def determine_mfsc(waveData: np.array, sampleRate:int = 16000) -> List[float]:
+    return get_mfsc(sampleRate).apply( waveData )
     
 def determine_log_mels(waveData: np.array, sampleRate:int = 16000) -> List[float]:
-    global _mfscs
-    if ( sampleRate not in _mfscs ):
-        _mfscs[sampleRate] = Mfsc(sr=sampleRate, n_mel=40, preem_coeff=0.5, frame_stride_ms=5, frame_size_ms=15)
-    _mfsc = _mfscs[sampleRate]
-    return _mfsc.get_log_mels( waveData )
+    return get_mfsc(sampleRate).get_log_mels( waveData )
+
+def get_streaming_mfsc(sampleRate:int = 16000) -> StreamingMfsc:
+    if ( not hasattr(_streaming_state, "mfscs") ):
+        _streaming_state.mfscs = {}
+    if ( sampleRate not in _streaming_state.mfscs ):
+        _streaming_state.mfscs[sampleRate] = StreamingMfsc(get_mfsc(sampleRate))
+    return _streaming_state.mfscs[sampleRate]
+
+# Same as determine_mfsc and determine_log_mels, but only calculates the STFT frames added by the last hop of a sliding window
+def determine_streaming_mfsc(waveData: np.array, hop_size: int, sampleRate:int = 16000) -> List[float]:
+    return get_streaming_mfsc(sampleRate).apply( waveData, hop_size )
+
+def determine_streaming_log_mels(waveData: np.array, hop_size: int, sampleRate:int = 16000) -> List[float]:
+    return get_streaming_mfsc(sampleRate).get_log_mels( waveData, hop_size )
 
 # Get a feeling of how much the signal changes based on the total distance between the first and the last mel cepstrum
 def determine_euclidean_dist(mfscData: np.array, half_wave_rectification: bool = False) -> float:
     if half_wave_rectification:
-        distance = 0
-        for index, bin in enumerate(mfscData[-1]):
-            if bin > mfscData[0][index]:
-                distance += abs(bin - mfscData[0][index])
+        return determine_euclidean_dist_batch(np.asarray(mfscData)[np.newaxis], half_wave_rectification)[0]
     else:
-        distance = np.linalg.norm(mfscData[-1] - mfscData[0])
-    return distance
+        return np.linalg.norm(mfscData[-1] - mfscData[0])
+
+def determine_euclidean_dist_batch(mfscData: np.array, half_wave_rectification: bool = False) -> np.array:
+    difference = mfscData[:,-1] - mfscData[:,0]
+    if half_wave_rectification:
+        # Only count the bins that have increased in energy
+        # The cumulative sum adds up the bins in order, the same way a loop would
+        rectified = np.maximum(difference, 0)
+        return np.cumsum(rectified, axis=-1)[:,-1] if rectified.shape[-1] > 0 else np.zeros(len(rectified))
+    else:
+        # A dot product of every row with itself, which sums the squares the same way np.linalg.norm does for a single row
+        return np.sqrt(np.matmul(difference[:,np.newaxis,:], difference[:,:,np.newaxis])[:,0,0])
 
 # Get a really quick representation of frequency shifts
 def determine_zero_crossing_count(waveData: np.array) -> int:
-    zc = 0
-    zc_sign = 0
-    for i in waveData:
-        if zc_sign <= 0 and i > 0:
-            zc += 1
-            zc_sign = 1
-        elif zc_sign >= 0 and i < 0:
-            zc_sign = -1
-            zc += 1
-    return zc
+    return int(determine_zero_crossing_count_batch(np.asarray(waveData)[np.newaxis])[0])
+
+def determine_zero_crossing_count_batch(waveData: np.array) -> np.array:
+    signs = np.sign(waveData)
+    if signs.shape[-1] == 0:
+        return np.zeros(len(signs), dtype=np.int64)
+
+    # Zeros keep the sign of the sample before them, so carry the last non-zero sign forward
+    positions = np.where(signs != 0, np.arange(signs.shape[-1]), 0)
+    np.maximum.accumulate(positions, axis=-1, out=positions)
+    carried_signs = np.take_along_axis(signs, positions, axis=-1)
+    previous_signs = np.concatenate((np.zeros((len(signs), 1), dtype=signs.dtype), carried_signs[:,:-1]), axis=-1)
+    return np.count_nonzero((signs != 0) & (signs != previous_signs), axis=-1)
 
 # High pass filter that filters out most frequencies below voice level
 # In order to improve signal to noise ratio
@@ -1,13 +1,17 @@
 import time
-from config.config import BACKGROUND_LABEL, CURRENT_VERSION
-from .typing import TransitionEvent, DetectionEvent, DetectionFrame
+from config.config import BACKGROUND_LABEL, CURRENT_VERSION, RECORD_SECONDS, SLIDING_WINDOW_AMOUNT, FEATURE_CACHE_FOLDER
+from .typing import TransitionEvent, TransitionIndex, DetectionEvent, DetectionFrame
+from .dataset_manifest import get_file_statistic, determine_file_signature
 from typing import List
+import hashlib
 import math
 import os
 import numpy as np
 
 current_v_ending = ".v" + str(CURRENT_VERSION) + ".srt"
 manual_ending = ".MANUAL.srt"
+index_ending = ".index"
+TRANSITION_INDEX_VERSION = 1
 
 def ms_to_srt_timestring( ms: int, include_hours=True):
     if ms <= 0:
@@ -41,6 +45,10 @@ def persist_srt_file(srt_filename: str, events: List[DetectionEvent]):
             srt_file.write( ms_to_srt_timestring(event.start_ms) + " --> " + ms_to_srt_timestring(event.end_ms) + '\n' )
             srt_file.write( event.label + '\n\n' )
 
+    # Store the frame index next to the SRT file right away, so it does not need to be parsed again when it is used
+    ms_per_frame = math.floor(RECORD_SECONDS / SLIDING_WINDOW_AMOUNT * 1000)
+    persist_transition_index(srt_filename, build_transition_index(parse_srt_file(srt_filename, ms_per_frame, False), ms_per_frame))
+
 def parse_srt_file(srt_filename: str, rounding_ms: int, show_errors: bool = True) -> List[TransitionEvent]:
     transition_events = []
     positive_event_list = []
@@ -99,6 +107,96 @@ def parse_srt_file(srt_filename: str, rounding_ms: int, show_errors: bool = True
     
     return transition_events
 
+def build_transition_index(transition_events: List[TransitionEvent], rounding_ms: int) -> TransitionIndex:
+    labels = [BACKGROUND_LABEL]
+    for transition_event in transition_events:
+        if transition_event.label not in labels:
+            labels.append(transition_event.label)
+    
+    event_labels = np.array([labels.index(transition_event.label) for transition_event in transition_events], dtype=np.int16)
+    start_index = np.array([transition_event.start_index for transition_event in transition_events], dtype=np.int64)
+    start_ms = np.array([transition_event.start_ms for transition_event in transition_events], dtype=np.int64)
+
+    # Frames before the first event are given the label of the first event
+    frame_count = start_index[-1] + 1 if len(start_index) > 0 else 0
+    frame_events = np.maximum(np.searchsorted(start_index, np.arange(frame_count), side="right") - 1, 0)
+    return TransitionIndex(rounding_ms, labels, event_labels, start_index, start_ms, np.append(start_index[1:], -1), np.append(start_ms[1:], -1),
+        event_labels[frame_events] if len(event_labels) > 0 else np.zeros(0, dtype=np.int16))
+
+# The frame index is stored as a sequence of .npy arrays in a single file, starting with the SRT file it was built from
+# The frame indices are kept in the feature cache folder rather than next to the SRT files, so the recordings folders stay unchanged
+# Every SRT file gets its own index file, named after the hash of its full path
+def get_transition_index_filename(srt_filename: str) -> str:
+    path_key = hashlib.sha1(os.path.abspath(srt_filename).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(FEATURE_CACHE_FOLDER, "indices", path_key + "_" + os.path.basename(srt_filename) + index_ending)
+
+def persist_transition_index(srt_filename: str, transition_index: TransitionIndex):
+    header = np.array([TRANSITION_INDEX_VERSION, transition_index.rounding_ms] + determine_file_signature([srt_filename])[0], dtype=np.int64)
+    arrays = [header, np.array(transition_index.labels, dtype=str), transition_index.event_labels, transition_index.start_index, 
+        transition_index.start_ms, transition_index.end_index, transition_index.end_ms, transition_index.frame_labels]
+
+    index_filename = get_transition_index_filename(srt_filename)
+    index_directory = os.path.dirname(index_filename)
+    if not os.path.exists(index_directory):
+        os.makedirs(index_directory, exist_ok=True)
+    with open(index_filename + ".tmp", 'wb') as index_file:
+        for array in arrays:
+            np.lib.format.write_array(index_file, np.ascontiguousarray(array), allow_pickle=False)
+    os.replace(index_filename + ".tmp", index_filename)
+
+    # Index files stored next to the SRT file by earlier versions are no longer used
+    if os.path.exists(srt_filename + index_ending):
+        os.remove(srt_filename + index_ending)
+
+# Memory maps every array inside of a file written by persist_transition_index
+def read_index_arrays(index_filename: str) -> List[np.array]:
+    arrays = []
+    index_buffer = np.memmap(index_filename, dtype=np.uint8, mode='r')
+    with open(index_filename, 'rb') as index_file:
+        while index_file.tell() < len(index_buffer):
+            version = np.lib.format.read_magic(index_file)
+            read_array_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_array_header(index_file)
+            offset = index_file.tell()
+            size = int(np.prod(shape)) * dtype.itemsize
+            if fortran_order or offset + size > len(index_buffer):
+                raise ValueError("Invalid index file " + index_filename)
+
+            arrays.append(index_buffer[offset:offset + size].view(dtype).reshape(shape))
+            index_file.seek(offset + size)
+    return arrays
+
+# Loads the frame index of an SRT file, which is built again whenever the SRT file has been changed since the index was stored
+def load_transition_index(srt_filename: str, rounding_ms: int, show_errors: bool = True) -> TransitionIndex:
+    if not srt_filename.endswith(".srt"):
+        srt_filename += ".srt"
+
+    index_filename = get_transition_index_filename(srt_filename)
+    if os.path.exists(index_filename):
+        try:
+            header, labels, event_labels, start_index, start_ms, end_index, end_ms, frame_labels = read_index_arrays(index_filename)
+            if header.tolist() == [TRANSITION_INDEX_VERSION, rounding_ms] + determine_file_signature([srt_filename])[0]:
+                return TransitionIndex(rounding_ms, labels.tolist(), event_labels, start_index, start_ms, end_index, end_ms, frame_labels)
+        except ValueError:
+            # A broken index is simply built again
+            pass
+
+    transition_index = build_transition_index(parse_srt_file(srt_filename, rounding_ms, show_errors), rounding_ms)
+    try:
+        persist_transition_index(srt_filename, transition_index)
+    except OSError:
+        # The index cannot be replaced while it is still in use, in which case it will be stored the next time
+        pass
+    return transition_index
+
+# Returns the label ids of the first frames, frames after the last event continue with the label of the last event
+def get_frame_labels(transition_index: TransitionIndex, frame_count: int) -> np.array:
+    frame_labels = transition_index.frame_labels[:frame_count]
+    if len(frame_labels) < frame_count:
+        last_label = transition_index.event_labels[-1] if len(transition_index.event_labels) > 0 else 0
+        frame_labels = np.concatenate([frame_labels, np.full(frame_count - len(frame_labels), last_label, dtype=np.int16)])
+    return frame_labels
+
 def count_total_frames(label: str, base_folder: str, rounding_ms: int) -> int:
     frames = 0
     segments_dir = os.path.join(base_folder, "segments")
@@ -110,7 +208,7 @@ def count_total_frames(label: str, base_folder: str, rounding_ms: int) -> int:
             if srt_file.endswith(current_v_ending) and srt_file.replace(current_v_ending, manual_ending) in srt_files:
                 continue
             else:
-                frames += count_frames_in_srt(label, os.path.join(segments_dir, srt_file), rounding_ms)
+                frames += count_srt_statistics(os.path.join(segments_dir, srt_file), rounding_ms)["frames"].get(label, 0)
     return frames
     
 def count_total_silence_frames(base_folder: str, rounding_ms: int) -> int:
@@ -124,7 +222,7 @@ def count_total_silence_frames(base_folder: str, rounding_ms: int) -> int:
             if srt_file.endswith(current_v_ending) and srt_file.replace(current_v_ending, manual_ending) in srt_files:
                 continue
             else:
-                frames += count_frames_in_srt(BACKGROUND_LABEL, os.path.join(segments_dir, srt_file), rounding_ms)
+                frames += count_srt_statistics(os.path.join(segments_dir, srt_file), rounding_ms)["frames"].get(BACKGROUND_LABEL, 0)
     return frames
 
 def count_total_label_ms(label: str, base_folder: str, rounding_ms: int) -> int:
@@ -138,56 +236,50 @@ def count_total_label_ms(label: str, base_folder: str, rounding_ms: int) -> int:
             if srt_file.endswith(current_v_ending) and srt_file.replace(current_v_ending, manual_ending) in srt_files:
                 continue
             else:
-                total_ms += count_label_ms_in_srt(label, os.path.join(segments_dir, srt_file), rounding_ms)
+                total_ms += count_srt_statistics(os.path.join(segments_dir, srt_file), rounding_ms)["ms"].get(label, 0)
     return total_ms
 
+# Counts the frames and the milliseconds of every label inside of an SRT file at once
+# The counts are kept in the dataset manifest, so the SRT file is only parsed again after it has changed
+def count_srt_statistics(srt_filename: str, rounding_ms: int) -> dict:
+    def calculate_srt_statistics():
+        transition_index = load_transition_index(srt_filename, rounding_ms, False)
+        labels = [transition_index.labels[label_id] for label_id in np.unique(transition_index.event_labels)]
+        return {
+            "frames": {label: count_frames_in_index(label, transition_index) for label in labels},
+            "ms": {label: count_label_ms_in_index(label, transition_index) for label in labels},
+        }
+    return get_file_statistic(srt_filename, "srt_statistics_" + str(rounding_ms), calculate_srt_statistics)
+
 def count_label_ms_in_srt(label: str, srt_filename: str, rounding_ms: int) -> int:
-    transition_events = parse_srt_file(srt_filename, rounding_ms, False)
-    total_ms = 0
-    start_ms = -1
-    for transition_event in transition_events:
-        if transition_event.label == label:
-            start_ms = transition_event.start_ms
-        elif start_ms > -1 and transition_event.label != label:
-            total_ms += transition_event.start_ms - start_ms
-            start_ms = -1
-    
-    return total_ms
+    return count_label_ms_in_index(label, load_transition_index(srt_filename, rounding_ms, False))
+
+# Determines which events of a label are followed by an event of another label, only those are counted
+# When the same label occurs twice in a row, only the last of the two is counted
+def determine_closed_events(label: str, transition_index: TransitionIndex) -> np.array:
+    if label not in transition_index.labels:
+        return np.zeros(len(transition_index.event_labels), dtype=bool)
+    label_events = transition_index.event_labels == transition_index.labels.index(label)
+    return label_events & np.append(~label_events[1:], False)
+
+def count_label_ms_in_index(label: str, transition_index: TransitionIndex) -> int:
+    closed_events = determine_closed_events(label, transition_index)
+    return int(np.sum(transition_index.end_ms[closed_events] - transition_index.start_ms[closed_events]))
 
 def count_frames_in_srt(label: str, srt_filename: str, rounding_ms: int) -> int:
-    transition_events = parse_srt_file(srt_filename, rounding_ms, False)
-    start_ms = -1
-    frames = 0
-    for transition_event in transition_events:
-        if transition_event.label == label:
-            start_ms = transition_event.start_ms
-        elif start_ms > -1 and transition_event.label != label:
-            frames += round((transition_event.start_ms - start_ms - rounding_ms) / 15)
-            start_ms = -1
-    
-    return frames
+    return count_frames_in_index(label, load_transition_index(srt_filename, rounding_ms, False))
+
+def count_frames_in_index(label: str, transition_index: TransitionIndex) -> int:
+    closed_events = determine_closed_events(label, transition_index)
+    event_ms = transition_index.end_ms[closed_events] - transition_index.start_ms[closed_events]
+    return int(np.sum(np.round((event_ms - transition_index.rounding_ms) / 15)))
 
 def print_detection_performance_compared_to_srt(actual_frames: List[DetectionFrame], frames_to_read: int, srt_file_location: str, output_wave_file = None):
     ms_per_frame = actual_frames[0].duration_ms
-    transition_events = parse_srt_file(srt_file_location, ms_per_frame)
-    detection_audio_frames = []
-    total_ms = 0
-
-    # Detection states
-    detected_during_index = False
-    false_detections = 0    
-    
-    # Times of recognitions
-    total_occurrences = 0
-    false_recognitions = 0
-    positive_recognitions = 0
-    total_recognitions = 0
-    
-    # Statistics
-    ms_true_negative = 0
-    ms_true_positive = 0
-    ms_false_negative = 0
-    ms_false_positive = 0
+    transition_index = load_transition_index(srt_file_location, ms_per_frame)
+    event_starts = transition_index.start_index.tolist()
+    event_labels = transition_index.event_labels.tolist()
+    total_ms = len(actual_frames) * ms_per_frame
     
     false_types = {
         # Types of false negative recognitions
@@ -202,117 +294,96 @@ def print_detection_performance_compared_to_srt(actual_frames: List[DetectionFra
         "full_false_positive": [],
     }
     
-    # Loop over the results and compare them against the expected transition events
-    index = 0
-    t_index = 0
-
-    for frame in actual_frames:
-        index += 1
-        total_ms += ms_per_frame
-
-        # Determine expected label
-        actual = frame.label
-        expected = BACKGROUND_LABEL
-        transitioning = False
-        if t_index < len(transition_events):
-            if t_index + 1 < len(transition_events) and index >= transition_events[t_index + 1].start_index:
-                t_index += 1
-                transitioning = True
-                if transition_events[t_index].label != BACKGROUND_LABEL:
-                    total_occurrences += 1
-                # If the current label is a background label, we have just passed a full occurrence
-                # So check if it has been found during the occurrence
-                else:
-                    if detected_during_index:
-                        positive_recognitions += 1
-                    else:
-                        false_recognitions += 1
-                detected_during_index = False
-            expected = transition_events[t_index].label
-
-        # Add a WAVE signal for each false and true positive detections
-        if output_wave_file is not None:
-            highest_amp = 65536 / 10
-            signal_strength = highest_amp if actual != BACKGROUND_LABEL else 0
-            if expected != actual and actual != BACKGROUND_LABEL:
-                signal_strength = -highest_amp
-
-            detection_signal = np.full(int(frames_to_read / 4), int(signal_strength))
-            detection_signal[::2] = 0
-            detection_signal[::3] = 0
-            detection_signal[::5] = 0
-            detection_signal[::7] = 0
-            detection_signal[::9] = 0
-            detection_audio_frames.append( detection_signal )
-            
-        if expected == actual:
-            # Determine false detection types
-            if false_detections > 0:
-                false_index_start = index - false_detections
-                false_index_end = index
-
-                # Determine the amount of true events that have been miscategorized
-                current_event_index = t_index
-                first_index = t_index
-                while( false_index_start < transition_events[first_index].start_index ):
-                    first_index -= 1
-                    if first_index <= 0:
-                        first_index = 0
-                        break
-                        
-                for ei in range(first_index - 1, current_event_index): 
-                    event_index = ei + 1
-                    event = transition_events[event_index]
-                    event_start = event.start_index
-                    event_end = transition_events[event_index + 1].start_index if event_index + 1 < len(transition_events) else len(actual_frames) - 1
-                    
-                    false_event_type = ""
-                    ms_event = 0
-                    if false_index_start <= event_start:
-                        false_index_start = event_start
-
-                        # Misrecognition of the start of an event
-                        if false_index_end < event_end:
-                            ms_event = (false_index_end - false_index_start ) * ms_per_frame
-                            false_event_type = "late_stop" if event.label == BACKGROUND_LABEL else "lag"
-                        # Misrecognition of a complete event
-                        else:
-                             ms_event = ( event_end - false_index_start ) * ms_per_frame
-                             
-                             false_event_type = "missed_dip" if event.label == BACKGROUND_LABEL else "full_miss"
-                    elif false_index_start > event_start:
-                    
-                        # Misrecognition in between a full event
-                        if false_index_end < event_end:
-                            ms_event = ( false_index_end - false_index_start ) * ms_per_frame
-                            false_event_type = "full_false_positive" if event.label == BACKGROUND_LABEL else "stutter"                            
-                        # Misrecognition of the end of an event
-                        else:
-                            ms_event = (event_end - false_index_start) * ms_per_frame
-                            false_event_type = "false_start" if event.label == BACKGROUND_LABEL else "cutoff"
-                    
-                    if false_event_type in false_types and ms_event > 0:
-                        false_types[false_event_type].append( ms_event )
-
-                    # Reset the index to the start of the next event if the event can be followed by another false event
-                    if false_event_type in ["false_start", "cutoff", "full_miss", "full_false_positive"]:
-                        false_index_start = event_end
-
-                false_detections = 0
-
-            if expected != BACKGROUND_LABEL:
-                if detected_during_index == False:
-                    detected_during_index = True
-                ms_true_positive += ms_per_frame
-            else:
-                ms_true_negative += ms_per_frame
-        else:
-            # False detections are counted by the sum of their events            
-            false_detections += 1
+    # Every frame is compared against the label of the frame after it, with labels that do not occur in the SRT file given id -1
+    label_ids = {label: label_id for label_id, label in enumerate(transition_index.labels)}
+    actual = np.array([label_ids.get(frame.label, -1) for frame in actual_frames], dtype=np.int16)
+    expected = get_frame_labels(transition_index, len(actual_frames) + 1)[1:]
+    correct = expected == actual
+    frame_events = np.maximum(np.searchsorted(transition_index.start_index, np.arange(1, len(actual_frames) + 1), side="right") - 1, 0)
+
+    # An occurrence is found if it has been detected during any of its frames, which is checked when the next background event is reached
+    reached_events = np.arange(1, np.searchsorted(transition_index.start_index, len(actual_frames), side="right"))
+    total_occurrences = int(np.count_nonzero(transition_index.event_labels[reached_events] != 0))
+    detected_events = np.bincount(frame_events[correct & (expected != 0)], minlength=len(event_starts)) > 0
+    finished_occurrences = reached_events[transition_index.event_labels[reached_events] == 0] - 1
+    positive_recognitions = int(np.count_nonzero(detected_events[finished_occurrences])) if len(event_starts) > 0 else 0
+    false_recognitions = len(finished_occurrences) - positive_recognitions
     
+    ms_true_positive = int(np.count_nonzero(correct & (expected != 0))) * ms_per_frame
+    ms_true_negative = int(np.count_nonzero(correct & (expected == 0))) * ms_per_frame
+
+    # Add a WAVE signal for each false and true positive detections
     if output_wave_file is not None:
-        output_wave_file.writeframes(b''.join(detection_audio_frames))
+        highest_amp = 65536 / 10
+        signal_strengths = np.where(actual != 0, int(highest_amp), 0)
+        signal_strengths[~correct & (actual != 0)] = int(-highest_amp)
+
+        detection_signal = np.ones(int(frames_to_read / 4), dtype=int)
+        detection_signal[::2] = 0
+        detection_signal[::3] = 0
+        detection_signal[::5] = 0
+        detection_signal[::7] = 0
+        detection_signal[::9] = 0
+        output_wave_file.writeframes((signal_strengths[:, np.newaxis] * detection_signal).tobytes())
         output_wave_file.close()
+
+    # Determine false detection types for every sequence of false detections that ends in a correct detection
+    correct_frames = np.flatnonzero(correct)
+    false_detection_counts = np.diff(correct_frames, prepend=-1) - 1
+    if len(event_starts) == 0:
+        correct_frames = correct_frames[:0]
+    for correct_frame, false_detections in zip(correct_frames[false_detection_counts > 0].tolist(), false_detection_counts[false_detection_counts > 0].tolist()):
+        index = correct_frame + 1
+        t_index = int(frame_events[correct_frame])
+        false_index_start = index - false_detections
+        false_index_end = index
+
+        # Determine the amount of true events that have been miscategorized
+        current_event_index = t_index
+        first_index = t_index
+        while( false_index_start < event_starts[first_index] ):
+            first_index -= 1
+            if first_index <= 0:
+                first_index = 0
+                break
+                
+        for ei in range(first_index - 1, current_event_index): 
+            event_index = ei + 1
+            is_background = event_labels[event_index] == 0
+            event_start = event_starts[event_index]
+            event_end = event_starts[event_index + 1] if event_index + 1 < len(event_starts) else len(actual_frames) - 1
+            
+            false_event_type = ""
+            ms_event = 0
+            if false_index_start <= event_start:
+                false_index_start = event_start
+
+                # Misrecognition of the start of an event
+                if false_index_end < event_end:
+                    ms_event = (false_index_end - false_index_start ) * ms_per_frame
+                    false_event_type = "late_stop" if is_background else "lag"
+                # Misrecognition of a complete event
+                else:
+                     ms_event = ( event_end - false_index_start ) * ms_per_frame
+                     
+                     false_event_type = "missed_dip" if is_background else "full_miss"
+            elif false_index_start > event_start:
+            
+                # Misrecognition in between a full event
+                if false_index_end < event_end:
+                    ms_event = ( false_index_end - false_index_start ) * ms_per_frame
+                    false_event_type = "full_false_positive" if is_background else "stutter"                            
+                # Misrecognition of the end of an event
+                else:
+                    ms_event = (event_end - false_index_start) * ms_per_frame
+                    false_event_type = "false_start" if is_background else "cutoff"
+            
+            if false_event_type in false_types and ms_event > 0:
+                false_types[false_event_type].append( ms_event )
+
+            # Reset the index to the start of the next event if the event can be followed by another false event
+            if false_event_type in ["false_start", "cutoff", "full_miss", "full_false_positive"]:
+                false_index_start = event_end
     
     # Determine total time
     ms_false_positive = 0
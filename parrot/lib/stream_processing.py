@@ -4,8 +4,8 @@ from typing import List
 import wave
 import math
 import numpy as np
-from .signal_processing import determine_power, determine_dBFS, determine_log_mels, determine_euclidean_dist
-from .wav import resample_audio
+from .signal_processing import FrameAnalysis
+from .wav import read_wav_header, load_resampled_wav
 from .srt import persist_srt_file, print_detection_performance_compared_to_srt
 import os
 
@@ -13,11 +13,9 @@ snr_cutoff = 30
 
 def process_wav_file(input_file, srt_file, output_file, thresholds_file, labels, progress_callback = None, comparison_srt_file = None, override_file = None, print_statistics = False):
     audioFrames = []
-    wf = wave.open(input_file, 'rb')
-    number_channels = wf.getnchannels()
-    total_frames = wf.getnframes()
-    frame_rate = wf.getframerate()
-    frames_to_read = round( frame_rate * RECORD_SECONDS / SLIDING_WINDOW_AMOUNT )
+    header = read_wav_header(input_file)
+    number_channels = header["number_channels"]
+    frames_to_read = round( min(header["frame_rate"], RATE) * RECORD_SECONDS / SLIDING_WINDOW_AMOUNT )
     ms_per_frame = math.floor(RECORD_SECONDS / SLIDING_WINDOW_AMOUNT * 1000)
     sample_width = 2# 16 bit = 2 bytes
     
@@ -55,33 +53,26 @@ def process_wav_file(input_file, srt_file, output_file, thresholds_file, labels,
     if progress_callback is not None:
         progress_callback(0, detection_state)
     
-    while( wf.tell() < total_frames ):
+    # The whole file is resampled to our 16k Hz rate up front to make sure all the calculations stay accurate
+    # After which the chunks are read as views on the memory mapped audio
+    samples = load_resampled_wav(input_file, header)
+    total_chunks = len(samples) // frames_to_read
+    chunks = samples[:total_chunks * frames_to_read].reshape(total_chunks, frames_to_read)
+    for chunk_index, chunk in enumerate(chunks):
         index = index + 1
-        raw_wav = wf.readframes(frames_to_read * number_channels)
         detection_state.ms_recorded += ms_per_frame
         detected = False
         
-        # If our wav file is shorter than the amount of bytes ( assuming 16 bit ) times the frames, we discard it and assume we arrived at the end of the file
-        if (len(raw_wav) != 2 * frames_to_read * number_channels ):
-            break;        
-        
-        # Do online downsampling if the files frame rate is higher than our 16k Hz rate
-        # To make sure all the calculations stay accurate
-        raw_wav = resample_audio(raw_wav, frame_rate, number_channels)
-
-        audioFrames.append(raw_wav)
+        audioFrames.append(chunk.tobytes())
         audioFrames, detection_state, detection_frames, current_occurrence, false_occurrence = \
             process_audio_frame(index, audioFrames, detection_state, detection_frames, current_occurrence, false_occurrence)
         
-        # Convert from different byte sizes to 16bit for proper progress
-        progress = wf.tell() / total_frames
+        progress = ( chunk_index + 1 ) / total_chunks
         if progress_callback is not None and progress < 1:
             # For the initial pass we calculate 75% of the progress
             # This progress partitioning is completely arbitrary
             progress_callback(progress * 0.75, detection_state)
 
-    wf.close()
-    
     output_wave_file = wave.open(output_file, 'wb')
     output_wave_file.setnchannels(number_channels)
     output_wave_file.setsampwidth(sample_width)
@@ -265,13 +256,11 @@ def determine_detection_frame(index, detection_state, audioFrames, detection_fra
     if( len( audioFrames ) >= SLIDING_WINDOW_AMOUNT ):
         audioFrames = audioFrames[-SLIDING_WINDOW_AMOUNT:]
         
-        byteString = b''.join(audioFrames)
-        wave_data = np.frombuffer( byteString, dtype=np.int16 )
-        power = determine_power( wave_data )
-        dBFS = determine_dBFS( wave_data )
-
-        log_mels = determine_log_mels( wave_data, RATE )
-        spectral_flux = determine_euclidean_dist( log_mels, True )
+        frame_analysis = FrameAnalysis( audioFrames, RATE, RECORD_SECONDS )
+        power = frame_analysis.power
+        dBFS = frame_analysis.dBFS
+        log_mels = frame_analysis.log_mels
+        spectral_flux = frame_analysis.spectral_flux
         onset_detected = detect_onset( index, dBFS, spectral_flux, detection_state, detection_frames )
         
         # Attempt to detect a label
@@ -6,8 +6,12 @@ pyautogui.FAILSAFE = False
 import joblib
 import numpy as np
 import copy
+import json
+import os
+import uuid
 import torch
-from lib.audio_net import TinyAudioNet, TinyAudioNetEnsemble
+from lib.audio_net import TinyAudioNet, TinyAudioNetEnsemble, FusedTinyAudioNetEnsemble
+from lib.numpy_classifier import NumpyTinyAudioNetEnsemble
 
 torch.set_num_threads(1)
 torch.backends.cudnn.benchmark = True
@@ -19,6 +23,7 @@ class TorchEnsembleClassifier:
     
     classifiers = {}
     combinedClassifier = None
+    quantized = False
             
     # A list of all the available classes which will be used as a starting point
     # When a prediction is made without this map having the key, it will not be added
@@ -30,40 +35,102 @@ class TorchEnsembleClassifier:
         self.device = torch.device('cpu')
         classifierArray = []
         for index, key in enumerate(classifier_map):
-            state_dict = torch.load(classifier_map[key], map_location=self.device)
+            # Checkpoints that are still in memory during training can be used directly instead of their filenames
+            if isinstance(classifier_map[key], dict):
+                state_dict = classifier_map[key]
+            else:
+                state_dict = torch.load(classifier_map[key], map_location=self.device)
             self.classes_ = state_dict['labels']
             if ('input_size' in state_dict):
                 input_size = state_dict['input_size']
             model = TinyAudioNet(input_size, len(state_dict['labels']))
             model.load_state_dict(state_dict['state_dict'])
             model.to( self.device )
-            model.double()
             model.eval()
             self.classifiers[key] = model
             classifierArray.append( key )
-        self.combinedClassifier = TinyAudioNetEnsemble( list(self.classifiers.values()) )
-        self.combinedClassifier.eval()
-        self.combinedClassifier.to( self.device )
+        self.combinedClassifier = self.create_combined_classifier()
+
+    # The members are evaluated together in a single float32 graph rather than one after the other
+    # Quantized members can only be evaluated one after the other, as the fused ensemble only works with float32 weights
+    def create_combined_classifier( self ):
+        if ( self.quantized ):
+            combinedClassifier = TinyAudioNetEnsemble( list(self.classifiers.values()) )
+        else:
+            combinedClassifier = FusedTinyAudioNetEnsemble( [model.state_dict() for model in self.classifiers.values()] )
+        combinedClassifier.eval()
+        return combinedClassifier
+
+    # Returns a copy of this classifier with the linear layers of all the members dynamically quantized to int8
+    # The weights are stored as int8, while the inputs of every layer are quantized as they come in
+    def quantize( self ):
+        quantized_classifier = copy.copy( self )
+        quantized_classifier.classifiers = {}
+        for key, model in self.classifiers.items():
+            quantized_classifier.classifiers[key] = torch.ao.quantization.quantize_dynamic( model, {torch.nn.Linear}, dtype=torch.qint8 )
+        quantized_classifier.quantized = True
+        quantized_classifier.torchscript_id = None
+        quantized_classifier.combinedClassifier = quantized_classifier.create_combined_classifier()
+        return quantized_classifier
+
+    # Returns a version of this ensemble that runs with numpy only, which is not possible for quantized members
+    def create_numpy_classifier( self ):
+        if ( self.quantized ):
+            return None
+        state_dicts = []
+        for model in self.classifiers.values():
+            state_dicts.append( {key: value.detach().cpu().double().numpy() for key, value in model.state_dict().items()} )
+        return NumpyTinyAudioNetEnsemble( list(self.classes_), state_dicts )
+
+    # The combined classifier is made again from the members when the classifier is loaded
+    # This also upgrades models that were saved with the members evaluated one after the other in float64
+    def __getstate__( self ):
+        state = self.__dict__.copy()
+        state.pop( 'combinedClassifier', None )
+        return state
+
+    def __setstate__( self, state ):
+        self.__dict__.update( state )
+        self.combinedClassifier = self.create_combined_classifier()
+
+    # Saves the fused ensemble as TorchScript, with an identifier that is also kept in this classifier
+    # So an export that does not belong to the saved classifier, for instance after retraining, is never loaded
+    # Quantized classifiers are not exported, and an older export with the same filename is removed
+    def export_torchscript( self, filename ):
+        if ( self.quantized ):
+            if ( os.path.exists( filename ) ):
+                os.remove( filename )
+            return
+
+        self.torchscript_id = uuid.uuid4().hex
+        extra_files = {'parrot.json': json.dumps( {'id': self.torchscript_id, 'labels': list(self.classes_)} )}
+        torch.jit.save( torch.jit.script( self.create_combined_classifier() ), filename + ".tmp", _extra_files=extra_files )
+        os.replace( filename + ".tmp", filename )
+
+    # Replaces the fused ensemble with its exported TorchScript version, if it belongs to this classifier
+    def load_torchscript( self, filename ):
+        if ( getattr( self, 'torchscript_id', None ) is None or not os.path.exists( filename ) ):
+            return False
+
+        extra_files = {'parrot.json': ''}
+        combinedClassifier = torch.jit.load( filename, map_location=self.device, _extra_files=extra_files )
+        if ( json.loads( extra_files['parrot.json'] )['id'] != self.torchscript_id ):
+            return False
+        combinedClassifier.eval()
+        self.combinedClassifier = combinedClassifier
+        return True
                                     
     # Predict the probabilities of the given data array
+    # All the rows are predicted in a single pass
     def predict_proba( self, data ):
-        predictions = []
-        for data_row in data:
-            predictions.append( self.predict_single_proba(data_row) )
+        data = torch.from_numpy( np.asarray( data, dtype=np.float32 ) ).to( self.device )
+        with torch.no_grad():
+            probabilities = self.combinedClassifier( data ).cpu()
                 
-        return np.asarray( predictions )
+        return probabilities.numpy().astype( np.float64 )
             
     # Predict a single data row
     # This will ask all the classifiers for a prediction
     # The one with the highest prediction wins
     def predict_single_proba( self, data_row ):
-        #reshaped_input = np.reshape(data_row, (-1, 13))
-        data_row = torch.from_numpy(np.asarray([data_row])).double()#.unsqueeze(0)
-        data_row = data_row.to( self.device )
-        totalProbabilities = []
-        
-        with torch.no_grad():
-            type = None
-            totalProbabilities = self.combinedClassifier( data_row ).cpu()
-            
-        return np.asarray( totalProbabilities[0], dtype=np.float64 )
\ No newline at end of file
+        return self.predict_proba( [data_row] )[0]
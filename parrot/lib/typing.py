@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from typing import List
+import numpy as np
 
 @dataclass
 class TransitionEvent:
@@ -7,6 +8,20 @@ class TransitionEvent:
     start_index: int
     start_ms: int
 
+# The transition events of an SRT file stored as arrays, together with the label id of every frame
+# The label ids point into the labels list, in which the background label always has id 0
+# The last event lasts until the end of the recording, so its end is stored as -1
+@dataclass
+class TransitionIndex:
+    rounding_ms: int
+    labels: List[str]
+    event_labels: np.ndarray
+    start_index: np.ndarray
+    start_ms: np.ndarray
+    end_index: np.ndarray
+    end_ms: np.ndarray
+    frame_labels: np.ndarray
+
 @dataclass
 class DetectionFrame:
     index: int
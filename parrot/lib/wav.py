@@ -1,15 +1,19 @@
 import wave
-from config.config import BACKGROUND_LABEL, RECORD_SECONDS, SLIDING_WINDOW_AMOUNT, RATE, TYPE_FEATURE_ENGINEERING_NORM_MFSC, PYTORCH_AVAILABLE
-from lib.machinelearning import feature_engineering_raw
-from .srt import parse_srt_file
+from config.config import BACKGROUND_LABEL, RECORD_SECONDS, SLIDING_WINDOW_AMOUNT, RATE, TYPE_FEATURE_ENGINEERING_NORM_MFSC, PYTORCH_AVAILABLE, FEATURE_CACHE_ENABLED, FEATURE_CACHE_AUGMENTED, AUGMENT_DURING_TRAINING
+from lib.machinelearning import feature_engineering_batch
+from .srt import load_transition_index
+from .augmentation import WaveAugmenter
+from .typing import TransitionIndex
+from .dataset_manifest import get_file_statistic
+from .feature_cache import load_cached_features, persist_cached_features, get_resampled_filename, persist_resampled_audio
 import numpy as np
+from scipy.signal import resample_poly
 import audioop
+import struct
 from typing import List
 import os
 import time
 import math
-if (PYTORCH_AVAILABLE == True):
-    from audiomentations import Compose, AddGaussianNoise, Shift, TimeStretch
 
 # Resamples the audio down to 16kHz ( or any other RATE filled in )
 # To make sure all the other calculations are stable and correct
@@ -21,6 +25,77 @@ def resample_audio(wavData: np.array, frame_rate, number_channels) -> np.array:
             wavData = audioop.tomono(wavData[0], 2, 1, 0)
     return wavData
 
+# Reads the format of a WAV file and the location of its PCM data
+# The total frames are the amount of frames reported by the header, which can be more than the frames that are actually stored
+def read_wav_header(filename: str) -> dict:
+    with open(filename, 'rb') as f:
+        riff_id, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff_id != b'RIFF' or wave_id != b'WAVE':
+            raise wave.Error('file does not start with RIFF id')
+        
+        header = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise wave.Error('data chunk missing in ' + filename)
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                _, number_channels, frame_rate, _, _, bits_per_sample = struct.unpack('<HHIIHH', f.read(16))
+                header = {"number_channels": number_channels, "frame_rate": frame_rate, "sample_width": (bits_per_sample + 7) // 8}
+                f.seek(chunk_size - 16 + (chunk_size & 1), 1)
+            elif chunk_id == b'data':
+                if header is None:
+                    raise wave.Error('data chunk before fmt chunk in ' + filename)
+                frame_size = header["number_channels"] * header["sample_width"]
+                header["data_offset"] = f.tell()
+                header["total_frames"] = chunk_size // frame_size
+                header["available_frames"] = min(chunk_size, os.path.getsize(filename) - header["data_offset"]) // frame_size
+                return header
+            else:
+                f.seek(chunk_size + (chunk_size & 1), 1)
+
+# Memory maps the PCM data of a 16 bit WAV file as an ( frames, channels ) array, without reading it into memory
+def load_wav_samples(filename: str, header: dict = None) -> np.array:
+    if header is None:
+        header = read_wav_header(filename)
+    if header["sample_width"] != 2:
+        raise wave.Error('only 16 bit WAV files are supported, ' + filename + ' uses ' + str(header["sample_width"] * 8) + ' bits')
+    
+    shape = (header["available_frames"], header["number_channels"])
+    if header["available_frames"] == 0:
+        return np.zeros(shape, dtype=np.int16)
+    return np.memmap(filename, dtype='<i2', mode='r', offset=header["data_offset"], shape=shape)
+
+# Returns the audio of a WAV file at our RATE as a one dimensional int16 array
+# Files with multiple channels are mixed down to mono by averaging their channels
+# Files with a higher frame rate are resampled as a whole using a polyphase filter, rather than in small chunks
+# The resampled audio is kept in the feature cache, so it only has to be calculated once per recording
+def load_resampled_wav(filename: str, header: dict = None) -> np.array:
+    if header is None:
+        header = read_wav_header(filename)
+    samples = load_wav_samples(filename, header)
+    if header["number_channels"] == 1:
+        samples = samples[:, 0]
+    else:
+        samples = np.round(samples.mean(axis=1, dtype=np.float32)).astype(np.int16)
+    if header["frame_rate"] <= RATE:
+        return samples
+    
+    if FEATURE_CACHE_ENABLED:
+        resampled_filename = get_resampled_filename(filename, RATE)
+        if os.path.exists(resampled_filename):
+            try:
+                return np.load(resampled_filename, mmap_mode='r')
+            except (ValueError, OSError):
+                pass
+
+    common_divisor = math.gcd(RATE, header["frame_rate"])
+    resampled = resample_poly(samples.astype(np.float32), RATE // common_divisor, header["frame_rate"] // common_divisor)
+    resampled = np.clip(np.round(resampled), -32768, 32767).astype(np.int16)
+    if FEATURE_CACHE_ENABLED:
+        resampled = persist_resampled_audio(resampled_filename, resampled)
+    return resampled
+
 def load_wav_files_with_srts( directories, label, int_label, start, end, input_type ):
     category_dataset_x = []
     category_dataset_labels = []
@@ -68,69 +143,333 @@ def load_wav_files_with_srts( directories, label, int_label, start, end, input_t
         print( "Loaded " + str( len( category_dataset_labels ) ) + " .wav files for category " + label + " (id: " + str(int_label) + ")" )
     return category_dataset_x, category_dataset_labels, totalFeatureEngineeringTime
 
-def augment_wav_data(wavData, sample_rate):
-    augmenter = Compose([
-        AddGaussianNoise(min_amplitude=0.001, max_amplitude=0.015, p=0.5),
-        TimeStretch(min_rate=0.8, max_rate=1.25, p=0.5),
-        Shift(p=0.5),
-    ])
-    return augmenter(samples=np.array(wavData, dtype="float32"), sample_rate=sample_rate)
-
 def load_wav_data_from_srt(srt_file: str, source_file: str, feature_engineering_type = TYPE_FEATURE_ENGINEERING_NORM_MFSC, with_offset = True, should_augment=False, background=False) -> List[List[float]]:
-    wav_file_data = []
-    wf = wave.open(source_file, 'rb')
-    frame_rate = wf.getframerate()
-    number_channels = wf.getnchannels()
-    total_frames = wf.getnframes()
-    frames_to_read = round( frame_rate * RECORD_SECONDS / SLIDING_WINDOW_AMOUNT )    
-    ms_per_frame = math.floor(RECORD_SECONDS / SLIDING_WINDOW_AMOUNT * 1000)
-    
-    # If offsets are required - We seek half a frame behind the expected frame to get more data from a different location
+    if not FEATURE_CACHE_ENABLED:
+        return extract_wav_data_from_srt(srt_file, source_file, feature_engineering_type, with_offset, should_augment, background)
+
+    variant = ("background" if background else "label") + ("_augmented" if should_augment and PYTORCH_AVAILABLE else "")
+    if not is_cached_variant(variant):
+        return extract_wav_data_from_srt(srt_file, source_file, feature_engineering_type, with_offset, should_augment, background)
+
+    wav_file_data = load_cached_features(source_file, srt_file, feature_engineering_type, variant, with_offset)
+    if wav_file_data is None:
+        wav_file_data = persist_cached_features(source_file, srt_file, feature_engineering_type, variant, with_offset,
+            extract_wav_data_from_srt(srt_file, source_file, feature_engineering_type, with_offset, should_augment, background))
+    return wav_file_data
+
+def extract_wav_data_from_srt(srt_file: str, source_file: str, feature_engineering_type = TYPE_FEATURE_ENGINEERING_NORM_MFSC, with_offset = True, should_augment=False, background=False) -> np.array:
+    chunk_views, [(window_chunks, _)] = read_srt_windows(srt_file, source_file, [(with_offset, background)])
+    wave_windows = gather_windows(chunk_views, window_chunks)
+    if should_augment and PYTORCH_AVAILABLE:
+        return augmented_feature_engineering_batch(wave_windows, feature_engineering_type)
+    return feature_engineering_batch(wave_windows, RATE, feature_engineering_type)
+
+# A new augmenter is seeded for every call when none is given, so worker processes never share the same random stream
+def augmented_feature_engineering_batch(wave_windows: np.array, feature_engineering_type, augmenter: WaveAugmenter = None) -> np.array:
+    if augmenter is None:
+        augmenter = WaveAugmenter()
+    return feature_engineering_batch(augmenter.augment_batch(wave_windows), RATE, feature_engineering_type)
+
+# Augmented features are only kept in the feature cache when FEATURE_CACHE_AUGMENTED is turned on
+# Otherwise they are calculated again from the cached audio every time they are loaded, so every training run gets new augmentations
+def is_cached_variant(variant: str) -> bool:
+    return FEATURE_CACHE_AUGMENTED or not variant.endswith("_augmented")
+
+# The kind of windows a cache variant is made from, either the label, background or augmented label windows
+def determine_sample_type(variant: str) -> str:
+    return "augmented" if variant == "label_augmented" else variant.split("_")[0]
+
+# The sample streams that are used during training for every source file
+# Mapped to the cache variant and offset used by load_wav_data_from_srt
+# When augmenting during training, the augmented streams contain the audio of the windows instead of their features
+def determine_sample_streams(with_offset = True):
+    augmented_variant = "label"
+    background_augmented_variant = "background"
+    if PYTORCH_AVAILABLE and AUGMENT_DURING_TRAINING:
+        augmented_variant = "label_wave"
+        background_augmented_variant = "background_wave"
+    elif PYTORCH_AVAILABLE:
+        augmented_variant = "label_augmented"
+
+    return {
+        "label": ("label", with_offset),
+        "augmented": (augmented_variant, with_offset),
+        "background": ("background", False),
+        "background_augmented": (background_augmented_variant, True),
+    }
+
+# Loads all the sample streams of a source file at once, reading and resampling the audio only a single time
+# Which gives the same results as calling load_wav_data_from_srt for every stream separately
+# When selections are given, only the selected windows of a stream are returned, in the order of their indices
+def load_wav_streams_from_srt(srt_file: str, source_file: str, feature_engineering_type = TYPE_FEATURE_ENGINEERING_NORM_MFSC, with_offset = True, selections: dict = None) -> dict:
+    # Without a cache to fill, only the features of the selected windows need to be calculated
+    if not FEATURE_CACHE_ENABLED:
+        return extract_selected_wav_streams_from_srt(srt_file, source_file, feature_engineering_type, with_offset, selections)
+
+    # Every window of the cached streams is stored, even when only a part of them is selected
+    # So a later training run that selects different windows can still read them from the cache
+    streams = load_cached_wav_streams_from_srt(srt_file, source_file, feature_engineering_type, with_offset)
+
+    # Streams that are not kept in the cache, like the augmented features, are extracted for the selected windows
+    missing_keys = [key for key, features in streams.items() if features is None]
+    streams = select_stream_windows({key: features for key, features in streams.items() if features is not None}, selections)
+    if len(missing_keys) > 0:
+        streams.update(extract_selected_wav_streams_from_srt(srt_file, source_file, feature_engineering_type, with_offset, selections, missing_keys))
+    return streams
+
+# Loads all the sample streams of a source file from the feature cache as memory mapped arrays
+# Filling the cache first if any of the streams is missing
+# Streams of variants that are not cached are returned as None, unless persist_augmented is given
+# In which case their shards are calculated and written again on every call, so streamed datasets have a shard to read with new augmentations
+def load_cached_wav_streams_from_srt(srt_file: str, source_file: str, feature_engineering_type = TYPE_FEATURE_ENGINEERING_NORM_MFSC, with_offset = True, persist_augmented = False) -> dict:
+    sample_streams = determine_sample_streams(with_offset)
+    streams = {}
+    for key, (variant, stream_offset) in sample_streams.items():
+        streams[key] = load_cached_features(source_file, srt_file, feature_engineering_type, variant, stream_offset) if is_cached_variant(variant) else None
+    missing_types = [determine_sample_type(variant) for key, (variant, _) in sample_streams.items() 
+        if streams[key] is None and (is_cached_variant(variant) or persist_augmented)]
+    if len(missing_types) == 0:
+        return streams
+
+    # Every window of the missing sample types is extracted to fill the cache
+    # And the variants of both offsets are persisted, so a change in the oversampling strategy of a label can still use the cache
+    extracted_streams = extract_wav_streams_from_srt(srt_file, source_file, feature_engineering_type, set(missing_types))
+    for (variant, stream_offset), features in extracted_streams.items():
+        extracted_streams[(variant, stream_offset)] = persist_cached_features(source_file, srt_file, feature_engineering_type, variant, stream_offset, features)
+
+    for key, stream_key in sample_streams.items():
+        if streams[key] is None and stream_key in extracted_streams:
+            streams[key] = extracted_streams[stream_key]
+    return streams
+
+def select_stream_windows(streams: dict, selections: dict = None) -> dict:
+    if selections is None:
+        return streams
+    return {key: features[selections[key]] if key in selections else features for key, features in streams.items()}
+
+# Determines the chunk positions of every window that extract_wav_data_from_srt would read
+# Including the windows that are stitched together from the last chunk before the offset and the first chunk after it
+# The windows are returned together with a mask that marks the windows read during the half frame offset pass
+# The total frames is the amount given in the WAV header, while the available frames are the frames that can actually be read
+def plan_srt_windows(transition_index: TransitionIndex, total_frames: int, available_frames: int, frames_to_read: int, number_channels: int, sample_width: int, with_offset = True, background = False) -> tuple:
     halfframe_offset = round( frames_to_read * number_channels * 0.5 )
     start_offsets = [0, -halfframe_offset] if with_offset else [0]
+    frames_per_read = frames_to_read * number_channels
+
+    # The events are selected with a mask, after which the chunks of all the events are laid out at once
+    selected_events = np.flatnonzero((transition_index.event_labels == 0) == background)
+    is_last_event = selected_events + 1 >= len(transition_index.start_index)
+    event_positions = frames_to_read * transition_index.start_index[selected_events]
+    next_event_positions = np.where(is_last_event, total_frames / frames_to_read, transition_index.end_index[selected_events]) * frames_to_read
+
+    # The chunks of the previous pass are kept, so the first window of the offset pass is stitched together with them
+    previous_chunk_counts = np.zeros(len(selected_events), dtype=np.int64)
+    previous_last_positions = np.zeros(len(selected_events), dtype=np.int64)
+    window_chunks = []
+    window_order = []
+    for pass_index, offset in enumerate(start_offsets):
+        events = np.flatnonzero(event_positions + offset >= 0)
+        if len(events) == 0:
+            continue
+        start_positions = event_positions[events] + offset
+        end_positions = next_event_positions[events] + offset
+
+        # Windows keep being read until the next event has been reached, but at least one full window is read for every event
+        first_window_chunks = np.maximum(0, SLIDING_WINDOW_AMOUNT - 1 - previous_chunk_counts[events])
+        chunk_counts = np.maximum(first_window_chunks + 1, np.ceil((end_positions - start_positions) / frames_per_read).astype(np.int64) + 1)
+        segment_starts = np.cumsum(chunk_counts) - chunk_counts
+        chunk_events = np.repeat(np.arange(len(events)), chunk_counts)
+        chunk_indices = np.arange(len(chunk_events)) - segment_starts[chunk_events]
+        positions = start_positions[chunk_events] + frames_per_read * chunk_indices
+
+        # Reached the end of wav - do not keep collecting
+        read_bytes = np.minimum(frames_per_read, np.maximum(0, available_frames - positions)) * number_channels * sample_width
+        reached_end = (positions + frames_per_read >= end_positions[chunk_events]) & (chunk_indices >= first_window_chunks[chunk_events])
+        unreadable = read_bytes != SLIDING_WINDOW_AMOUNT * frames_to_read * number_channels
+        last_chunks = np.minimum(np.minimum.reduceat(np.where(reached_end, chunk_indices, chunk_counts[chunk_events]), segment_starts),
+            np.minimum.reduceat(np.where(unreadable, chunk_indices, chunk_counts[chunk_events]), segment_starts) - 1)
+
+        # Every window ends at a chunk of this pass, earlier chunks come from the previous pass if they lie before the start
+        window_counts = np.maximum(0, last_chunks - first_window_chunks + 1)
+        window_events = np.repeat(np.arange(len(events)), window_counts)
+        last_window_chunks = first_window_chunks[window_events] + np.arange(len(window_events)) - (np.cumsum(window_counts) - window_counts)[window_events]
+        relative_chunks = last_window_chunks[:, np.newaxis] - ( SLIDING_WINDOW_AMOUNT - 1 ) + np.arange(SLIDING_WINDOW_AMOUNT)[np.newaxis, :]
+        window_chunks.append(np.where(relative_chunks >= 0, start_positions[window_events][:, np.newaxis] + frames_per_read * relative_chunks,
+            previous_last_positions[events][window_events][:, np.newaxis] + frames_per_read * (relative_chunks + 1)))
+        window_order.append(np.stack([events[window_events], np.full(len(window_events), pass_index), last_window_chunks]))
+
+        read_events = last_chunks >= 0
+        previous_chunk_counts[events[read_events]] = np.minimum(SLIDING_WINDOW_AMOUNT, previous_chunk_counts[events[read_events]] + last_chunks[read_events] + 1)
+        previous_last_positions[events[read_events]] = start_positions[read_events] + frames_per_read * last_chunks[read_events]
+
+    if len(window_chunks) == 0:
+        return np.zeros((0, SLIDING_WINDOW_AMOUNT), dtype=np.int64), np.zeros(0, dtype=bool)
+
+    # Order the windows by event, with the windows of the offset pass following the regular windows of the same event
+    window_order = np.concatenate(window_order, axis=1)
+    order = np.lexsort((window_order[2], window_order[1], window_order[0]))
+    return np.concatenate(window_chunks)[order], (np.array(start_offsets)[window_order[1]] != 0)[order]
+
+# Determines the windows of an SRT file for every given ( with_offset, background ) plan without reading any audio
+# The windows are returned as the chunk positions in frames of the source file
+# Together with a mask that marks the windows read during the half frame offset pass
+def plan_srt_file(srt_file: str, source_file: str, plans: List, header: dict = None, warn_empty = True) -> tuple:
+    if header is None:
+        header = read_wav_header(source_file)
+    frames_to_read = round( header["frame_rate"] * RECORD_SECONDS / SLIDING_WINDOW_AMOUNT )
+    ms_per_frame = math.floor(RECORD_SECONDS / SLIDING_WINDOW_AMOUNT * 1000)
     
-    transition_events = parse_srt_file(srt_file, ms_per_frame)
-    if len(transition_events) < 2:
+    transition_index = load_transition_index(srt_file, ms_per_frame)
+    if len(transition_index.start_index) < 2 and warn_empty:
         print( "Empty .SRT file for " + source_file + " - Consider deleting " + srt_file + " to resegment the audio file" )
-        
-    for index, transition_event in enumerate(transition_events):
-        next_event_index = total_frames / frames_to_read if index + 1 >= len(transition_events) else transition_events[index + 1].start_index
-        audioFrames = []
-        
-        if (transition_event.label == BACKGROUND_LABEL) == background:
-            
-            for offset in start_offsets:
-                # Skip of the offset makes the position before the start of the file
-                if offset + (frames_to_read * transition_event.start_index) < 0:
-                    continue;
-                wf.setpos(offset + (frames_to_read * transition_event.start_index))
-            
-                keep_collecting = True
-                while keep_collecting:
-                    try:
-                        raw_wav = wf.readframes(frames_to_read * number_channels)
-                    except RuntimeError:
-                        raw_wav = ""
-                        print( "Error loading in all of the .SRT file for " + source_file + " - Consider deleting " + srt_file + " to resegment the audio file" )
-                        keep_collecting = False
-
-                    # Reached the end of wav - do not keep collecting
-                    if (len(raw_wav) != SLIDING_WINDOW_AMOUNT * frames_to_read * number_channels ):
-                        keep_collecting = False
-                        break
-                        
-                    raw_wav = resample_audio(raw_wav, frame_rate, number_channels)                    
-                    audioFrames.append(raw_wav)
-                    if( len( audioFrames ) >= SLIDING_WINDOW_AMOUNT ):
-                        audioFrames = audioFrames[-SLIDING_WINDOW_AMOUNT:]
-                
-                        byteString = b''.join(audioFrames)
-                        wave_data = np.frombuffer( byteString, dtype=np.int16 )
-                        if should_augment and PYTORCH_AVAILABLE:
-                            wave_data = augment_wav_data(wave_data, RATE)
-                        wav_file_data.append( feature_engineering_raw(wave_data, RATE, 0, RECORD_SECONDS, feature_engineering_type)[0] )
-                    
-                        if wf.tell() >= ( next_event_index * frames_to_read ) + offset:
-                            keep_collecting = False
+
+    return [plan_srt_windows(transition_index, header["total_frames"], header["available_frames"], frames_to_read,
+        header["number_channels"], header["sample_width"], with_offset, background) for with_offset, background in plans]
+
+# Determines the windows of an SRT file for every given ( with_offset, background ) plan
+# The windows are returned as the chunk indices of a strided view over the resampled audio, so no audio is copied until the windows are used
+# Together with a mask that marks the windows read during the half frame offset pass
+def read_srt_windows(srt_file: str, source_file: str, plans: List) -> tuple:
+    header = read_wav_header(source_file)
+    planned_windows = plan_srt_file(srt_file, source_file, plans, header)
+
+    # Chunk positions are planned in frames of the source file and then mapped onto the resampled audio
+    samples = load_resampled_wav(source_file, header)
+    if header["frame_rate"] > RATE:
+        chunk_size = round( RATE * RECORD_SECONDS / SLIDING_WINDOW_AMOUNT )
+        position_ratio = RATE / header["frame_rate"]
+    else:
+        chunk_size = round( header["frame_rate"] * RECORD_SECONDS / SLIDING_WINDOW_AMOUNT )
+        position_ratio = 1
+    if len(samples) < chunk_size:
+        samples = np.zeros(chunk_size, dtype=np.int16)
+    chunk_views = np.lib.stride_tricks.sliding_window_view(samples, chunk_size)
+
+    planned_windows = [(np.minimum(np.round(window_chunks * position_ratio).astype(np.int64), len(chunk_views) - 1), offset_mask)
+        for window_chunks, offset_mask in planned_windows]
+    return chunk_views, planned_windows
+
+# Counts the windows of every sample stream of a source file, which only requires its header and its SRT file
+# The window counts are kept in the dataset manifest, so they are only counted again after either file has changed
+def count_srt_streams(srt_file: str, source_file: str, with_offset = True) -> dict:
+    def calculate_window_counts():
+        [(_, label_offsets), (_, background_offsets)] = plan_srt_file(srt_file, source_file, [(True, False), (True, True)], warn_empty=False)
+        return {
+            "label": [len(label_offsets), int(np.count_nonzero(~label_offsets))],
+            "background": [len(background_offsets), int(np.count_nonzero(~background_offsets))],
+        }
+    settings_key = "_".join([str(RATE), str(RECORD_SECONDS), str(SLIDING_WINDOW_AMOUNT)])
+    window_counts = get_file_statistic([srt_file, source_file], "window_counts_" + settings_key, calculate_window_counts)
+
+    stream_counts = {}
+    for key, (variant, stream_offset) in determine_sample_streams(with_offset).items():
+        offset_count, regular_count = window_counts["background"] if variant.startswith("background") else window_counts["label"]
+        stream_counts[key] = offset_count if stream_offset else regular_count
+    return stream_counts
+
+# Maps every window of a stream without offsets onto the window read half a frame earlier in the same stream with offsets
+# The windows of the offset pass follow the regular windows of the same event, so the offset windows of an event are the run right after its regular windows
+# Returns the row of the offset variant in the stream with offsets for every regular window, or -1 if its event has no offset windows
+def determine_offset_windows(srt_file: str, source_file: str, background = False) -> np.array:
+    [(_, offset_mask)] = plan_srt_file(srt_file, source_file, [(True, background)], warn_empty=False)
+    if len(offset_mask) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    run_starts = np.concatenate([[0], np.flatnonzero(offset_mask[1:] != offset_mask[:-1]) + 1])
+    run_lengths = np.diff(np.append(run_starts, len(offset_mask)))
+    regular_rows = np.flatnonzero(~offset_mask)
+    regular_runs = np.repeat(np.arange(len(run_starts)), run_lengths)[regular_rows]
+    offset_runs = np.minimum(regular_runs + 1, len(run_starts) - 1)
+    has_offset = (regular_runs + 1 < len(run_starts)) & offset_mask[run_starts[offset_runs]]
+    offset_rows = run_starts[offset_runs] + np.minimum(regular_rows - run_starts[regular_runs], run_lengths[offset_runs] - 1)
+    return np.where(has_offset, offset_rows, -1)
+
+# Copies the chunks of every window next to each other into an ( windows, window size ) array
+def gather_windows(chunk_views: np.array, window_chunks: np.array) -> np.array:
+    return chunk_views[window_chunks].reshape(len(window_chunks), window_chunks.shape[1] * chunk_views.shape[1])
+
+# Calculates the features for several lists of windows at once
+# Windows that are shared between the lists only have their features calculated once
+def featurize_unique_windows(chunk_views: np.array, window_chunk_lists: List, feature_engineering_type) -> List:
+    unique_chunks, window_indices = np.unique(np.concatenate(window_chunk_lists), axis=0, return_inverse=True)
+    window_indices = window_indices.reshape(-1)
+    unique_features = feature_engineering_batch(gather_windows(chunk_views, unique_chunks), RATE, feature_engineering_type)
+    if len(unique_features) == 0:
+        unique_features = np.zeros( (0, 0), dtype=np.float32 )
+
+    features = []
+    start = 0
+    for window_chunks in window_chunk_lists:
+        features.append(unique_features[window_indices[start:start + len(window_chunks)]])
+        start += len(window_chunks)
+    return features
+
+# Extracts the label, augmented and background samples of a source file in a single pass
+# Returns the features for both the regular and the half frame offset variants of every stream, keyed by their cache variant and offset
+# Only the variants of the given sample types are extracted
+def extract_wav_streams_from_srt(srt_file: str, source_file: str, feature_engineering_type = TYPE_FEATURE_ENGINEERING_NORM_MFSC, sample_types = ("label", "background", "augmented")) -> dict:
+    read_types = [sample_type for sample_type in ["label", "background"] if sample_type in sample_types or (sample_type == "label" and "augmented" in sample_types)]
+    chunk_views, planned_windows = read_srt_windows(srt_file, source_file, [(True, sample_type == "background") for sample_type in read_types])
+    windows = dict(zip(read_types, planned_windows))
+
+    streams = {}
+    featurized_types = [sample_type for sample_type in read_types if sample_type in sample_types]
+    if len(featurized_types) > 0:
+        for sample_type, features in zip(featurized_types, featurize_unique_windows(chunk_views, [windows[sample_type][0] for sample_type in featurized_types], feature_engineering_type)):
+            streams[(sample_type, True)] = features
+            streams[(sample_type, False)] = features[~windows[sample_type][1]]
     
-    return wav_file_data
+    # The augmented windows are only calculated once for the offset variant, as the regular windows are a subset of those
+    if PYTORCH_AVAILABLE and AUGMENT_DURING_TRAINING:
+        if "label" in featurized_types:
+            label_chunks, label_offsets = windows["label"]
+            label_windows = gather_windows(chunk_views, label_chunks)
+            streams[("label_wave", True)] = label_windows
+            streams[("label_wave", False)] = label_windows[~label_offsets]
+        if "background" in featurized_types:
+            streams[("background_wave", True)] = gather_windows(chunk_views, windows["background"][0])
+    elif PYTORCH_AVAILABLE and "augmented" in sample_types:
+        label_chunks, label_offsets = windows["label"]
+        augmented_features = augmented_feature_engineering_batch(gather_windows(chunk_views, label_chunks), feature_engineering_type)
+        streams[("label_augmented", True)] = augmented_features
+        streams[("label_augmented", False)] = augmented_features[~label_offsets]
+    return streams
+
+# Extracts the features of the given windows of a single cache variant of a source file, without extracting the other windows
+def extract_wav_windows_from_srt(srt_file: str, source_file: str, feature_engineering_type, variant: str, with_offset: bool, window_indices: np.array) -> np.array:
+    chunk_views, [(window_chunks, offset_mask)] = read_srt_windows(srt_file, source_file, [(True, determine_sample_type(variant) == "background")])
+    if not with_offset:
+        window_chunks = window_chunks[~offset_mask]
+    return feature_engineering_batch(gather_windows(chunk_views, window_chunks[window_indices]), RATE, feature_engineering_type)
+
+# Extracts only the selected windows of the sample streams of a source file
+# The selections map the stream names to the indices of the windows to keep, streams without a selection are extracted completely
+# When stream keys are given, only those streams are extracted
+def extract_selected_wav_streams_from_srt(srt_file: str, source_file: str, feature_engineering_type = TYPE_FEATURE_ENGINEERING_NORM_MFSC, with_offset = True, selections: dict = None, stream_keys: List = None) -> dict:
+    chunk_views, [(label_chunks, label_offsets), (background_chunks, background_offsets)] = \
+        read_srt_windows(srt_file, source_file, [(True, False), (True, True)])
+    
+    sample_streams = determine_sample_streams(with_offset)
+    if stream_keys is not None:
+        sample_streams = {key: sample_streams[key] for key in stream_keys}
+
+    stream_chunks = {}
+    for key, (variant, stream_offset) in sample_streams.items():
+        window_chunks, offset_mask = (background_chunks, background_offsets) if variant.startswith("background") else (label_chunks, label_offsets)
+        if not stream_offset:
+            window_chunks = window_chunks[~offset_mask]
+        if selections is not None and key in selections:
+            window_chunks = window_chunks[selections[key]]
+        stream_chunks[key] = window_chunks
+
+    stream_variants = {key: variant for key, (variant, _) in sample_streams.items()}
+    featurized_keys = [key for key in stream_chunks if stream_variants[key] in ["label", "background"]]
+    streams = {}
+    if len(featurized_keys) > 0:
+        streams = dict(zip(featurized_keys, featurize_unique_windows(chunk_views, [stream_chunks[key] for key in featurized_keys], feature_engineering_type)))
+    for key, variant in stream_variants.items():
+        if variant.endswith("_wave"):
+            streams[key] = gather_windows(chunk_views, stream_chunks[key])
+        elif variant == "label_augmented":
+            streams[key] = augmented_feature_engineering_batch(gather_windows(chunk_views, stream_chunks[key]), feature_engineering_type)
+    return streams
@@ -43,5 +43,7 @@ def select_mode():
     elif( setup_mode.lower() == 'x' ):
         print( "Goodbye." )
 
-check_migration()
-root_navigation( True )
\ No newline at end of file
+# The guard is required for the worker processes that load in the training data
+if __name__ == "__main__":
+    check_migration()
+    root_navigation( True )
\ No newline at end of file
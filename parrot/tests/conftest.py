@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import the modules in lib the same way the scripts in the parrot folder do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
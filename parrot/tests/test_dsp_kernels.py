@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from scipy.fftpack import fft
+from lib.signal_processing import determine_legacy_frequency, determine_legacy_frequency_batch, \
+    determine_euclidean_dist, determine_euclidean_dist_batch, determine_zero_crossing_count, determine_zero_crossing_count_batch
+from lib.machinelearning import get_loudest_freq, get_loudest_freq_batch
+
+# The loop implementations that the vectorized kernels replaced, kept as references
+def reference_loudest_freq(fftData, recordLength):
+    fft_result = fft( fftData )
+    positiveFreqs = np.abs( fft_result[ 0:round( len(fft_result)/2 ) ] )
+    highestFreq = 0
+    loudestPeak = 500
+    frequencies = [0]
+    for freq in range( 0, len( positiveFreqs ) ):
+        if( positiveFreqs[ freq ] > loudestPeak ):
+            loudestPeak = positiveFreqs[ freq ]
+            highestFreq = freq
+
+    if( loudestPeak > 500 ):
+        frequencies.append( highestFreq )
+
+    if( recordLength < 1 ):
+        return ( 1 / recordLength ) + np.amax( frequencies )
+    else:
+        return np.amax( frequencies )
+
+def reference_legacy_frequency(waveData):
+    return reference_loudest_freq(waveData, 0.03)
+
+def reference_euclidean_dist(mfscData, half_wave_rectification = False):
+    if half_wave_rectification:
+        distance = 0
+        for index, bin in enumerate(mfscData[-1]):
+            if bin > mfscData[0][index]:
+                distance += abs(bin - mfscData[0][index])
+    else:
+        distance = np.linalg.norm(mfscData[-1] - mfscData[0])
+    return distance
+
+def reference_zero_crossing_count(waveData):
+    zc = 0
+    zc_sign = 0
+    for i in waveData:
+        if zc_sign <= 0 and i > 0:
+            zc += 1
+            zc_sign = 1
+        elif zc_sign >= 0 and i < 0:
+            zc_sign = -1
+            zc += 1
+    return zc
+
+def generate_windows(kind, shape, seed = 0):
+    rng = np.random.default_rng(seed)
+    if kind == "random":
+        return rng.integers(-32768, 32768, shape).astype(np.float64)
+    elif kind == "sparse":
+        windows = np.zeros(shape)
+        mask = rng.random(shape) < 0.02
+        windows[mask] = rng.integers(-32768, 32768, np.count_nonzero(mask))
+        return windows
+    return np.zeros(shape)
+
+WINDOW_KINDS = ["random", "sparse", "silent"]
+
+@pytest.mark.parametrize("kind", WINDOW_KINDS)
+@pytest.mark.parametrize("record_length", [0.03, 0.5, 1, 2])
+def test_loudest_freq(kind, record_length):
+    windows = generate_windows(kind, (16, 480))
+    expected = np.array([reference_loudest_freq(window, record_length) for window in windows])
+    assert np.array_equal([get_loudest_freq(window, record_length) for window in windows], expected)
+    assert np.array_equal(get_loudest_freq_batch(windows, record_length), expected)
+
+@pytest.mark.parametrize("kind", WINDOW_KINDS)
+@pytest.mark.parametrize("window_size", [480, 481, 2])
+def test_legacy_frequency(kind, window_size):
+    windows = generate_windows(kind, (16, window_size), 1)
+    expected = np.array([reference_legacy_frequency(window) for window in windows])
+    assert np.array_equal([determine_legacy_frequency(window) for window in windows], expected)
+    assert np.array_equal(determine_legacy_frequency_batch(windows), expected)
+
+@pytest.mark.parametrize("kind", WINDOW_KINDS)
+@pytest.mark.parametrize("half_wave_rectification", [False, True])
+def test_euclidean_dist(kind, half_wave_rectification):
+    mfscs = generate_windows(kind, (16, 4, 40), 2) / 1000
+    expected = np.array([reference_euclidean_dist(mfsc, half_wave_rectification) for mfsc in mfscs])
+    assert np.array_equal([determine_euclidean_dist(mfsc, half_wave_rectification) for mfsc in mfscs], expected)
+    assert np.array_equal(determine_euclidean_dist_batch(mfscs, half_wave_rectification), expected)
+
+@pytest.mark.parametrize("kind", WINDOW_KINDS)
+def test_zero_crossing_count(kind):
+    windows = generate_windows(kind, (16, 480), 3)
+    expected = np.array([reference_zero_crossing_count(window) for window in windows])
+    assert np.array_equal([determine_zero_crossing_count(window) for window in windows], expected)
+    assert np.array_equal(determine_zero_crossing_count_batch(windows), expected)